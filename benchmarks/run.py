@@ -0,0 +1,286 @@
+# Benchmark runner
+"""
+    Offline benchmark of the conversion stages on synthetic Interfile images.
+
+    python3 -m benchmarks.run -o results.json --thresholds benchmarks/thresholds.json
+
+    Every case runs in a fresh process, so its peak RSS is not affected by
+    the other cases. Exit status is 1 if any regression threshold is not met.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import math
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pydicom
+
+from converter.quantization import min_max, quantize, rescale_parameters
+from converter.reader import (
+    _binary_dtype, clear_header_cache, interfile_header_import, read_binary, read_json_meta
+)
+from converter.synthetic import write_synthetic_interfile
+from converter.writer import (
+    create_series_template, create_slice_from_template, rand_uid, write_dicom
+)
+
+CASES = {
+    'small_f4_le': dict(shape=(64, 128, 128), dtype='<f4'),
+    'medium_f4_le': dict(shape=(128, 256, 256), dtype='<f4'),
+    'medium_f4_be': dict(shape=(128, 256, 256), dtype='>f4'),
+    'medium_i2_le': dict(shape=(128, 256, 256), dtype='<i2'),
+}
+DEFAULT_CASES = ('small_f4_le', 'medium_f4_le')
+
+DEFAULT_META = Path(__file__).parents[1] / 'tests' / 'inputs' / 'metadata_pt.json'
+
+
+def _peak_rss_mb() -> float:
+    """
+        Returns peak resident set size of this process in MiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def _build_datasets(header, metadata) -> None:
+    """
+        Builds all slice datasets in memory, like write_dicom without writing
+    """
+    img, slope, intercept, byte_order = read_binary(header)
+    series = {keyword: rand_uid() for keyword in ('SOPInstanceUID', 'SOPClassUID',
+              'StudyInstanceUID', 'SeriesInstanceUID', 'FrameOfReferenceUID')}
+    template = create_series_template(
+        header, metadata, img.shape, slope, intercept, byte_order, series
+    )
+    for i in range(img.shape[0]):
+        create_slice_from_template(template, img[i, :, :], metadata, i)
+
+def run_case(
+    name: str,
+    header_path: Path,
+    meta_path: Path=DEFAULT_META,
+    repeat: int=3,
+    write_kwargs: Optional[Dict]=None,
+) -> Dict:
+    """
+        Times every conversion stage of an Interfile image
+
+        Arguments:
+        name - name of the case
+        header_path - Interfile header, e.g. from write_synthetic_interfile
+        meta_path - metadata JSON
+        repeat - every stage is run this many times, the best time is kept
+        write_kwargs - passed to write_dicom (e.g. backend, lazy, compression)
+
+        Returns:
+        - dictionary with the case parameters and seconds, throughput (MiB/s of
+          the image file) and peak RSS so far (MiB) of every stage; read_binary
+          of a float image is reading the file only, quantization is timed apart
+    """
+    header_path = Path(header_path)
+    metadata = read_json_meta(meta_path, 'PT')
+    stages = {}
+
+    def timed(stage: str, function: Callable, per_image: bool=True):
+        seconds = math.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            seconds = min(seconds, time.perf_counter() - start)
+        stages[stage] = {
+            'seconds': seconds,
+            'mb_per_s': image_mb/seconds if per_image else None,
+            'peak_rss_mb': _peak_rss_mb(),
+        }
+        return result
+
+    def parse():
+        clear_header_cache()
+        return interfile_header_import(header_path)
+
+    header = timed('header_parse', parse, per_image=False)
+
+    shape = (header.matrix_size_3, header.matrix_size_2, header.matrix_size_1)
+    dtype = _binary_dtype(header)[0]
+    image_mb = math.prod(shape)*np.dtype(dtype).itemsize / 2**20
+
+    if np.dtype(dtype).kind == 'f':
+        # read_binary quantizes float images, reading and quantization are timed apart
+        def read_raw():
+            return np.fromfile(
+                header.header_file_path + header.img_file_name, dtype=dtype,
+                count=math.prod(shape), offset=header.data_offset_in_bytes
+            ).reshape(shape)
+
+        raw = timed('read_binary', read_raw)
+
+        def quantize_raw():
+            return quantize(raw, *rescale_parameters(*min_max(raw)))
+
+        timed('quantization', quantize_raw)
+        del raw
+    else:
+        timed('read_binary', lambda: read_binary(header))
+
+    timed('dataset_build', lambda: _build_datasets(header, metadata))
+
+    with tempfile.TemporaryDirectory(prefix='i2d_benchmark_') as directory:
+        output_path = Path(directory) / 'output'
+
+        def write():
+            shutil.rmtree(output_path, ignore_errors=True)
+            write_dicom(header, metadata, output_path, extended_format=False, **(write_kwargs or {}))
+
+        timed('write_dicom', write)
+
+    return {
+        'name': name,
+        'shape': list(shape),
+        'dtype': dtype,
+        'image_mb': image_mb,
+        'write_kwargs': write_kwargs or {},
+        'stages': stages,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+def run_cases(cases: Dict[str, Dict], **kwargs) -> Dict:
+    """
+        Generates synthetic images of the cases and runs every case in a fresh process,
+        so that neither generation nor other cases affect its peak RSS
+
+        Arguments:
+        cases - dictionary of case name: {'shape': (z, y, x), 'dtype': numpy dtype string}
+        kwargs - passed to run_case
+
+        Returns:
+        - results with environment description
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name, case in cases.items():
+        with tempfile.TemporaryDirectory(prefix='i2d_benchmark_') as directory:
+            header_path = write_synthetic_interfile(directory, name, tuple(case['shape']), case['dtype'])
+            with context.Pool(1) as pool:
+                results.append(pool.apply(run_case, (name, header_path), kwargs))
+        _print_case(results[-1])
+
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pydicom': pydicom.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'cases': results,
+    }
+
+def check_thresholds(results: Dict, thresholds: Dict) -> List[str]:
+    """
+        Compares results with regression thresholds, e.g.
+        {"small_f4_le": {"min_mb_per_s": {"read_binary": 50},
+                         "max_seconds": {"header_parse": 0.05},
+                         "max_peak_rss_mb": 400}}
+        Cases without results are skipped.
+
+        Returns:
+        - list of failure descriptions (empty if all thresholds are met)
+    """
+    failures = []
+    for case in results['cases']:
+        limits = thresholds.get(case['name'], {})
+        stages = case['stages']
+
+        for stage, minimum in limits.get('min_mb_per_s', {}).items():
+            if stage in stages and stages[stage]['mb_per_s'] < minimum:
+                failures.append(
+                    f"{case['name']}: {stage} {stages[stage]['mb_per_s']:.1f} MiB/s < {minimum} MiB/s"
+                )
+        for stage, maximum in limits.get('max_seconds', {}).items():
+            if stage in stages and stages[stage]['seconds'] > maximum:
+                failures.append(
+                    f"{case['name']}: {stage} {stages[stage]['seconds']:.4f} s > {maximum} s"
+                )
+        if 'max_peak_rss_mb' in limits and case['peak_rss_mb'] > limits['max_peak_rss_mb']:
+            failures.append(
+                f"{case['name']}: peak RSS {case['peak_rss_mb']:.0f} MiB > {limits['max_peak_rss_mb']} MiB"
+            )
+    return failures
+
+def _print_case(case: Dict) -> None:
+    print(f"{case['name']} {'x'.join(map(str, case['shape']))} {case['dtype']} ({case['image_mb']:.1f} MiB)")
+    for stage, result in case['stages'].items():
+        throughput = f"{result['mb_per_s']:9.1f} MiB/s" if result['mb_per_s'] else ' '*14
+        print(f"  {stage:<14} {result['seconds']:9.4f} s {throughput} {result['peak_rss_mb']:8.0f} MiB RSS")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmarks conversion stages on synthetic Interfile images.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-c', '--case',
+        help='benchmark case (can be repeated)',
+        action='append',
+        choices=sorted(CASES),
+    )
+    parser.add_argument(
+        '--shape',
+        help='run a custom case of this (z, y, x) shape instead',
+        type=int,
+        nargs=3,
+    )
+    parser.add_argument('--dtype', help='data type of the custom case', type=str, default='<f4')
+    parser.add_argument('-r', '--repeat', help='runs of every stage, best is kept', type=int, default=3)
+    parser.add_argument('-m', '--meta_file', help='metadata JSON', type=str, default=str(DEFAULT_META))
+    parser.add_argument('--backend', help='write_dicom backend', type=str, default='pydicom')
+    parser.add_argument('--lazy', help='write_dicom reads the image lazily', action='store_true')
+    parser.add_argument(
+        '-o', '--output',
+        help='JSON file with results',
+        type=str,
+        default='benchmark_results.json'
+    )
+    parser.add_argument('--thresholds', help='JSON file with regression thresholds', type=str)
+    args = parser.parse_args(argv)
+
+    if args.shape:
+        cases = {'custom': dict(shape=tuple(args.shape), dtype=args.dtype)}
+    else:
+        cases = {name: CASES[name] for name in (args.case or DEFAULT_CASES)}
+
+    results = run_cases(
+        cases,
+        meta_path=Path(args.meta_file),
+        repeat=args.repeat,
+        write_kwargs=dict(backend=args.backend, lazy=args.lazy),
+    )
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.thresholds:
+        with open(args.thresholds, 'r') as f:
+            failures = check_thresholds(results, json.load(f))
+        for failure in failures:
+            print(f'REGRESSION  {failure}')
+        return 1 if failures else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
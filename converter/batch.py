@@ -0,0 +1,335 @@
+# Batch conversion module
+
+import csv
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+import glob
+import json
+import logging
+from pathlib import Path
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from converter.claims import WorkClaims
+from converter.derived import DerivedOutputs
+from converter.exceptions import I2DException
+from converter.reader import iter_interfile_frames, read_json_meta
+from converter.manifest import convert_resumable
+from converter.memory import MemoryBudget
+from converter.writer import write_frames
+from models.metadata import InterfileHeader, CTMetaFile, PETMetaFile
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_FIELDS = ('header', 'metadata', 'output')
+
+
+class BatchJob(NamedTuple):
+    """Single conversion: Interfile header, metadata JSON and output path"""
+    header: Path
+    metadata: Path
+    output: Path
+
+
+class BatchResult(NamedTuple):
+    job: BatchJob
+    error: Optional[str]
+    seconds: float
+    peak_rss_mb: Optional[float]=None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def jobs_from_glob(
+    pattern: str,
+    meta_path: Path,
+    output_dir: Path,
+    extended_format: bool=False,
+) -> List[BatchJob]:
+    """
+        Creates jobs for all headers matching a glob pattern (or all headers in a directory)
+
+        Arguments:
+        pattern - glob pattern of header files, or a directory containing them
+        meta_path - metadata JSON used for every header
+        output_dir - directory where outputs are created
+        extended_format - outputs are single files instead of directories
+
+        Returns:
+        - list of jobs sorted by header path
+    """
+    if Path(pattern).is_dir():
+        pattern = str(Path(pattern) / '*.hdr')
+
+    jobs = []
+    for header in sorted(glob.glob(pattern, recursive=True)):
+        header = Path(header)
+        output_name = header.stem + ('.dcm' if extended_format else '')
+        jobs.append(BatchJob(header, Path(meta_path), Path(output_dir) / output_name))
+    return jobs
+
+
+def jobs_from_manifest(path: Path) -> List[BatchJob]:
+    """
+        Reads jobs from a CSV (with header row) or JSONL manifest.
+        Each record has `header`, `metadata` and `output` fields,
+        relative paths are relative to the manifest directory.
+
+        Arguments:
+        path - path to the manifest
+
+        Returns:
+        - list of jobs in manifest order
+    """
+    path = Path(path)
+
+    with open(path, 'r', newline='') as f:
+        if path.suffix.lower() in ('.jsonl', '.ndjson'):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = list(csv.DictReader(f))
+
+    jobs = []
+    for number, record in enumerate(records, start=1):
+        missing = [field for field in MANIFEST_FIELDS if not record.get(field)]
+        if missing:
+            raise I2DException(f'{path}: record {number} is missing {", ".join(missing)}')
+        jobs.append(BatchJob(*(path.parent / record[field] for field in MANIFEST_FIELDS)))
+    return jobs
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """
+        Parses shard `i/N` (1 <= i <= N) into a pair of ints
+    """
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard: {text}, use i/N, e.g. 1/4')
+    if not 1 <= index <= count:
+        raise ValueError(f'Invalid shard: {text}, i has to be between 1 and N')
+    return index, count
+
+
+def shard_jobs(jobs: Iterable[BatchJob], index: int, count: int) -> List[BatchJob]:
+    """
+        Returns jobs of shard `index` of `count`: every count-th job of the list
+        sorted by header path, so that all nodes split the same list the same way
+
+        Arguments:
+        jobs - all jobs
+        index - shard number, from 1 to count
+        count - number of shards (nodes)
+    """
+    ordered = sorted(jobs, key=lambda job: str(job.header))
+    return ordered[index - 1::count]
+
+
+def _convert_job(
+    job: BatchJob,
+    frames: List[InterfileHeader],
+    metadata: Union[CTMetaFile, PETMetaFile],
+    convert_kwargs: Dict,
+) -> BatchResult:
+    start = time.perf_counter()
+    write_kwargs = dict(convert_kwargs)
+    max_memory = write_kwargs.pop('max_memory', None)
+    # A budget per job, measured in the process converting it
+    budget = MemoryBudget(max_memory) if max_memory is not None else None
+    try:
+        if budget is not None:
+            write_kwargs['memory_budget'] = budget
+        if write_kwargs.pop('resume', False):
+            convert_resumable(job.header, frames, job.metadata, metadata, job.output, **write_kwargs)
+        else:
+            write_frames(frames, metadata, output_path=job.output, **write_kwargs)
+    except Exception as e:
+        return BatchResult(job, f'{e.__class__.__name__}: {e}', time.perf_counter() - start)
+    peak_rss_mb = budget.report()['peak_rss_mb'] if budget is not None else None
+    return BatchResult(job, None, time.perf_counter() - start, peak_rss_mb)
+
+
+def _prepare_jobs(
+    jobs: Iterable[BatchJob],
+) -> Tuple[List[Tuple[BatchJob, List[InterfileHeader], Union[CTMetaFile, PETMetaFile]]], List[BatchResult]]:
+    """
+        Parses headers (of all time frames) and metadata of all jobs, every metadata
+        file is parsed once per modality. Jobs which can not be parsed are returned
+        as failed results.
+    """
+    metadata_cache = {}
+    prepared, failed = [], []
+
+    for job in jobs:
+        try:
+            frames = list(iter_interfile_frames(job.header))
+            modality = frames[0].modality
+            key = (Path(job.metadata).resolve(), modality)
+            if key not in metadata_cache:
+                metadata_cache[key] = read_json_meta(job.metadata, modality)
+            prepared.append((job, frames, metadata_cache[key]))
+        except Exception as e:
+            failed.append(BatchResult(job, f'{e.__class__.__name__}: {e}', 0.0))
+
+    return prepared, failed
+
+
+def run_batch(
+    jobs: Iterable[BatchJob],
+    processes: int=1,
+    extended_format: bool=False,
+    lazy: bool=False,
+    backend: str='pydicom',
+    compression: Optional[str]=None,
+    pipeline: bool=False,
+    archive_deflate: bool=False,
+    resume: bool=False,
+    per_slice_rescale: bool=False,
+    max_memory: Optional[int]=None,
+    float_pixel_data: bool=False,
+    derived: Optional[DerivedOutputs]=None,
+    shard: Optional[Tuple[int, int]]=None,
+    claims: Optional[WorkClaims]=None,
+) -> List[BatchResult]:
+    """
+        Converts all jobs, whole volumes are spread across a process pool.
+        A failing job does not stop the others.
+
+        Several nodes sharing a filesystem split the jobs statically with
+        `shard`, or dynamically with `claims`: a job is claimed right before it
+        is converted, so faster nodes convert more jobs. Both can be combined.
+
+        Arguments:
+        jobs - jobs to convert
+        processes - number of volumes converted at the same time
+        extended_format, lazy, backend, compression, pipeline, per_slice_rescale,
+            float_pixel_data, derived - passed to write_dicom
+        shard - (i, N): convert only the i-th of N parts of the jobs (see shard_jobs)
+        claims - claims.WorkClaims in a directory shared by the nodes, jobs
+            finished or claimed by other nodes are skipped
+        archive_deflate - compress members of outputs written as archives (.zip, .tar)
+        resume - skip files completed by a previous run (see manifest.convert_resumable)
+        max_memory - memory budget (bytes) of every conversion process, volumes
+            are converted slab by slab within it (see writer.write_dicom)
+
+        Returns:
+        - list of results, one per job
+    """
+    if shard is not None:
+        jobs = shard_jobs(jobs, *shard)
+    if claims is not None:
+        jobs = [job for job in jobs if not claims.is_finished(job.header)]
+
+    prepared, results = _prepare_jobs(jobs)
+    convert_kwargs = dict(
+        extended_format=extended_format, lazy=lazy, backend=backend, compression=compression,
+        pipeline=pipeline, archive_deflate=archive_deflate, resume=resume,
+        per_slice_rescale=per_slice_rescale, max_memory=max_memory, float_pixel_data=float_pixel_data,
+    )
+    if derived is not None:
+        convert_kwargs['derived'] = derived
+
+    if claims is not None:
+        with claims:
+            # Jobs which can not be parsed are reported by the node claiming them
+            failed = [result for result in results if claims.claim(result.job.header)]
+            for result in failed:
+                claims.release(result.job.header, result.error)
+            return failed + _run_claimed(prepared, processes, convert_kwargs, claims)
+
+    if processes <= 1:
+        for job, frames, metadata in prepared:
+            results.append(_convert_job(job, frames, metadata, convert_kwargs))
+            _log_result(results[-1])
+        return results
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {
+            executor.submit(_convert_job, job, frames, metadata, convert_kwargs): job
+            for job, frames, metadata in prepared
+        }
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # e.g. worker process killed
+                results.append(BatchResult(futures[future], f'{e.__class__.__name__}: {e}', 0.0))
+            _log_result(results[-1])
+
+    return results
+
+
+def _run_claimed(
+    prepared: List[Tuple[BatchJob, List[InterfileHeader], Union[CTMetaFile, PETMetaFile]]],
+    processes: int,
+    convert_kwargs: Dict,
+    claims: WorkClaims,
+) -> List[BatchResult]:
+    """
+        Converts jobs which this node manages to claim, at most `processes` at a time.
+        Jobs are claimed only when a process is free, unclaimed ones are left to other nodes.
+    """
+    results = []
+    pending = iter(prepared)
+    skipped = 0
+
+    def next_claimed():
+        nonlocal skipped
+        for job, frames, metadata in pending:
+            if claims.claim(job.header):
+                return job, frames, metadata
+            skipped += 1
+        return None
+
+    def finish(result: BatchResult) -> None:
+        claims.release(result.job.header, result.error)
+        results.append(result)
+        _log_result(result)
+
+    if processes <= 1:
+        while (item := next_claimed()) is not None:
+            finish(_convert_job(*item, convert_kwargs))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            running = {}
+            while True:
+                while len(running) < processes and (item := next_claimed()) is not None:
+                    running[executor.submit(_convert_job, *item, convert_kwargs)] = item[0]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = BatchResult(job, f'{e.__class__.__name__}: {e}', 0.0)
+                    finish(result)
+
+    LOGGER.info('Converted %d jobs, %d were claimed by other nodes', len(results), skipped)
+    return results
+
+
+def _log_result(result: BatchResult) -> None:
+    if result.ok:
+        LOGGER.info('Converted %s (%.2f s)', result.job.header, result.seconds)
+    else:
+        LOGGER.error('Failed %s: %s', result.job.header, result.error)
+
+
+def format_summary(results: List[BatchResult]) -> str:
+    """
+        Returns per-file summary of batch results, ordered by header path
+    """
+    lines = []
+    for result in sorted(results, key=lambda r: str(r.job.header)):
+        if result.ok:
+            peak = f', peak RSS {result.peak_rss_mb:.0f} MiB' if result.peak_rss_mb is not None else ''
+            lines.append(f'OK      {result.job.header} -> {result.job.output} ({result.seconds:.2f} s{peak})')
+        else:
+            lines.append(f'FAILED  {result.job.header}: {result.error}')
+
+    failed = sum(not result.ok for result in results)
+    lines.append(f'{len(results) - failed} converted, {failed} failed')
+    return '\n'.join(lines)
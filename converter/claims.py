@@ -0,0 +1,169 @@
+# Work claiming module
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+from typing import Dict, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds after which a claim which is not refreshed is considered abandoned
+DEFAULT_CLAIM_TTL = 300.0
+
+
+def node_id() -> str:
+    """
+        Returns identifier of this process: host name and process id
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkClaims:
+    """
+        Claims of conversions in a directory shared by all nodes.
+
+        A node claims an input by creating `<key>.lock` with O_CREAT | O_EXCL,
+        which succeeds on one node only (also on NFS v3 and newer). While the
+        node converts the input, a heartbeat thread touches its lock files. A
+        lock which is not touched for `ttl` seconds belongs to a crashed node:
+        it is renamed away (only one node wins the rename) and claimed again.
+        Finished inputs are marked with `<key>.done` or `<key>.failed` and are
+        skipped by all nodes, also in later runs.
+    """
+
+    def __init__(self, directory: Path, ttl: float=DEFAULT_CLAIM_TTL, node: Optional[str]=None):
+        """
+            Arguments:
+            directory - shared claims directory, created if missing
+            ttl - seconds after which a lock without heartbeat expires
+            node - identifier written into locks (default: host name and pid)
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.node = node or node_id()
+        self._held: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @staticmethod
+    def key(path: Path) -> str:
+        """
+            Returns claim key of an input: hash of its absolute path
+        """
+        return hashlib.sha1(str(Path(path).resolve()).encode()).hexdigest()
+
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.directory / f'{key}.{suffix}'
+
+    def is_finished(self, path: Path) -> bool:
+        key = self.key(path)
+        return self._path(key, 'done').exists() or self._path(key, 'failed').exists()
+
+    def _create_lock(self, key: str, path: Path) -> bool:
+        token = f'{self.node}:{time.time_ns()}'
+        try:
+            fd = os.open(self._path(key, 'lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'node': self.node, 'token': token, 'input': str(path), 'claimed': time.time()}, f)
+        with self._lock:
+            self._held[key] = token
+        return True
+
+    def _break_stale(self, key: str) -> bool:
+        """
+            Removes the lock if its heartbeat stopped, returns True if it was removed
+        """
+        lock_path = self._path(key, 'lock')
+        try:
+            age = time.time() - lock_path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.ttl:
+            return False
+        stale_path = self._path(key, f'stale.{self.node.replace(":", "_")}')
+        try:
+            # Atomic, when several nodes find the stale lock only one renames it
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return True
+        if time.time() - stale_path.stat().st_mtime < self.ttl:
+            # Another node replaced the stale lock after we looked at it, put its lock back
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+            stale_path.unlink(missing_ok=True)
+            return False
+        LOGGER.warning('Claim %s expired (no heartbeat for %.0f s), claiming it again', lock_path, age)
+        stale_path.unlink(missing_ok=True)
+        return True
+
+    def claim(self, path: Path) -> bool:
+        """
+            Claims the input, returns False if it is finished or claimed by another node
+        """
+        key = self.key(path)
+        if self.is_finished(path):
+            return False
+        if self._create_lock(key, path):
+            return True
+        return self._break_stale(key) and self._create_lock(key, path)
+
+    def _owns(self, key: str) -> bool:
+        try:
+            with open(self._path(key, 'lock'), 'r') as f:
+                return json.load(f).get('token') == self._held.get(key)
+        except (OSError, ValueError):
+            return False
+
+    def release(self, path: Path, error: Optional[str]=None) -> None:
+        """
+            Marks the claimed input as done (or failed with the error) and removes the lock
+        """
+        key = self.key(path)
+        owned = self._owns(key)
+        with self._lock:
+            self._held.pop(key, None)
+        if not owned:
+            LOGGER.warning('Claim of %s was taken over by another node', path)
+            return
+
+        record = {'node': self.node, 'input': str(path), 'finished': time.time(), 'error': error}
+        marker = self._path(key, 'failed' if error is not None else 'done')
+        marker.write_text(json.dumps(record))
+        self._path(key, 'lock').unlink(missing_ok=True)
+
+    def _beat(self) -> None:
+        while not self._stop.wait(self.ttl/4):
+            with self._lock:
+                keys = list(self._held)
+            for key in keys:
+                try:
+                    os.utime(self._path(key, 'lock'))
+                except FileNotFoundError:
+                    pass
+
+    def __enter__(self) -> 'WorkClaims':
+        # Locks of inputs being converted are refreshed four times per ttl
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name='claims-heartbeat', daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._heartbeat.join()
+        # Inputs still held (e.g. after Ctrl+C) are left for other nodes at once
+        for key in list(self._held):
+            if self._owns(key):
+                self._path(key, 'lock').unlink(missing_ok=True)
+        self._held.clear()
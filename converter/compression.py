@@ -0,0 +1,152 @@
+# Compression module
+
+import struct
+import zlib
+from typing import BinaryIO, Optional
+
+import numpy as np
+from pydicom.uid import (
+    DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, RLELossless, UID
+)
+
+COMPRESSIONS = ('rle', 'deflate')
+
+TRANSFER_SYNTAXES = {
+    None: ExplicitVRLittleEndian,
+    'rle': RLELossless,
+    'deflate': DeflatedExplicitVRLittleEndian,
+}
+
+# PackBits runs shorter than this are cheaper inside a literal run
+MIN_REPLICATE_RUN = 3
+MAX_RUN = 128
+
+
+def transfer_syntax(compression: Optional[str]) -> UID:
+    """
+        Returns transfer syntax UID of the compression (None - uncompressed)
+    """
+    if compression not in TRANSFER_SYNTAXES:
+        raise ValueError(f"Unknown compression: {compression}, use one of {COMPRESSIONS}")
+    return TRANSFER_SYNTAXES[compression]
+
+def _split_runs(starts: np.ndarray, lengths: np.ndarray):
+    """
+        Splits runs longer than MAX_RUN into consecutive runs of at most MAX_RUN bytes
+    """
+    chunks = -(-lengths // MAX_RUN)
+    first_chunk = np.repeat(np.cumsum(chunks) - chunks, chunks)
+    chunk_number = np.arange(chunks.sum()) - first_chunk
+    run = np.repeat(np.arange(len(lengths)), chunks)
+    return (
+        starts[run] + chunk_number*MAX_RUN,
+        np.minimum(lengths[run] - chunk_number*MAX_RUN, MAX_RUN),
+    )
+
+def rle_encode_segment(segment: np.ndarray, row_length: int) -> np.ndarray:
+    """
+        PackBits encodes one byte segment, every row separately (DICOM PS3.5 Annex G).
+        Runs are found and emitted with vectorized NumPy operations.
+
+        Arguments:
+        segment - uint8 array of the segment bytes
+        row_length - number of bytes in a row
+
+        Returns:
+        - uint8 array of encoded segment, padded to even length
+    """
+    segment = segment.ravel()
+    size = segment.size
+
+    # Starts of runs of equal bytes, a run never crosses a row boundary
+    is_start = np.ones(size, dtype=bool)
+    is_start[1:] = segment[1:] != segment[:-1]
+    is_start[::row_length] = True
+    run_starts = np.flatnonzero(is_start)
+    run_lengths = np.diff(np.append(run_starts, size))
+
+    replicate = run_lengths >= MIN_REPLICATE_RUN
+
+    # Consecutive short runs in the same row are joined into one literal run
+    literal_starts = run_starts[~replicate]
+    literal_lengths = run_lengths[~replicate]
+    follows_literal = np.zeros(size + 1, dtype=bool)
+    follows_literal[literal_starts + literal_lengths] = True
+    new_group = ~follows_literal[literal_starts] | (literal_starts % row_length == 0)
+    group_index = np.flatnonzero(new_group)
+    literal_lengths = np.add.reduceat(literal_lengths, group_index) if group_index.size else literal_lengths
+    literal_starts = literal_starts[group_index]
+
+    rep_starts, rep_lengths = _split_runs(run_starts[replicate], run_lengths[replicate])
+    lit_starts, lit_lengths = _split_runs(literal_starts, literal_lengths)
+
+    # Header byte: n-1 for n literal bytes, 257-n for n replicated bytes
+    starts = np.concatenate([rep_starts, lit_starts])
+    lengths = np.concatenate([rep_lengths, lit_lengths])
+    is_literal = np.concatenate([np.zeros(rep_starts.size, bool), np.ones(lit_starts.size, bool)])
+    order = np.argsort(starts, kind='stable')
+    starts, lengths, is_literal = starts[order], lengths[order], is_literal[order]
+
+    encoded_lengths = np.where(is_literal, lengths + 1, 2)
+    offsets = np.cumsum(encoded_lengths) - encoded_lengths
+    total = int(encoded_lengths.sum())
+
+    out = np.zeros(total + total % 2, dtype=np.uint8)
+    out[offsets] = np.where(is_literal, lengths - 1, (257 - lengths) % 256)
+
+    out[offsets[~is_literal] + 1] = segment[starts[~is_literal]]
+
+    # Copy literal bytes: build gather/scatter indices for all literal runs at once
+    lit_offsets, lit_starts, lit_lengths = offsets[is_literal], starts[is_literal], lengths[is_literal]
+    position = np.arange(lit_lengths.sum()) - np.repeat(np.cumsum(lit_lengths) - lit_lengths, lit_lengths)
+    out[np.repeat(lit_offsets + 1, lit_lengths) + position] = segment[np.repeat(lit_starts, lit_lengths) + position]
+
+    return out
+
+def rle_encode_frame(frame: np.ndarray, columns: int) -> bytes:
+    """
+        Encodes a frame with RLE Lossless, one segment per byte of a sample
+        (most significant byte first)
+
+        Arguments:
+        frame - 2D image (any integer dtype)
+        columns - number of pixels in a row (Columns attribute)
+
+        Returns:
+        - RLE frame: 64 bytes header with segment offsets and encoded segments
+    """
+    itemsize = frame.dtype.itemsize
+    big_endian = np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder('>'))
+    samples = big_endian.view(np.uint8).reshape(-1, itemsize)
+
+    segments = [rle_encode_segment(samples[:, i], columns) for i in range(itemsize)]
+
+    offsets = np.cumsum([64] + [segment.size for segment in segments[:-1]])
+    header = struct.pack('<L', itemsize) + struct.pack(f'<{itemsize}L', *offsets)
+    header += b'\x00' * (64 - len(header))
+
+    return header + b''.join(segment.tobytes() for segment in segments)
+
+
+class DeflateWriter:
+    """
+        File-like wrapper deflating everything written to it (Deflated Explicit VR
+        Little Endian data set). close() flushes the compressor, it does not close fp.
+    """
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        self.length = 0
+        self.compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+    def write(self, data) -> None:
+        deflated = self.compressor.compress(data)
+        self.length += len(deflated)
+        self.fp.write(deflated)
+
+    def close(self) -> None:
+        deflated = self.compressor.flush()
+        self.length += len(deflated)
+        self.fp.write(deflated)
+        if self.length % 2:
+            self.fp.write(b'\x00')
@@ -0,0 +1,334 @@
+# Derived outputs module (projections and previews)
+
+import copy
+import logging
+from pathlib import Path
+import struct
+from typing import Dict, Tuple
+import zlib
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import (
+    ExplicitVRLittleEndian, MultiFrameGrayscaleWordSecondaryCaptureImageStorage,
+    SecondaryCaptureImageStorage, generate_uid
+)
+
+from converter.quantization import quantize, rescale_parameters
+from converter.settings import IMPLEMENTATION_VERSION_NAME, UID
+
+LOGGER = logging.getLogger(__name__)
+
+DERIVED_FORMATS = ('png', 'dicom')
+
+# Descriptions of the projections
+PROJECTIONS = {
+    'axial': 'Axial MIP',
+    'coronal': 'Coronal MIP',
+    'sagittal': 'Sagittal MIP',
+}
+
+# Template attributes copied to derived images (patient, study and frame of reference)
+COPIED_KEYWORDS = (
+    'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'PatientAge', 'PatientWeight',
+    'StudyInstanceUID', 'StudyDate', 'StudyTime', 'StudyID', 'StudyDescription',
+    'ReferringPhysicianName', 'AccessionNumber', 'FrameOfReferenceUID', 'Manufacturer',
+)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _group_sizes(length: int, factor: int) -> np.ndarray:
+    return np.diff(np.append(np.arange(0, length, factor), length))
+
+
+class SeriesProjections:
+    """
+        Maximum intensity projections and a downsampled (block mean) preview
+        of one series, accumulated from blocks of slices as they are converted.
+        Values are rescaled to real units (RescaleSlope and RescaleIntercept
+        of every slice), so per-slice rescaled series project correctly.
+    """
+
+    def __init__(self, shape: Tuple[int, int, int], rescale_slope, rescale_intercept, preview_factor: int):
+        """
+            Arguments:
+            shape - shape of the volume (slices, rows of a slice, columns of a slice)
+            rescale_slope, rescale_intercept - scalars or values per slice
+            preview_factor - size of the preview blocks along every axis
+        """
+        n, y, x = shape
+        self.shape = shape
+        self.rescale_slope = np.broadcast_to(np.asarray(rescale_slope, dtype=np.float64), (n,))
+        self.rescale_intercept = np.broadcast_to(np.asarray(rescale_intercept, dtype=np.float64), (n,))
+        self.factor = preview_factor
+
+        self.axial = np.full((y, x), -np.inf)
+        self.coronal = np.full((n, x), -np.inf)
+        self.sagittal = np.full((n, y), -np.inf)
+
+        self._y_groups = np.arange(0, y, preview_factor)
+        self._x_groups = np.arange(0, x, preview_factor)
+        self._preview_sum = np.zeros((-(-n // preview_factor), len(self._y_groups), len(self._x_groups)))
+        # Voxels summed in every preview block
+        self._preview_count = (
+            _group_sizes(n, preview_factor)[:, None, None]
+            * _group_sizes(y, preview_factor)[None, :, None]
+            * _group_sizes(x, preview_factor)[None, None, :]
+        )
+        self._seen = np.zeros(n, dtype=bool)
+
+    def update(self, start: int, block: np.ndarray) -> None:
+        """
+            Adds slices [start, start + len(block)) of the converted volume
+        """
+        stop = start + block.shape[0]
+        if self._seen[start:stop].all():
+            return
+        self._seen[start:stop] = True
+
+        values = (
+            block*self.rescale_slope[start:stop, None, None] + self.rescale_intercept[start:stop, None, None]
+        )
+        np.maximum(self.axial, values.max(axis=0), out=self.axial)
+        self.coronal[start:stop] = values.max(axis=1)
+        self.sagittal[start:stop] = values.max(axis=2)
+
+        sums = np.add.reduceat(np.add.reduceat(values, self._y_groups, axis=1), self._x_groups, axis=2)
+        np.add.at(self._preview_sum, np.arange(start, stop) // self.factor, sums)
+
+    def observe(self, volume) -> '_ObservedVolume':
+        """
+            Returns the volume (array or reader.InterfileVolume) wrapped so that
+            every slice read from it is added
+        """
+        return _ObservedVolume(volume, self)
+
+    @property
+    def complete(self) -> bool:
+        return bool(self._seen.all())
+
+    @property
+    def preview(self) -> np.ndarray:
+        return self._preview_sum / self._preview_count
+
+    def images(self) -> Dict[str, np.ndarray]:
+        """
+            Returns projections and preview volume, by name
+        """
+        if not self.complete:
+            raise ValueError(f'Only {self._seen.sum()} of {len(self._seen)} slices were projected')
+        return {'axial': self.axial, 'coronal': self.coronal, 'sagittal': self.sagittal, 'preview': self.preview}
+
+
+class _ObservedVolume:
+    """
+        Volume (array or reader.InterfileVolume) passing every slice read with
+        volume[i] (or volume[i, :, :]) to SeriesProjections
+    """
+
+    def __init__(self, volume, projections: SeriesProjections):
+        self.volume = volume
+        self.projections = projections
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.volume.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.volume.dtype
+
+    def __len__(self) -> int:
+        return len(self.volume)
+
+    def __getitem__(self, key) -> np.ndarray:
+        values = self.volume[key]
+        first, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(first, (int, np.integer)) and all(k == slice(None) for k in rest):
+            self.projections.update(range(len(self))[first], np.asarray(values)[None])
+        elif key is Ellipsis:
+            self.projections.update(0, np.asarray(values))
+        return values
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        values = np.asarray(self.volume)
+        self.projections.update(0, values)
+        return values if dtype is None else values.astype(dtype)
+
+
+def write_png(path: Path, image: np.ndarray) -> None:
+    """
+        Writes 8-bit grayscale image as PNG (zlib only, no imaging library needed)
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    # Every row starts with filter type 0 (none)
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), image])
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+def _to_uint8(image: np.ndarray) -> np.ndarray:
+    minimum, maximum = image.min(), image.max()
+    scale = 255/(maximum - minimum) if maximum > minimum else 0
+    return np.round((image - minimum)*scale).astype(np.uint8)
+
+def montage(volume: np.ndarray) -> np.ndarray:
+    """
+        Tiles slices of the volume into a 2D image, row by row in a near-square grid
+    """
+    n, y, x = volume.shape
+    columns = int(np.ceil(np.sqrt(n)))
+    rows = -(-n // columns)
+    tiles = np.zeros((rows*columns, y, x), dtype=volume.dtype)
+    tiles[:n] = volume
+    return tiles.reshape(rows, columns, y, x).swapaxes(1, 2).reshape(rows*y, columns*x)
+
+
+class DerivedOutputs:
+    """
+        Settings of the derived outputs written next to a conversion: coronal,
+        sagittal and axial MIPs and a preview volume downsampled by block means,
+        as PNG (the preview as a montage of its slices) or as Secondary Capture
+        DICOM (the preview as a multi-frame image).
+    """
+
+    def __init__(self, directory: Path, image_format: str='png', preview_factor: int=4):
+        """
+            Arguments:
+            directory - directory where derived files are written
+            image_format - 'png' or 'dicom'
+            preview_factor - downsampling factor of the preview along every axis
+        """
+        if image_format not in DERIVED_FORMATS:
+            raise ValueError(f'Unknown derived format: {image_format}, use one of {DERIVED_FORMATS}')
+        if preview_factor < 1:
+            raise ValueError('Preview factor has to be at least 1')
+        self.directory = Path(directory)
+        self.image_format = image_format
+        self.preview_factor = preview_factor
+
+    def series(self, template: Dataset, shape: Tuple[int, int, int]) -> SeriesProjections:
+        """
+            Returns accumulator of a series, with rescale values of the template
+        """
+        return SeriesProjections(
+            shape, np.asarray(template.RescaleSlope, dtype=np.float64),
+            np.asarray(template.RescaleIntercept, dtype=np.float64), self.preview_factor
+        )
+
+    def write(self, projections: SeriesProjections, template: Dataset, name: str) -> Dict[str, Path]:
+        """
+            Writes `{name}_mip_<axial|coronal|sagittal>` and `{name}_preview` files
+
+            Returns:
+            - paths of the written files, by image name
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        images = projections.images()
+        paths = {}
+
+        if self.image_format == 'png':
+            for image_name, image in images.items():
+                path = self.directory / f'{name}_{"" if image_name == "preview" else "mip_"}{image_name}.png'
+                write_png(path, _to_uint8(montage(image) if image.ndim == 3 else image))
+                paths[image_name] = path
+        else:
+            series_uid = str(generate_uid(prefix=UID, entropy_srcs=[template.SeriesInstanceUID, 'derived']))
+            for number, (image_name, image) in enumerate(images.items(), start=1):
+                path = self.directory / f'{name}_{"" if image_name == "preview" else "mip_"}{image_name}.dcm'
+                ds = secondary_capture(image, template, image_name, series_uid, number, self.preview_factor)
+                ds.save_as(path, write_like_original=False)
+                paths[image_name] = path
+
+        LOGGER.info('Written derived images of %s to %s', name, self.directory)
+        return paths
+
+
+def _pixel_spacing(template: Dataset, image_name: str, preview_factor: int):
+    row_spacing, column_spacing = (float(v) for v in template.PixelSpacing)
+    slice_spacing = float(template.SliceThickness)
+    if image_name == 'axial':
+        return [row_spacing, column_spacing]
+    if image_name == 'coronal':
+        return [slice_spacing, column_spacing]
+    if image_name == 'sagittal':
+        return [slice_spacing, row_spacing]
+    return [row_spacing*preview_factor, column_spacing*preview_factor]
+
+def secondary_capture(
+    image: np.ndarray,
+    template: Dataset,
+    image_name: str,
+    series_uid: str,
+    instance_number: int,
+    preview_factor: int=1,
+) -> Dataset:
+    """
+        Creates Secondary Capture dataset of a derived image (multi-frame for
+        a volume), quantized to 16 bits with RescaleSlope and RescaleIntercept
+
+        Arguments:
+        image - 2D projection or 3D preview volume in real units
+        template - series template (patient, study and geometry attributes)
+        image_name - 'axial', 'coronal', 'sagittal' or 'preview'
+        series_uid - series of the derived images
+        instance_number - number of the image in the derived series
+        preview_factor - downsampling factor of the preview volume
+    """
+    rescale_slope, rescale_intercept = rescale_parameters(image.min(), image.max())
+    if rescale_slope == 0:
+        rescale_slope = 1
+    pixels = quantize(image[None] if image.ndim == 2 else image, rescale_slope, rescale_intercept)
+
+    ds = Dataset()
+    for keyword in COPIED_KEYWORDS:
+        if keyword in template:
+            ds[keyword] = copy.deepcopy(template[keyword])
+
+    multiframe = image.ndim == 3
+    ds.SOPClassUID = (
+        MultiFrameGrayscaleWordSecondaryCaptureImageStorage if multiframe else SecondaryCaptureImageStorage
+    )
+    ds.SOPInstanceUID = str(generate_uid(prefix=UID, entropy_srcs=[series_uid, image_name]))
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = 999
+    ds.InstanceNumber = instance_number
+    ds.Modality = 'OT'
+    ds.ConversionType = 'WSD' # workstation
+    ds.ImageType = ['DERIVED', 'SECONDARY', 'PREVIEW' if image_name == 'preview' else 'MIP']
+    ds.SeriesDescription = f'{template.get("SeriesDescription", "")} derived'.strip()
+    ds.DerivationDescription = (
+        f'Preview, block mean of {preview_factor} voxels per axis' if image_name == 'preview'
+        else PROJECTIONS[image_name]
+    )
+    ds.PixelSpacing = _pixel_spacing(template, image_name, preview_factor)
+
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows, ds.Columns = pixels.shape[1:]
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.RescaleIntercept = float(rescale_intercept)
+    ds.RescaleSlope = float(rescale_slope)
+    ds.RescaleType = 'US'
+    if multiframe:
+        ds.NumberOfFrames = pixels.shape[0]
+    ds.PixelData = pixels.astype('<u2', copy=False).tobytes()
+
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.ImplementationVersionName = IMPLEMENTATION_VERSION_NAME
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.fix_meta_info()
+    return ds
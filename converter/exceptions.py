@@ -13,3 +13,7 @@ class InterfileInvalidValueException(I2DException):
 class InterfileDataMissingException(I2DException):
     '''Mandatory value missing from Interfile'''
     pass
+
+class DicomStoreException(I2DException):
+    '''Sending DICOM objects to a Storage SCP failed'''
+    pass
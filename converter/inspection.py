@@ -0,0 +1,250 @@
+# Interfile inspection module
+
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from converter.profiling import profile_stage
+from converter.quantization import _blocks
+from converter.reader import _binary_dtype, interfile_header_import
+
+LOGGER = logging.getLogger(__name__)
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+HISTOGRAM_BINS = 20
+# Percentiles are read from a histogram of that many bins, the error is below
+# (max - min)/PERCENTILE_BINS
+PERCENTILE_BINS = 2**16
+# Voxels read with --sample if no number is given
+SAMPLE_VOXELS = 2**20
+# Width of histogram and profile bars and maximum number of printed profile rows
+BAR_WIDTH = 40
+PROFILE_ROWS = 32
+
+
+class ImageReport(NamedTuple):
+    """Header fields, file size check and voxel statistics of an Interfile image"""
+    header: Dict
+    image_path: str
+    file_bytes: int
+    expected_bytes: int
+    voxels: int
+    sampled: bool
+    non_finite: int
+    minimum: Optional[float]
+    maximum: Optional[float]
+    mean: Optional[float]
+    std: Optional[float]
+    percentiles: Dict[str, float]
+    histogram_counts: List[int]
+    histogram_edges: List[float]
+    slices: List[int]
+    slice_means: List[float]
+    slice_maxima: List[float]
+
+    @property
+    def size_status(self) -> str:
+        if self.file_bytes == self.expected_bytes:
+            return 'ok'
+        return 'truncated' if self.file_bytes < self.expected_bytes else 'trailing data'
+
+    def as_dict(self) -> Dict:
+        report = self._asdict()
+        report['size_status'] = self.size_status
+        return report
+
+
+def _sample_steps(shape, sample: Optional[int]):
+    """
+        Returns steps over slices and rows reading about `sample` voxels,
+        rows of every slice are skipped first, then whole slices
+    """
+    if sample is None:
+        return 1, 1
+    step = max(1, math.ceil(np.prod(shape, dtype=np.float64)/sample))
+    return math.ceil(step/shape[1]), min(step, shape[1])
+
+def _finite_blocks(view: np.ndarray):
+    for block in _blocks(view):
+        values = np.asarray(view[block], dtype=np.float64)
+        yield values, np.isfinite(values)
+
+def _percentile(counts: np.ndarray, minimum: float, maximum: float, q: float) -> float:
+    # Linear interpolation inside the histogram bin holding the q-th percentile
+    cumulative = np.cumsum(counts)
+    rank = q/100*cumulative[-1]
+    index = min(int(np.searchsorted(cumulative, rank)), len(counts) - 1)
+    below = cumulative[index - 1] if index > 0 else 0
+    fraction = (rank - below)/counts[index] if counts[index] else 0.0
+    return float(minimum + (index + fraction)*(maximum - minimum)/len(counts))
+
+def inspect_interfile(
+    path: Path,
+    bins: int=HISTOGRAM_BINS,
+    sample: Optional[int]=None,
+) -> ImageReport:
+    """
+        Reads statistics of an Interfile image in blocks of slices, without
+        converting it. Voxels are stored values (before any rescaling), slices
+        are numbered in the order of the image file. A truncated image file is
+        reported and its complete slices are inspected.
+
+        The first pass finds minimum, maximum, mean and the per-slice profile,
+        the second fills a fine histogram percentiles are interpolated from.
+
+        Arguments:
+        path - Interfile header (all frames of a dynamic image are inspected)
+        bins - number of histogram bins
+        sample - read only about that many voxels: every n-th row of every
+            slice (and every m-th slice of large images), for fast estimates
+
+        Returns:
+        - ImageReport
+    """
+    obj = interfile_header_import(Path(path))
+    data_type, _ = _binary_dtype(obj)
+    image_path = obj.header_file_path + obj.img_file_name
+
+    shape = (obj.images_number, obj.matrix_size_2, obj.matrix_size_1)
+    slice_bytes = shape[1]*shape[2]*obj.bytes_per_pixel
+    expected_bytes = obj.data_offset_in_bytes + shape[0]*slice_bytes
+    file_bytes = os.path.getsize(image_path)
+    if file_bytes != expected_bytes:
+        LOGGER.warning(
+            'Size of %s is %d bytes, %d expected from the header', image_path, file_bytes, expected_bytes
+        )
+
+    # Only complete slices are mapped
+    complete = max(0, min(shape[0], (file_bytes - obj.data_offset_in_bytes)//slice_bytes))
+    slice_step, row_step = _sample_steps(shape, sample)
+    slices = list(range(0, complete, slice_step))
+
+    minimum, maximum, total, squares, count, non_finite = np.inf, -np.inf, 0.0, 0.0, 0, 0
+    slice_means, slice_maxima = [], []
+    fine = np.zeros(PERCENTILE_BINS, dtype=np.int64)
+
+    if complete:
+        raw = np.memmap(
+            image_path, dtype=data_type, mode='r', offset=obj.data_offset_in_bytes,
+            shape=(complete, shape[1], shape[2])
+        )
+        view = raw[::slice_step, ::row_step, :]
+
+        with profile_stage('inspect', view.size*obj.bytes_per_pixel):
+            for values, finite in _finite_blocks(view):
+                finite_values = values[finite]
+                non_finite += values.size - finite_values.size
+                if finite_values.size:
+                    minimum = min(minimum, finite_values.min())
+                    maximum = max(maximum, finite_values.max())
+                    total += finite_values.sum()
+                    squares += np.square(finite_values).sum()
+                    count += finite_values.size
+
+                # Per-slice mean and maximum of finite voxels
+                zeroed = np.where(finite, values, 0)
+                counts = finite.sum(axis=(1, 2))
+                sums = zeroed.sum(axis=(1, 2))
+                maxima = np.where(finite, values, -np.inf).max(axis=(1, 2))
+                slice_means.extend(np.where(counts > 0, sums/np.maximum(counts, 1), np.nan).tolist())
+                slice_maxima.extend(np.where(counts > 0, maxima, np.nan).tolist())
+
+            if count:
+                scale = PERCENTILE_BINS/(maximum - minimum) if maximum > minimum else 0
+                for values, finite in _finite_blocks(view):
+                    index = ((values[finite] - minimum)*scale).astype(np.int64)
+                    fine += np.bincount(np.minimum(index, PERCENTILE_BINS - 1), minlength=PERCENTILE_BINS)
+        del raw, view
+
+    if count:
+        mean = float(total/count)
+        std = math.sqrt(max(0.0, squares/count - mean*mean))
+        percentiles = {f'p{q}': _percentile(fine, minimum, maximum, q) for q in PERCENTILES}
+        # Histogram bins are groups of the fine bins
+        starts = np.arange(bins)*PERCENTILE_BINS//bins
+        histogram_counts = np.add.reduceat(fine, starts).tolist()
+        width = (maximum - minimum)/PERCENTILE_BINS
+        histogram_edges = (minimum + np.append(starts, PERCENTILE_BINS)*width).tolist()
+    else:
+        minimum = maximum = mean = std = None
+        percentiles, histogram_counts, histogram_edges = {}, [], []
+
+    return ImageReport(
+        header=obj.dict(),
+        image_path=image_path,
+        file_bytes=file_bytes,
+        expected_bytes=expected_bytes,
+        voxels=count + non_finite,
+        sampled=sample is not None and (slice_step > 1 or row_step > 1),
+        non_finite=non_finite,
+        minimum=None if minimum is None else float(minimum),
+        maximum=None if maximum is None else float(maximum),
+        mean=mean,
+        std=std,
+        percentiles=percentiles,
+        histogram_counts=histogram_counts,
+        histogram_edges=histogram_edges,
+        slices=slices,
+        slice_means=slice_means,
+        slice_maxima=slice_maxima,
+    )
+
+
+def _bar(value: float, maximum: float) -> str:
+    if not maximum or not np.isfinite(value) or not np.isfinite(maximum):
+        return ''
+    return '#'*int(round(BAR_WIDTH*max(0.0, value)/maximum))
+
+def _reduce_finite(function, values: np.ndarray) -> float:
+    finite = values[np.isfinite(values)]
+    return float(function(finite)) if finite.size else np.nan
+
+def format_report(report: ImageReport) -> str:
+    """
+        Returns the report as text: header fields, file size check, statistics,
+        histogram and slice profile (neighbouring slices grouped to PROFILE_ROWS rows)
+    """
+    lines = [f'{key}: {value}' for key, value in report.header.items()]
+    lines.append('')
+    lines.append(
+        f'Image file {report.image_path}: {report.file_bytes} bytes, '
+        f'{report.expected_bytes} expected ({report.size_status})'
+    )
+
+    estimated = ' (estimated from a sample)' if report.sampled else ''
+    lines.append(f'Voxels read: {report.voxels}{estimated}, non-finite: {report.non_finite}')
+    if report.minimum is None:
+        lines.append('No finite voxels')
+        return '\n'.join(lines)
+
+    lines.append(
+        f'min {report.minimum:.6g}, max {report.maximum:.6g}, '
+        f'mean {report.mean:.6g}, std {report.std:.6g}'
+    )
+    lines.append(', '.join(f'{name} {value:.6g}' for name, value in report.percentiles.items()))
+
+    lines.append('')
+    lines.append('Histogram:')
+    highest = max(report.histogram_counts)
+    edges = report.histogram_edges
+    for i, count in enumerate(report.histogram_counts):
+        lines.append(f'{edges[i]:>12.5g} - {edges[i + 1]:<12.5g} {count:>12d} {_bar(count, highest)}')
+
+    lines.append('')
+    lines.append('Slice profile (mean, max):')
+    group = -(-len(report.slices)//PROFILE_ROWS)
+    means = np.asarray(report.slice_means)
+    maxima = np.asarray(report.slice_maxima)
+    highest = _reduce_finite(np.max, means)
+    for start in range(0, len(report.slices), group):
+        first, last = report.slices[start], report.slices[min(start + group, len(report.slices)) - 1]
+        label = f'{first}' if first == last else f'{first}-{last}'
+        mean = _reduce_finite(np.mean, means[start:start + group])
+        maximum = _reduce_finite(np.max, maxima[start:start + group])
+        lines.append(f'{label:>11} {mean:>12.5g} {maximum:>12.5g} {_bar(mean, highest)}')
+
+    return '\n'.join(lines)
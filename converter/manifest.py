@@ -0,0 +1,267 @@
+# Conversion manifest module
+
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import secrets
+from typing import Dict, Iterable, List, Sequence, Tuple, Union
+
+from converter.reader import _metaheader_data_sets, _read_interfile_header
+from converter.writer import (
+    ENCODE_ARGUMENTS, archive_format, archive_stem, frame_attributes, iter_dicom,
+    iter_frames_dicom, seeded_series_attributes, write_archive
+)
+from models.metadata import InterfileHeader, CTMetaFile, PETMetaFile
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# Completed files are recorded in the manifest file after this many files
+SAVE_EVERY = 16
+
+HASH_CHUNK = 2**20
+
+
+def file_digest(path: Path) -> str:
+    """
+        Returns SHA-256 of the file content, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_file_atomic(path: Path, data: bytes) -> None:
+    """
+        Writes the file under a temporary name and renames it, so that a killed
+        conversion never leaves a truncated file
+    """
+    temporary = Path(f'{path}.part')
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+def manifest_path(output_path: Path) -> Path:
+    """
+        Returns path of the manifest of an output (directory, file or archive), next to it
+    """
+    output_path = Path(output_path)
+    return output_path.parent / f'{output_path.name}.manifest.json'
+
+def input_paths(header_path: Path, frames: Iterable[InterfileHeader], meta_path: Path) -> List[Path]:
+    """
+        Returns all files the conversion depends on: header (and frame headers
+        of a metaheader), image files and the metadata
+    """
+    header_path = Path(header_path)
+    paths = [header_path]
+    paths += [header_path.parent / name for name in _metaheader_data_sets(_read_interfile_header(header_path))]
+    for frame in frames:
+        path = Path(frame.header_file_path + frame.img_file_name)
+        if path not in paths:
+            paths.append(path)
+    paths.append(Path(meta_path))
+    return paths
+
+
+class ConversionManifest:
+    """
+        Record of a conversion: input content hashes, settings, UID seed and
+        completed output files with their hashes.
+
+        A conversion with the same inputs and settings reuses the seed, so it
+        generates the same UIDs and files; completed files whose content still
+        matches are skipped.
+    """
+
+    def __init__(self, path: Path, inputs: Dict[str, str], settings: Dict):
+        self.path = Path(path)
+        self.inputs = inputs
+        self.settings = settings
+        self.uid_seed = secrets.token_hex(16)
+        now = datetime.today()
+        self.study_date = now.strftime("%Y%m%d")
+        self.study_time = now.strftime("%H%M%S.%f")
+        self.completed = {}
+        self._unsaved = 0
+
+    @classmethod
+    def open(cls, path: Path, inputs: Dict[str, str], settings: Dict) -> Tuple['ConversionManifest', List[str]]:
+        """
+            Loads the manifest if it was written for the same inputs and settings,
+            otherwise starts a new one
+
+            Returns:
+            - manifest
+            - files completed by a previous conversion of other inputs or settings (stale)
+        """
+        manifest = cls(path, inputs, settings)
+        if not manifest.path.is_file():
+            return manifest, []
+
+        try:
+            with open(manifest.path, 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError) as e:
+            LOGGER.warning('Ignoring unreadable manifest %s: %s', manifest.path, e)
+            return manifest, []
+
+        if (record.get('version') != MANIFEST_VERSION or record.get('inputs') != inputs
+                or record.get('settings') != settings):
+            LOGGER.info('Inputs or settings changed since %s was written, converting again', manifest.path)
+            return manifest, list(record.get('completed', {}))
+
+        manifest.uid_seed = record['uid_seed']
+        manifest.study_date = record['study_date']
+        manifest.study_time = record['study_time']
+        manifest.completed = record['completed']
+        return manifest, []
+
+    def is_done(self, output_root: Path, name: str) -> bool:
+        """
+            Checks whether the file was completed and its content did not change
+        """
+        digest = self.completed.get(name)
+        path = Path(output_root) / name
+        if digest is None or not path.is_file():
+            return False
+        if file_digest(path) != digest:
+            LOGGER.warning('%s changed since it was written, converting it again', path)
+            del self.completed[name]
+            return False
+        return True
+
+    def mark_done(self, name: str, digest: str) -> None:
+        """
+            Records the file as completed with SHA-256 (hex digest) of its content
+        """
+        self.completed[name] = digest
+        self._unsaved += 1
+        if self._unsaved >= SAVE_EVERY:
+            self.save()
+
+    def save(self) -> None:
+        """
+            Writes the manifest atomically
+        """
+        record = {
+            'version': MANIFEST_VERSION,
+            'inputs': self.inputs,
+            'settings': self.settings,
+            'uid_seed': self.uid_seed,
+            'study_date': self.study_date,
+            'study_time': self.study_time,
+            'completed': self.completed,
+        }
+        write_file_atomic(self.path, json.dumps(record, indent=2).encode())
+        self._unsaved = 0
+
+
+def convert_resumable(
+    header_path: Path,
+    frames: Sequence[InterfileHeader],
+    meta_path: Path,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    output_path: Path,
+    extended_format: bool=False,
+    archive_deflate: bool=False,
+    **write_kwargs,
+) -> Tuple[int, int]:
+    """
+        Converts a static or dynamic image like writer.write_frames, recording
+        progress in a manifest next to the output. A repeated conversion skips
+        files which are completed and unchanged, and converts only missing,
+        changed or stale ones. UIDs are derived from the seed in the manifest,
+        so the files of all runs belong to the same series.
+
+        Arguments:
+        header_path - Interfile header (or metaheader) of the image
+        frames - frame headers from reader.iter_interfile_frames
+        meta_path - metadata JSON file
+        metadata - metadata read from meta_path
+        output_path - output directory, file or archive (archives are all or nothing)
+        extended_format, archive_deflate - as in writer.write_frames
+        write_kwargs - writer.ENCODE_ARGUMENTS are passed to writer.iter_dicom,
+            files are written one by one (workers and pipeline are not used)
+
+        Returns:
+        - number of written and skipped files
+    """
+    output_path = Path(output_path)
+    encode_kwargs = {key: write_kwargs[key] for key in ENCODE_ARGUMENTS if key in write_kwargs}
+    inputs = {
+        str(path.resolve()): file_digest(path) for path in input_paths(header_path, frames, meta_path)
+    }
+    settings = {
+        'output': output_path.name,
+        'extended_format': extended_format,
+        'compression': encode_kwargs.get('compression'),
+        'per_slice_rescale': encode_kwargs.get('per_slice_rescale', False),
+        'float_pixel_data': encode_kwargs.get('float_pixel_data', False),
+        'archive_deflate': archive_deflate,
+    }
+    manifest, stale = ConversionManifest.open(manifest_path(output_path), inputs, settings)
+
+    archive = archive_format(output_path) is not None
+    dynamic = len(frames) > 1
+    # Files are recorded relative to this directory
+    output_root = output_path.parent if archive or (extended_format and not dynamic) else output_path
+
+    for name in stale:
+        (output_root / name).unlink(missing_ok=True)
+
+    written, skipped = 0, 0
+
+    if archive:
+        if manifest.is_done(output_root, output_path.name):
+            return 0, 1
+        encoded = iter_frames_dicom(
+            frames, metadata, name=archive_stem(output_path), extended_format=extended_format,
+            **encode_kwargs
+        )
+        # Seeded UIDs are not needed, an archive is always written as a whole
+        write_archive(encoded, output_path, deflate=archive_deflate)
+        manifest.mark_done(output_path.name, file_digest(output_path))
+        manifest.save()
+        return 1, 0
+
+    def skip(name: str) -> bool:
+        nonlocal skipped
+        done = manifest.is_done(output_root, name)
+        skipped += done
+        return done
+
+    try:
+        for frame_number, frame in enumerate(frames, start=1):
+            series_attributes = seeded_series_attributes(
+                manifest.uid_seed, manifest.study_date, manifest.study_time, frame_number
+            )
+            if dynamic:
+                series_attributes.update(frame_attributes(frame, frame_number, len(frames)))
+                name = f'frame_{frame_number}'
+                prefix = '' if extended_format else f'{name}/'
+            else:
+                name = output_path.stem if extended_format else output_path.name
+                prefix = ''
+
+            for file_name, data in iter_dicom(
+                frame, metadata, name=name, extended_format=extended_format,
+                series_attributes=series_attributes,
+                skip=lambda file_name: skip(prefix + file_name),
+                **encode_kwargs
+            ):
+                path = output_root / (prefix + file_name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                write_file_atomic(path, data)
+                manifest.mark_done(prefix + file_name, hashlib.sha256(data).hexdigest())
+                written += 1
+    finally:
+        manifest.save()
+
+    LOGGER.info('Written %d files, skipped %d completed files of %s', written, skipped, output_path)
+    return written, skipped
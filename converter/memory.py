@@ -0,0 +1,145 @@
+# Memory budget module
+
+import logging
+import os
+import re
+import resource
+import sys
+from typing import Dict, Optional
+
+from converter.exceptions import I2DException
+
+LOGGER = logging.getLogger(__name__)
+
+SIZE_PATTERN = re.compile(r'^\s*(?P<number>\d+(\.\d+)?)\s*(?P<unit>[KMGT]?)(i?B)?\s*$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+# Part of the budget given to slabs, the rest is left for allocations which
+# are not accounted for (datasets, encoder buffers, allocator fragmentation)
+SLAB_SHARE = 0.8
+
+
+class MemoryBudgetExceeded(I2DException):
+    '''Conversion needs more memory than the budget allows'''
+    pass
+
+
+def parse_size(text: str) -> int:
+    """
+        Parses a size like '512M', '2G' or '1.5GiB' (binary units) into bytes
+    """
+    match = SIZE_PATTERN.match(str(text))
+    if match is None:
+        raise ValueError(f'Invalid size: {text}, use e.g. 512M or 2G')
+    return int(float(match['number'])*SIZE_UNITS[match['unit'].upper()])
+
+def current_rss() -> int:
+    """
+        Returns resident set size of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # No procfs, the peak is the best available estimate
+        return peak_rss()
+
+def peak_rss() -> int:
+    """
+        Returns peak resident set size of this process in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak*2**10
+
+
+class MemoryBudget:
+    """
+        Limit of the resident set size of a conversion.
+
+        Memory in use when the conversion starts (interpreter, libraries) is the
+        baseline; slabs of the image are sized so that they fit into the rest.
+        The resident set size is checked after every slab is loaded, a conversion
+        going over the limit is stopped with MemoryBudgetExceeded instead of
+        being killed by the system.
+    """
+
+    def __init__(self, limit: int):
+        """
+            Arguments:
+            limit - maximum resident set size in bytes
+        """
+        self.limit = int(limit)
+        self.baseline = None
+        self.peak = 0
+        self._process_peak = 0
+        self.slab_slices = None
+
+    def start(self) -> None:
+        """
+            Measures the baseline, called in the process doing the conversion
+        """
+        if self.baseline is None:
+            self.baseline = current_rss()
+            self.peak = self.baseline
+            self._process_peak = peak_rss()
+
+    def available(self) -> int:
+        """
+            Returns bytes of the budget which slabs and reserved memory may use
+        """
+        self.start()
+        return int((self.limit - self.baseline)*SLAB_SHARE)
+
+    def slab_size(self, slice_bytes: int, reserved_bytes: int=0) -> int:
+        """
+            Returns number of slices of a slab fitting into the budget
+
+            Arguments:
+            slice_bytes - memory needed by every slice of a slab
+            reserved_bytes - memory needed independently of the slab size
+
+            Returns:
+            - number of slices, at least 1
+        """
+        needed = reserved_bytes + slice_bytes
+        available = self.available() - reserved_bytes
+        if available < slice_bytes:
+            raise MemoryBudgetExceeded(
+                f'Memory budget {self.limit / 2**20:.0f} MiB is too small, at least '
+                f'{(self.baseline + needed/SLAB_SHARE) / 2**20:.0f} MiB is needed'
+            )
+        self.slab_slices = available // slice_bytes
+        return self.slab_slices
+
+    def _sample(self) -> int:
+        rss = current_rss()
+        process_peak = peak_rss()
+        if process_peak > self._process_peak:
+            # The process peak grew since the start, so it was reached by the
+            # conversion, possibly between two samples
+            rss = max(rss, process_peak)
+        return rss
+
+    def check(self) -> None:
+        """
+            Records the resident set size, raises MemoryBudgetExceeded if it is over the limit
+        """
+        self.start()
+        rss = self._sample()
+        self.peak = max(self.peak, rss)
+        if rss > self.limit:
+            raise MemoryBudgetExceeded(
+                f'Resident set size {rss / 2**20:.0f} MiB is over the budget of {self.limit / 2**20:.0f} MiB'
+            )
+
+    def report(self) -> Dict[str, Optional[float]]:
+        """
+            Returns budget, baseline, peak resident set size (MiB) and slab size (slices)
+        """
+        return {
+            'budget_mb': self.limit / 2**20,
+            'baseline_mb': self.baseline / 2**20 if self.baseline is not None else None,
+            'peak_rss_mb': max(self.peak, self._sample()) / 2**20,
+            'slab_slices': self.slab_slices,
+        }
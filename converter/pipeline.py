@@ -0,0 +1,119 @@
+# Pipeline module
+
+import queue
+import threading
+from typing import Callable, Iterable, Sequence, Tuple
+
+# Default number of items waiting between two stages
+QUEUE_SIZE = 8
+
+# Marks the end of the stream of items
+_DONE = object()
+
+# Blocked threads check whether the pipeline was stopped this often (seconds)
+_POLL = 0.1
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+        Puts item into the queue, waits while it is full. Returns False if pipeline was stopped.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """
+        Gets item from the queue, waits while it is empty. Returns _DONE if pipeline was stopped.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def run_pipeline(
+    source: Iterable,
+    stages: Sequence[Tuple[Callable, int]],
+    queue_size: int=QUEUE_SIZE,
+) -> None:
+    """
+        Runs stages in threads connected by bounded queues.
+
+        A reader thread iterates over the source, every item is passed to the
+        first stage, its result to the next one and so on; results of the last
+        stage are dropped. A full queue blocks the stage before it, so at most
+        `queue_size` items wait between two stages. If any stage fails,
+        all threads stop and the first exception is raised.
+
+        Arguments:
+        source - iterable of items, iterated in the reader thread
+        stages - (function, number of threads) of every stage
+        queue_size - capacity of every queue
+
+        Returns:
+        - None, stages are run for their side effects (e.g. writing files)
+    """
+    stop = threading.Event()
+    errors = []
+    lock = threading.Lock()
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    remaining = [threads for _, threads in stages]
+
+    def fail(e: BaseException) -> None:
+        with lock:
+            errors.append(e)
+        stop.set()
+
+    def read() -> None:
+        try:
+            for item in source:
+                if not _put(queues[0], item, stop):
+                    return
+        except BaseException as e:
+            fail(e)
+        _put(queues[0], _DONE, stop)
+
+    def work(number: int, function: Callable) -> None:
+        inbox = queues[number]
+        outbox = queues[number + 1] if number + 1 < len(queues) else None
+        try:
+            while True:
+                item = _get(inbox, stop)
+                if item is _DONE:
+                    # Other threads of the stage have to see the end as well
+                    _put(inbox, _DONE, stop)
+                    break
+                result = function(item)
+                if outbox is not None and not _put(outbox, result, stop):
+                    break
+        except BaseException as e:
+            fail(e)
+        finally:
+            with lock:
+                remaining[number] -= 1
+                last = remaining[number] == 0
+            if last and outbox is not None:
+                _put(outbox, _DONE, stop)
+
+    threads = [threading.Thread(target=read, name='pipeline-read', daemon=True)]
+    for number, (function, count) in enumerate(stages):
+        threads += [
+            threading.Thread(
+                target=work, args=(number, function), name=f'pipeline-{number}-{i}', daemon=True
+            )
+            for i in range(count)
+        ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
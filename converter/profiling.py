@@ -0,0 +1,242 @@
+# Profiling module
+
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import threading
+import time
+import tracemalloc
+from typing import Dict, Iterator, List
+
+# Profiler collecting stages of the current conversion (None - profiling disabled)
+_ACTIVE = None
+
+# tracemalloc.reset_peak is new in Python 3.9, on older versions the memory
+# traced when a stage ends is reported instead of its peak
+RESET_PEAK = hasattr(tracemalloc, 'reset_peak')
+MEMORY_MEASURE = 'peak' if RESET_PEAK else 'current at stage end'
+
+
+class _Span:
+    __slots__ = ('start', 'start_memory', 'peak', 'shared')
+
+    def __init__(self, start_memory: int):
+        self.start = time.perf_counter()
+        self.start_memory = start_memory
+        self.peak = 0
+        # Set if a stage of another thread ran at the same time
+        self.shared = False
+
+
+class Profiler:
+    """
+        Collects wall time, bytes processed and allocation peaks of conversion stages.
+
+        Stages may be nested and may run in several threads. Allocation peaks are
+        measured with tracemalloc (if `memory` is set), relative to the memory
+        allocated when the stage started; a stage peak includes its nested stages.
+        tracemalloc has one peak for the whole process, so it is measured only for
+        stages which did not overlap with stages of other threads (e.g. pipeline
+        stages), the peak of the others is None. Before Python 3.9 the memory
+        traced when the stage ends is measured instead (see MEMORY_MEASURE).
+    """
+
+    def __init__(self, memory: bool=True):
+        self.memory = memory
+        self.origin = time.perf_counter()
+        self.end = None
+        self.events = []
+        self._lock = threading.Lock()
+        # Open stages of every thread
+        self._stacks: Dict[int, List[_Span]] = {}
+
+    def _stack(self) -> List[_Span]:
+        with self._lock:
+            return self._stacks.setdefault(threading.get_ident(), [])
+
+    def _open(self, stack: List[_Span], span: _Span) -> bool:
+        """
+            Opens the span, returns True if no stage of another thread is open
+        """
+        with self._lock:
+            others = [s for s in self._stacks.values() if s is not stack and s]
+            if others:
+                span.shared = True
+                for open_stack in others + [stack]:
+                    for open_span in open_stack:
+                        open_span.shared = True
+            stack.append(span)
+            return not others
+
+    @staticmethod
+    def _traced_peak() -> int:
+        current, peak = tracemalloc.get_traced_memory()
+        return peak if RESET_PEAK else current
+
+    @staticmethod
+    def _reset_peak() -> None:
+        if RESET_PEAK:
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int=0) -> Iterator[None]:
+        stack = self._stack()
+        tracing = self.memory and tracemalloc.is_tracing()
+        span = _Span(0)
+        alone = self._open(stack, span)
+        if tracing and alone:
+            # Peak since the last reset is passed to the enclosing stage, then reset
+            if len(stack) > 1:
+                stack[-2].peak = max(stack[-2].peak, self._traced_peak())
+            self._reset_peak()
+            span.start_memory = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                stack.pop()
+                shared = span.shared
+            peak = 0
+            if tracing and shared:
+                peak = None
+            elif tracing:
+                span.peak = max(span.peak, self._traced_peak())
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, span.peak)
+                self._reset_peak()
+                peak = max(0, span.peak - span.start_memory)
+
+            with self._lock:
+                self.events.append({
+                    'name': name,
+                    'start': span.start - self.origin,
+                    'seconds': end - span.start,
+                    'bytes': nbytes,
+                    'peak_bytes': peak,
+                    'thread': threading.get_ident(),
+                    'depth': len(stack),
+                })
+
+    def report(self) -> Dict:
+        """
+            Returns stages aggregated by name, in order of their first call
+
+            Returns:
+            - dictionary with total wall time and calls, seconds, bytes,
+              throughput (MiB/s) and allocation peak (MiB, None if no call was
+              measured) of every stage; memory_measure tells what the peak is
+        """
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event['name'], {
+                'name': event['name'], 'calls': 0, 'seconds': 0.0, 'bytes': 0, 'peak_mb': None,
+            })
+            stage['calls'] += 1
+            stage['seconds'] += event['seconds']
+            stage['bytes'] += event['bytes']
+            if event['peak_bytes'] is not None:
+                stage['peak_mb'] = max(stage['peak_mb'] or 0.0, event['peak_bytes'] / 2**20)
+
+        for stage in stages.values():
+            stage['mb_per_s'] = (
+                stage['bytes'] / 2**20 / stage['seconds'] if stage['bytes'] and stage['seconds'] else None
+            )
+
+        return {
+            'total_seconds': (self.end or time.perf_counter()) - self.origin,
+            'memory': self.memory,
+            'memory_measure': MEMORY_MEASURE,
+            'stages': list(stages.values()),
+        }
+
+    def format_report(self) -> str:
+        """
+            Returns the report as a table
+        """
+        report = self.report()
+        memory_header = 'peak MiB' if RESET_PEAK else 'end MiB'
+        lines = [f"{'stage':<16} {'calls':>7} {'seconds':>10} {'MiB':>10} {'MiB/s':>10} {memory_header:>10}"]
+        for stage in report['stages']:
+            throughput = f"{stage['mb_per_s']:10.1f}" if stage['mb_per_s'] else ' '*10
+            measured = report['memory'] and stage['peak_mb'] is not None
+            peak = f"{stage['peak_mb']:10.1f}" if measured else ' '*10
+            lines.append(
+                f"{stage['name']:<16} {stage['calls']:>7} {stage['seconds']:>10.4f} "
+                f"{stage['bytes'] / 2**20:>10.1f} {throughput} {peak}"
+            )
+        lines.append(f"total {report['total_seconds']:.4f} s")
+        return '\n'.join(lines)
+
+    def chrome_trace(self) -> Dict:
+        """
+            Returns stages as Chrome trace events (chrome://tracing, Perfetto)
+        """
+        pid = os.getpid()
+        return {
+            'traceEvents': [
+                {
+                    'name': event['name'],
+                    'ph': 'X',
+                    'ts': event['start']*1e6,
+                    'dur': event['seconds']*1e6,
+                    'pid': pid,
+                    'tid': event['thread'],
+                    'args': {'bytes': event['bytes'], 'peak_bytes': event['peak_bytes']},
+                }
+                for event in self.events
+            ],
+            'displayTimeUnit': 'ms',
+        }
+
+    def write_report(self, path: Path) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_chrome_trace(self, path: Path) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+@contextmanager
+def profile_stage(name: str, nbytes: int=0) -> Iterator[None]:
+    """
+        Measures a stage with the active profiler, does nothing if profiling is disabled
+
+        Arguments:
+        name - stage name, calls with the same name are aggregated in the report
+        nbytes - number of bytes processed by the stage
+    """
+    profiler = _ACTIVE
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name, nbytes):
+        yield
+
+@contextmanager
+def profiling(memory: bool=True) -> Iterator[Profiler]:
+    """
+        Enables profiling of all stages run inside the block (in this process)
+
+        Arguments:
+        memory - trace allocations with tracemalloc, slows allocations down
+
+        Returns:
+        - profiler with collected stages
+    """
+    global _ACTIVE
+    previous = _ACTIVE
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    profiler = _ACTIVE = Profiler(memory=memory)
+    try:
+        yield profiler
+    finally:
+        profiler.end = time.perf_counter()
+        _ACTIVE = previous
+        if started_tracing:
+            tracemalloc.stop()
@@ -0,0 +1,134 @@
+# Quantization module
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+# Target size of a block of slices processed at once by a thread
+BLOCK_BYTES = 8*2**20
+
+
+def _blocks(volume: np.ndarray) -> Iterator[slice]:
+    """
+        Splits the first (slice) axis of the volume into blocks of about BLOCK_BYTES
+    """
+    slice_bytes = max(1, volume[:1].nbytes)
+    step = max(1, BLOCK_BYTES // slice_bytes)
+    for start in range(0, volume.shape[0], step):
+        yield slice(start, min(start + step, volume.shape[0]))
+
+def _threads(threads: Optional[int]) -> int:
+    return threads if threads is not None else (os.cpu_count() or 1)
+
+def min_max(volume: np.ndarray, threads: Optional[int]=None) -> Tuple:
+    """
+        Finds minimum and maximum of the volume in one pass over memory.
+        Every block is small enough to stay in cache between min() and max().
+
+        Arguments:
+        volume - array (or np.memmap) with slices in the first axis
+        threads - number of threads, NumPy releases the GIL in reductions
+
+        Returns:
+        - minimum and maximum values (numpy scalars of volume dtype)
+    """
+    def reduce(block: slice) -> Tuple:
+        values = volume[block]
+        return values.min(), values.max()
+
+    with ThreadPoolExecutor(max_workers=_threads(threads)) as executor:
+        results = list(executor.map(reduce, _blocks(volume)))
+
+    return min(r[0] for r in results), max(r[1] for r in results)
+
+def slice_min_max(volume: np.ndarray, threads: Optional[int]=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Finds minimum and maximum of every slice in one pass over memory,
+        with one vectorized reduction per block of slices
+
+        Arguments:
+        volume - array (or np.memmap) with slices in the first axis
+        threads - number of threads, NumPy releases the GIL in reductions
+
+        Returns:
+        - arrays of minima and maxima (volume dtype), one value per slice
+    """
+    minima = np.empty(volume.shape[0], dtype=volume.dtype)
+    maxima = np.empty(volume.shape[0], dtype=volume.dtype)
+    axes = tuple(range(1, volume.ndim))
+
+    def reduce(block: slice) -> None:
+        values = volume[block]
+        minima[block] = values.min(axis=axes)
+        maxima[block] = values.max(axis=axes)
+
+    with ThreadPoolExecutor(max_workers=_threads(threads)) as executor:
+        list(executor.map(reduce, _blocks(volume)))
+
+    return minima, maxima
+
+def rescale_parameters(minimum, maximum) -> Tuple:
+    """
+        Returns rescale slope and intercept mapping [minimum, maximum] to [0, 32767].
+        Minima and maxima may be arrays (e.g. from slice_min_max), then constant
+        slices get slope 1, so that they are quantized to 0.
+    """
+    rescale_slope = (maximum - minimum)/np.iinfo(np.int16).max
+    if np.ndim(rescale_slope):
+        rescale_slope[rescale_slope == 0] = 1
+    return rescale_slope, minimum
+
+def _per_slice(value, block: slice, ndim: int):
+    """
+        Returns scalar value, or values of the block slices shaped to broadcast over slices
+    """
+    value = np.asarray(value)
+    if value.ndim == 0:
+        return value[()]
+    return value[block].reshape((-1,) + (1,)*(ndim - 1))
+
+def quantize(
+    volume: np.ndarray,
+    rescale_slope,
+    rescale_intercept,
+    out: Optional[np.ndarray]=None,
+    threads: Optional[int]=None,
+) -> np.ndarray:
+    """
+        Rescales float volume to uint16 block by block.
+        Gives the same values as ((volume - intercept)/slope).astype(np.uint16),
+        but every thread holds at most one temporary block at a time.
+
+        Arguments:
+        volume - float array (or np.memmap) with slices in the first axis
+        rescale_slope, rescale_intercept - values from rescale_parameters,
+            scalars or arrays with a value per slice
+        out - preallocated uint16 array of volume shape
+        threads - number of threads, NumPy releases the GIL in ufuncs
+
+        Returns:
+        - out array
+    """
+    if out is None:
+        out = np.empty(volume.shape, dtype=np.uint16)
+
+    # Same type as the not chunked arithmetic would give
+    first = slice(0, 1)
+    work_dtype = (
+        (volume[:1, :1] - _per_slice(rescale_intercept, first, volume.ndim))
+        / _per_slice(rescale_slope, first, volume.ndim)
+    ).dtype
+
+    def rescale(block: slice) -> None:
+        values = volume[block]
+        work = np.subtract(values, _per_slice(rescale_intercept, block, values.ndim), dtype=work_dtype)
+        np.divide(work, _per_slice(rescale_slope, block, values.ndim), out=work)
+        np.copyto(out[block], work, casting='unsafe')
+
+    with ThreadPoolExecutor(max_workers=_threads(threads)) as executor:
+        # Consume results, so exceptions are raised here
+        list(executor.map(rescale, _blocks(volume)))
+
+    return out
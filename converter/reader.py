@@ -1,92 +1,168 @@
 # Reader module
 #Author: Mateusz Kruk, Rafal Mozdzonek
 
+import copy
+from functools import lru_cache
 import json
 import logging
+import os
+import re
 import sys
 from pathlib import Path
-from typing import Dict, Union, Tuple
+from typing import Dict, Iterator, List, Optional, Union, Tuple
 
 import numpy as np
 from numpy.core.records import array
 
 from converter.exceptions import InterfileInvalidHeaderException, InterfileInvalidValueException
+from converter.memory import MemoryBudget
+from converter.profiling import profile_stage
+from converter.quantization import (
+    BLOCK_BYTES, _threads, min_max, quantize, rescale_parameters, slice_min_max
+)
 from models.metadata import InterfileHeader, CTMetaFile, PETMetaFile
 
 LOGGER = logging.getLogger(__name__)
 
+GATE_KEYS = ('number of gates', 'number of cardiac gates', 'number of respiratory gates')
 
-def _read_interfile_header(path: Path) -> Dict:
-    """
-        Reads values from Interfile header file
+# Number of parsed headers kept in memory
+HEADER_CACHE_SIZE = 4096
 
-        Arguments:
-        path - Path class containing path to the file
+# "!key := value", the key may be followed by an index, e.g. "matrix size [1]"
+LINE_PATTERN = re.compile(r'\s*!?\s*(?P<key>.*?)\s*:=\s*(?P<value>.*?)\s*$')
+INDEX_PATTERN = re.compile(r'(?P<name>.*?)\s*\[\s*(?P<index>\d+)\s*\]')
+INT_PATTERN = re.compile(r'[+-]?\d+')
+FLOAT_PATTERN = re.compile(r'[+-]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?')
+# Keys of str fields of InterfileHeader (lower case), kept as written even if they
+# look like numbers, e.g. "CASToR version := 3.10" is not the float 3.1
+STRING_KEYS = (
+    'imaging modality', 'version of keys', 'castor version', 'name of data file',
+    'imagedata byte order', 'number format',
+)
 
-        Returns:
-        meta_dict - dictionary containing all header values
-    """
 
-    meta_dict = {}
+def _typed_value(value: str) -> Union[int, float, str]:
+    """
+        Converts header value to int or float if it is a number, otherwise returns it stripped
+    """
+    if INT_PATTERN.fullmatch(value):
+        return int(value)
+    if FLOAT_PATTERN.fullmatch(value):
+        return float(value)
+    return value
 
+def _header_cache_key(path: Path) -> Tuple[str, int, int]:
+    """
+        Returns path, modification time and size of the header file
+    """
     try:
-        # Opens header file
-        with open(path, "r") as header:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        LOGGER.error("File not found !")
+        raise InterfileInvalidHeaderException(f'header not found: {path}')
+    return str(path), stat.st_mtime_ns, stat.st_size
 
-            # Saves header path for later convenience
-            meta_dict["header path"] = str(path).replace(path.name, '')
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _parse_interfile_header(path: str, mtime_ns: int, size: int) -> Dict:
+    """
+        Parses header file in a single pass, results are cached
+        until modification time or size of the file changes
+    """
+    path = Path(path)
 
-            # Validation of interfile header (no start flag)
-            if header.readline() != "!INTERFILE := \n":
-                raise InterfileInvalidHeaderException('invalid start header format')
+    # Saves header path for later convenience
+    meta_dict = {"header path": str(path).replace(path.name, '')}
+    arrays = {}
 
-            # Get rest of the file
-            header = header.readlines()
+    with open(path, "r") as header:
+        lines = iter(header)
 
-            for line in header: #line e.g. "!key := value\n"
+        # Validation of interfile header (no start flag)
+        token = LINE_PATTERN.match(next(lines, ''))
+        if token is None or token['key'].upper() != 'INTERFILE':
+            raise InterfileInvalidHeaderException('invalid start header format')
 
-                if line.isspace(): continue
+        for number, line in enumerate(lines, start=2): #line e.g. "!key := value\n"
 
-                # Stripping and splitting line from redundant symbols
-                key, value = line.strip('!\n').split(':=')
+            if line.isspace() or line.lstrip().startswith(';'): continue
 
-                if key != '':
+            token = LINE_PATTERN.match(line)
+            if token is None:
+                raise InterfileInvalidValueException(f'{path}: line {number} is not a key := value pair')
 
-                     # Check if importer encountered "!END OF INTERFILE :="
-                    if 'end' in key.lower():
-                        return meta_dict
+            key, value = token['key'], token['value']
+            lower_key = key.lower()
 
-                    # Ignore all lines with `general` keyword, usually with empty value
-                    elif 'general' not in key.lower():
+            # Check if importer encountered "!END OF INTERFILE :="
+            if lower_key.startswith('end of interfile'):
+                break
 
-                        try:
-                            # Attempt to cast value to int
-                            meta_dict[key.strip()] = int(value)
+            # Ignore all lines with `general` keyword and empty keys
+            if not key or 'general' in lower_key:
+                continue
 
-                        except IndexError:
-                            meta_dict[key.strip()] = ''
+            if lower_key not in STRING_KEYS:
+                value = _typed_value(value)
 
-                        # if it's not a number or it's string repesentation of float
-                        # then leave it as string
-                        except ValueError:
+            indexed = INDEX_PATTERN.fullmatch(key)
+            if indexed:
+                # Flat "key [n]" entry and n-th item of the "key" array
+                key = f"{indexed['name']} [{indexed['index']}]"
+                arrays.setdefault(indexed['name'], {})[int(indexed['index'])] = value
 
-                            meta_dict[key.strip()] = value.strip()
+            meta_dict[key] = value
 
-                        # if something bad happens, throws an exception
-                        except Exception as e:
-                            raise InterfileInvalidValueException(
-                                'invalid header format throws '+ e.__class__.__name__
-                            )
+        else:
+            raise InterfileInvalidHeaderException('invalid end header format')
 
-        raise InterfileInvalidHeaderException('invalid end header format')
+    for name, items in arrays.items():
+        # Plain key wins, missing indices are None
+        meta_dict.setdefault(name, [items.get(i) for i in range(1, max(items) + 1)])
 
-    except FileNotFoundError:
-        LOGGER.error("File not found !")
-        raise InterfileInvalidHeaderException(f'header not found: {path}')
+    return meta_dict
 
+def _read_interfile_header(path: Path) -> Dict:
+    """
+        Reads values from Interfile header file.
+        Values are int, float or str, keys indexed with [n] are
+        also gathered into lists (e.g. "matrix size": [x, y, z]).
+
+        Arguments:
+        path - Path class containing path to the file
+
+        Returns:
+        meta_dict - dictionary containing all header values (a copy, the
+            parsed header is cached)
+    """
+    return copy.deepcopy(_parse_interfile_header(*_header_cache_key(Path(path))))
 
 def interfile_header_import(path: Path) -> InterfileHeader:
-    int_dict = _read_interfile_header(path)
+    """
+        Reads and validates Interfile header, results are cached
+        until modification time or size of the file changes
+
+        Arguments:
+        path - Path class containing path to the file
+
+        Returns:
+        - InterfileHeader obj
+    """
+    with profile_stage('header_parse'):
+        return _import_interfile_header(*_header_cache_key(Path(path))).copy(deep=True)
+
+def clear_header_cache() -> None:
+    """
+        Forgets all parsed headers
+    """
+    _parse_interfile_header.cache_clear()
+    _import_interfile_header.cache_clear()
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _import_interfile_header(path: str, mtime_ns: int, size: int) -> InterfileHeader:
+    int_dict = _parse_interfile_header(path, mtime_ns, size)
+    # Dynamic and gated images store all frames in one file, one after another
+    frames_number = max(1, int_dict['total number of images'] // int_dict['matrix size [3]'])
     return InterfileHeader(
         modality=int_dict['imaging modality'],
         keys_version=int_dict['version of keys'],
@@ -108,17 +184,79 @@ def interfile_header_import(path: Path) -> InterfileHeader:
         data_rescale_offset=int_dict['data rescale offset'],
         data_rescale_slope=int_dict['data rescale slope'],
         quantification_units=int_dict['quantification units'],
+        frames_number=frames_number,
+        frame_start_times=_frame_timing(int_dict, 'image start time (sec)', frames_number),
+        frame_durations=_frame_timing(int_dict, 'image duration (sec)', frames_number),
+        gated=any(isinstance(int_dict.get(key), int) and int_dict[key] > 1 for key in GATE_KEYS),
     )
 
-def read_binary(obj: InterfileHeader) -> Tuple[array, float, float, str]:
+def _frame_timing(int_dict: Dict, key: str, frames_number: int) -> List[float]:
     """
-        Reads image data from a binary file.
+        Reads per-frame timing values (in seconds) from indexed keys. A single frame
+        may use the plain key. Returns empty list if timing of any frame is missing.
+    """
+    values = int_dict.get(key)
+    if not isinstance(values, list):
+        values = [values]
+
+    if len(values) != frames_number or any(value is None or value == '' for value in values):
+        return []
+    return [float(value) for value in values]
+
+def _metaheader_data_sets(int_dict: Dict) -> List[str]:
+    """
+        Returns header files listed in a metaheader ("%data set [1] := {frame_1.hdr}")
+    """
+    data_sets = int_dict.get('%data set', [])
+    if not isinstance(data_sets, list):
+        data_sets = [data_sets]
+    return [str(value).strip('{}') for value in data_sets if value is not None]
+
+def iter_interfile_frames(path: Path) -> Iterator[InterfileHeader]:
+    """
+        Iterates over time frames (or gates) of a dynamic Interfile image.
+
+        Both a single header whose image file holds all frames one after another
+        (`total number of images` is a multiple of `matrix size [3]`) and
+        a metaheader listing a header per frame are supported. Only headers
+        are yielded, so the caller reads one frame at a time with read_binary.
 
         Arguments:
-        args - Dictionary containing input parameters.
+        path - Path class containing path to the header or metaheader
 
         Returns:
-        - Numpy array containing pixel values.
+        - generator of InterfileHeader objects, each describing a single 3D frame
+    """
+    path = Path(path)
+    data_sets = _metaheader_data_sets(_read_interfile_header(path))
+
+    if data_sets:
+        for data_set in data_sets:
+            yield interfile_header_import(path.parent / data_set)
+        return
+
+    obj = interfile_header_import(path)
+    frame_bytes = obj.matrix_size_1*obj.matrix_size_2*obj.matrix_size_3*obj.bytes_per_pixel
+
+    for k in range(obj.frames_number):
+        yield obj.copy(update=dict(
+            data_offset_in_bytes=obj.data_offset_in_bytes + k*frame_bytes,
+            images_number=obj.matrix_size_3,
+            frames_number=1,
+            frame_start_times=obj.frame_start_times[k:k + 1],
+            frame_durations=obj.frame_durations[k:k + 1],
+        ))
+
+def _binary_dtype(obj: InterfileHeader) -> Tuple[str, str]:
+    """
+        Works out numpy data type of the image file from header data
+
+        Arguments:
+        obj - InterfileHeader obj
+
+        Returns:
+        - numpy data type string (e.g. "<f4")
+        - byte order character ("<" or ">")
     """
 
     byte_order_local = ""
@@ -148,9 +286,308 @@ def read_binary(obj: InterfileHeader) -> Tuple[array, float, float, str]:
     else:
         raise(Exception(f"Unsupported data format: {obj.number_format}"))
 
-    data_type = byte_order_local + ttype + str(obj.bytes_per_pixel)
+    return byte_order_local + ttype + str(obj.bytes_per_pixel), byte_order_local
+
+
+class InterfileVolume:
+    """
+        Lazily sliced view on an Interfile image.
+
+        The image file is mapped with np.memmap at `data offset in bytes`, so
+        voxels are only paged in when a slice is requested. Indexing returns
+        the same values as the array produced by `read_binary`, i.e. flipped
+        and (for float data, unless float_pixel_data is set) quantized to uint16.
+    """
+
+    def __init__(
+        self,
+        obj: InterfileHeader,
+        threads: Optional[int]=None,
+        per_slice_rescale: bool=False,
+        float_pixel_data: bool=False,
+    ):
+        self.header = obj
+        self.data_type, self.byte_order = _binary_dtype(obj)
+        self.path = obj.header_file_path + obj.img_file_name
+        self._map()
+
+        self.is_float = 'float' in obj.number_format
+        # Float voxels are passed through as they are with float_pixel_data
+        self.quantized = self.is_float and not float_pixel_data
+        self.rescale_intercept = 0
+        self.rescale_slope = 1
+
+        if self.quantized and per_slice_rescale:
+            # Slices of the view are in reversed order
+            minima, maxima = self._slice_min_max(threads)
+            self.rescale_slope, self.rescale_intercept = rescale_parameters(minima[::-1], maxima[::-1])
+        elif self.quantized:
+            # min_max goes through the file block by block
+            minimum, maximum = self._min_max(threads)
+            self.rescale_slope, self.rescale_intercept = rescale_parameters(minimum, maximum)
+
+    def _map(self) -> None:
+        obj = self.header
+        self._raw = np.memmap(
+            self.path,
+            dtype=self.data_type,
+            mode='r',
+            offset=obj.data_offset_in_bytes,
+            shape=(obj.matrix_size_3, obj.matrix_size_2, obj.matrix_size_1),
+        )
+        # Same flip as in read_binary, this is only a view
+        self._view = self._raw[::-1, ::-1, :]
+
+    def _min_max(self, threads: Optional[int]) -> Tuple:
+        return min_max(self._raw, threads=threads)
+
+    def _slice_min_max(self, threads: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        return slice_min_max(self._raw, threads=threads)
+
+    def __getstate__(self) -> Dict:
+        # Mapped voxels are not pickled, the file is mapped again on unpickling
+        state = self.__dict__.copy()
+        del state['_raw'], state['_view']
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._map()
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self._view.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(np.uint16) if self.quantized else self._view.dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        values = np.asarray(self._view[key])
+        if self.quantized:
+            slope, intercept = self.rescale_slope, self.rescale_intercept
+            if np.ndim(slope):
+                # Rescale values of the selected slices
+                slices = np.arange(len(self))[key[0] if isinstance(key, tuple) else key]
+                shape = np.shape(slices) + (1,)*(values.ndim - np.ndim(slices))
+                slope, intercept = slope[slices].reshape(shape), intercept[slices].reshape(shape)
+            values = ((values - intercept)/slope).astype(np.uint16)
+        return values
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        values = self[...]
+        return values if dtype is None else values.astype(dtype)
+
+
+class SlabVolume(InterfileVolume):
+    """
+        Out-of-core view on an Interfile image, kept within a MemoryBudget.
+
+        The image file is never mapped as a whole. Slabs of consecutive slices,
+        sized to the budget, are mapped one at a time, quantized (float data)
+        or copied, and unmapped again, so mapped pages leave the resident set
+        with their slab. Slices are best requested in order, as write_dicom
+        does; the current slab is kept until a slice of another one is needed.
+    """
+
+    def __init__(
+        self,
+        obj: InterfileHeader,
+        memory_budget: MemoryBudget,
+        threads: Optional[int]=None,
+        per_slice_rescale: bool=False,
+        reserved_bytes: int=0,
+        float_pixel_data: bool=False,
+    ):
+        """
+            Arguments:
+            obj - InterfileHeader obj
+            memory_budget - budget the slabs are sized to and checked against
+            threads, per_slice_rescale, float_pixel_data - as in InterfileVolume
+            reserved_bytes - memory needed besides the slab (e.g. slice encoding)
+        """
+        self.budget = memory_budget
+        self.threads = _threads(threads)
+        self.reserved_bytes = reserved_bytes
+        self._slab = None
+        super().__init__(
+            obj, threads=threads, per_slice_rescale=per_slice_rescale, float_pixel_data=float_pixel_data
+        )
+
+    def _map(self) -> None:
+        obj = self.header
+        self._shape = (obj.matrix_size_3, obj.matrix_size_2, obj.matrix_size_1)
+        itemsize = np.dtype(self.data_type).itemsize
+        self._slice_bytes = obj.matrix_size_2*obj.matrix_size_1*itemsize
+        # A slice costs its mapped pages and its quantized (or copied) values,
+        # every quantize thread holds a temporary block (of up to 8-byte values)
+        # besides the slab
+        values_bytes = obj.matrix_size_2*obj.matrix_size_1*max(itemsize, 2)
+        block_slices = min(max(1, BLOCK_BYTES // self._slice_bytes), self._shape[0])
+        block_bytes = 2*block_slices*self._slice_bytes
+        # Threads beyond the number of blocks stay idle, and only as many
+        # threads as have room for their blocks next to one slice are used
+        room = self.budget.available() - self.reserved_bytes - self._slice_bytes - values_bytes
+        self.threads = max(1, min(
+            self.threads, -(-self._shape[0] // block_slices), room // block_bytes
+        ))
+        slab_slices = self.budget.slab_size(
+            self._slice_bytes + values_bytes, self.reserved_bytes + self.threads*block_bytes
+        )
+        self.slab_slices = int(min(slab_slices, self._shape[0]))
+        LOGGER.debug('Reading %s in slabs of %d slices', self.path, self.slab_slices)
+
+    def _raw_slab(self, start: int, stop: int) -> np.memmap:
+        """
+            Maps slices [start, stop) of the image file (file order, not flipped)
+        """
+        return np.memmap(
+            self.path,
+            dtype=self.data_type,
+            mode='r',
+            offset=self.header.data_offset_in_bytes + start*self._slice_bytes,
+            shape=(stop - start,) + self._shape[1:],
+        )
 
-    image_matrix = np.fromfile(obj.header_file_path + obj.img_file_name, dtype=data_type, count=-1)
+    def _raw_slabs(self) -> Iterator[Tuple[int, np.memmap]]:
+        for start in range(0, self._shape[0], self.slab_slices):
+            raw = self._raw_slab(start, min(start + self.slab_slices, self._shape[0]))
+            yield start, raw
+            self.budget.check()
+            del raw
+
+    def _min_max(self, threads: Optional[int]) -> Tuple:
+        results = [min_max(raw, threads=self.threads) for _, raw in self._raw_slabs()]
+        return min(r[0] for r in results), max(r[1] for r in results)
+
+    def _slice_min_max(self, threads: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        minima = np.empty(self._shape[0], dtype=self.data_type)
+        maxima = np.empty(self._shape[0], dtype=self.data_type)
+        for start, raw in self._raw_slabs():
+            stop = start + raw.shape[0]
+            minima[start:stop], maxima[start:stop] = slice_min_max(raw, threads=self.threads)
+        return minima, maxima
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state['_slab'] = None
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self._shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(np.uint16) if self.quantized else np.dtype(self.data_type)
+
+    def _load_slab(self, index: int) -> Tuple[int, int, np.ndarray]:
+        """
+            Reads the slab holding slice `index` of the (flipped) view
+        """
+        n = self._shape[0]
+        start = index - index % self.slab_slices
+        stop = min(start + self.slab_slices, n)
+        self._slab = None
+
+        # Slices of the view are in reversed order
+        raw = self._raw_slab(n - stop, n - start)
+        view = raw[::-1, ::-1, :]
+        if self.quantized:
+            slope, intercept = self.rescale_slope, self.rescale_intercept
+            if np.ndim(slope):
+                slope, intercept = slope[start:stop], intercept[start:stop]
+            values = quantize(view, slope, intercept, threads=self.threads)
+        else:
+            values = np.array(view)
+        del view, raw
+
+        self._slab = (start, stop, values)
+        self.budget.check()
+        return self._slab
+
+    def _slice(self, index: int) -> np.ndarray:
+        index = range(self._shape[0])[index]
+        start, stop, values = self._slab or (0, 0, None)
+        if not start <= index < stop:
+            start, stop, values = self._load_slab(index)
+        # A copy, so that slices queued by a pipeline do not keep their slab alive
+        return values[index - start].copy()
+
+    def __getitem__(self, key) -> np.ndarray:
+        first, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(first, (int, np.integer)):
+            return self._slice(first)[rest]
+        # Several slices are assembled slice by slice, the result has to fit into the budget
+        slices = range(self._shape[0])[first if first is not Ellipsis else slice(None)]
+        values = np.stack([self._slice(i) for i in slices])
+        return values[(slice(None),) + rest] if first is not Ellipsis else values[(Ellipsis,) + rest]
+
+
+def read_binary(
+    obj: InterfileHeader,
+    lazy: bool=False,
+    threads: Optional[int]=None,
+    per_slice_rescale: bool=False,
+    memory_budget: Optional[MemoryBudget]=None,
+    reserved_bytes: int=0,
+    float_pixel_data: bool=False,
+) -> Tuple[Union[array, InterfileVolume], float, float, str]:
+    """
+        Reads image data from a binary file.
+
+        Arguments:
+        obj - InterfileHeader obj
+        lazy - return memory-mapped InterfileVolume instead of loading the whole image
+        threads - number of threads used to quantize float data (default: CPU count)
+        per_slice_rescale - quantize every slice of float data with its own
+            slope and intercept, using the full 16-bit range of every slice
+        memory_budget - return SlabVolume reading the image in slabs sized to the
+            budget (implies lazy)
+        reserved_bytes - memory the caller needs besides the slabs (with memory_budget)
+        float_pixel_data - return float data as it is (slope 1, intercept 0),
+            without quantization, to be written as Float Pixel Data
+
+        Returns:
+        - Numpy array (or InterfileVolume) containing pixel values.
+        - rescale slope (array with a value per slice with per_slice_rescale)
+        - rescale intercept (as rescale slope)
+        - byte order of the image file
+    """
+
+    nbytes = obj.matrix_size_3*obj.matrix_size_2*obj.matrix_size_1*obj.bytes_per_pixel
+
+    if memory_budget is not None:
+        with profile_stage('read_binary', nbytes):
+            volume = SlabVolume(
+                obj, memory_budget, threads=threads, per_slice_rescale=per_slice_rescale,
+                reserved_bytes=reserved_bytes, float_pixel_data=float_pixel_data,
+            )
+        return volume, volume.rescale_slope, volume.rescale_intercept, volume.byte_order
+
+    if lazy:
+        # Only the min-max pass over a float image reads the file here
+        with profile_stage('read_binary', nbytes):
+            volume = InterfileVolume(
+                obj, threads=threads, per_slice_rescale=per_slice_rescale, float_pixel_data=float_pixel_data
+            )
+        return volume, volume.rescale_slope, volume.rescale_intercept, volume.byte_order
+
+    data_type, byte_order_local = _binary_dtype(obj)
+
+    with profile_stage('read_binary', nbytes):
+        image_matrix = np.fromfile(
+            obj.header_file_path + obj.img_file_name,
+            dtype=data_type,
+            count=obj.matrix_size_3*obj.matrix_size_2*obj.matrix_size_1,
+            offset=obj.data_offset_in_bytes,
+        )
     resh_arr = image_matrix.reshape((obj.matrix_size_3, obj.matrix_size_2, obj.matrix_size_1))
     # TODO: Understand why it is needed here
     # Flip every slice of 3D image (Y and Z axes) to match reference test case.
@@ -159,12 +596,15 @@ def read_binary(obj: InterfileHeader) -> Tuple[array, float, float, str]:
     rescale_intercept = 0
     rescale_slope = 1
 
-    if 'float' in obj.number_format:
-        rescale_intercept = resh_arr.min()
-        rescale_slope = (resh_arr.max() - resh_arr.min())/np.iinfo(np.int16).max
-        resh_arr = (resh_arr - rescale_intercept)/rescale_slope
-
-        resh_arr = resh_arr.astype(np.uint16)
+    if 'float' in obj.number_format and not float_pixel_data:
+        with profile_stage('quantization', nbytes):
+            if per_slice_rescale:
+                rescale_slope, rescale_intercept = rescale_parameters(
+                    *slice_min_max(resh_arr, threads=threads)
+                )
+            else:
+                rescale_slope, rescale_intercept = rescale_parameters(*min_max(resh_arr, threads=threads))
+            resh_arr = quantize(resh_arr, rescale_slope, rescale_intercept, threads=threads)
 
     return resh_arr, rescale_slope, rescale_intercept, byte_order_local
 
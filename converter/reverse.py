@@ -0,0 +1,314 @@
+# Reverse (DICOM to Interfile) conversion module
+
+from collections import defaultdict
+import logging
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+
+from converter.exceptions import I2DException
+from converter.profiling import profile_stage
+from converter.settings import IMPLEMENTATION_VERSION_NAME, UID
+
+LOGGER = logging.getLogger(__name__)
+
+# Default Image Orientation (Patient) of slices written by write_dicom
+DEFAULT_ORIENTATION = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
+INTERFILE_HEADER_TEMPLATE = """!INTERFILE :=
+!imaging modality := {modality}
+!version of keys := CASToRv3.1
+CASToR version := 3.1.1
+
+!GENERAL DATA :=
+!originating system := {originating_system}
+!data offset in bytes := 0
+!name of data file := {img_name}
+
+!GENERAL IMAGE DATA :=
+!type of data := Dynamic
+!total number of images := {size_3}
+imagedata byte order := LITTLEENDIAN
+!number of frame groups := 1
+
+!STATIC STUDY (General) :=
+number of dimensions := 3
+!matrix size [1] := {size_1}
+!matrix size [2] := {size_2}
+!matrix size [3] := {size_3}
+!number format := {number_format}
+!number of bytes per pixel := {bytes_per_pixel}
+scaling factor (mm/pixel) [1] := {scaling_factor_1}
+scaling factor (mm/pixel) [2] := {scaling_factor_2}
+scaling factor (mm/pixel) [3] := {scaling_factor_3}
+first pixel offset (mm) [1] := 0
+first pixel offset (mm) [2] := 0
+first pixel offset (mm) [3] := 0
+data rescale offset := 0
+data rescale slope := 1
+quantification units := 1
+!image duration (sec) := {duration}
+!image start time (sec) := {start_time}
+!END OF INTERFILE :=
+"""
+
+
+class SliceInfo(NamedTuple):
+    """Header data of one slice (file, or frame of a multi-frame file) needed to place it in the volume"""
+    path: Path
+    position: float
+    rescale_slope: float
+    rescale_intercept: float
+    frame: Optional[int] = None
+
+
+class SeriesInfo(NamedTuple):
+    """Geometry and pixel format of a series, slices sorted for the Interfile volume"""
+    series_uid: str
+    modality: str
+    slices: List[SliceInfo]
+    rows: int
+    columns: int
+    stored_dtype: np.dtype
+    pixel_spacing: Tuple[float, float]
+    slice_spacing: float
+    start_time: float
+    duration: float
+    # Written by write_dicom: slices hold the flipped Interfile slice, with
+    # Rows and Columns swapped, and the last Interfile slice is the lowest
+    converter_output: bool
+
+    @property
+    def rescaled(self) -> bool:
+        return any(s.rescale_slope != 1 or s.rescale_intercept != 0 for s in self.slices)
+
+    @property
+    def output_dtype(self) -> np.dtype:
+        return np.dtype('<f4') if self.rescaled else self.stored_dtype.newbyteorder('<')
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        if self.converter_output:
+            # Columns is the number of image rows, as written by write_dicom
+            return len(self.slices), self.columns, self.rows
+        return len(self.slices), self.rows, self.columns
+
+
+def _stored_dtype(ds) -> np.dtype:
+    if 'PixelRepresentation' not in ds:
+        # Float Pixel Data or Double Float Pixel Data
+        return np.dtype(f'f{ds.BitsAllocated // 8}')
+    kind = 'i' if ds.PixelRepresentation == 1 else 'u'
+    return np.dtype(f'{kind}{ds.BitsAllocated // 8}')
+
+def is_converter_output(ds) -> bool:
+    """
+        Checks whether the file was written by this converter (write_dicom)
+    """
+    file_meta = getattr(ds, 'file_meta', None)
+    if file_meta is not None and file_meta.get('ImplementationVersionName') == IMPLEMENTATION_VERSION_NAME:
+        return True
+    return str(ds.get('SeriesInstanceUID', '')).startswith(UID)
+
+def _functional_group(ds, frame: Optional[int], keyword: str):
+    """
+        Returns the item of a functional group of a multi-frame frame (per-frame
+        or shared), or the dataset itself for a single-frame file
+    """
+    if frame is None:
+        return ds
+    for groups in (ds.PerFrameFunctionalGroupsSequence[frame], ds.SharedFunctionalGroupsSequence[0]):
+        if keyword in groups:
+            return groups[keyword][0]
+    return Dataset()
+
+def _slice_infos(path: Path, ds, normal: np.ndarray) -> List[SliceInfo]:
+    frames = [None] if 'PerFrameFunctionalGroupsSequence' not in ds else range(int(ds.NumberOfFrames))
+    slices = []
+    for frame in frames:
+        position = _functional_group(ds, frame, 'PlanePositionSequence').ImagePositionPatient
+        rescale = _functional_group(ds, frame, 'PixelValueTransformationSequence')
+        slices.append(SliceInfo(
+            path=path,
+            position=float(np.dot(np.array(position, dtype=float), normal)),
+            rescale_slope=float(rescale.get('RescaleSlope', 1)),
+            rescale_intercept=float(rescale.get('RescaleIntercept', 0)),
+            frame=frame,
+        ))
+    return slices
+
+def scan_series(directory: Path, series_uid: Optional[str]=None) -> SeriesInfo:
+    """
+        Reads headers (without pixel data) of all DICOM files in the directory
+        and sorts slices of the series along the slice normal. Frames of
+        Enhanced (multi-frame) files are slices as well.
+
+        Files written by this converter are read back into the Interfile volume
+        they were converted from; slices of other series keep the orientation of
+        DICOM images (Rows along Y, Columns along X, the first slice lowest).
+
+        Arguments:
+        directory - directory with slice files (files which are not DICOM are skipped)
+        series_uid - series to read, required if the directory holds more than one
+
+        Returns:
+        - series description with slices in Interfile order
+    """
+    series = defaultdict(list)
+
+    with profile_stage('header_parse'):
+        for path in sorted(Path(directory).iterdir()):
+            if not path.is_file():
+                continue
+            try:
+                ds = dcmread(path, stop_before_pixels=True)
+            except InvalidDicomError:
+                LOGGER.debug('Skipping %s, not a DICOM file', path)
+                continue
+            if 'SeriesInstanceUID' in ds and (
+                    'ImagePositionPatient' in ds or 'PerFrameFunctionalGroupsSequence' in ds):
+                series[ds.SeriesInstanceUID].append((path, ds))
+
+    if not series:
+        raise I2DException(f'No DICOM slices in {directory}')
+    if series_uid is None:
+        if len(series) > 1:
+            raise I2DException(
+                f'{directory} holds {len(series)} series, choose one of: {", ".join(sorted(series))}'
+            )
+        series_uid = next(iter(series))
+    if series_uid not in series:
+        raise I2DException(f'Series {series_uid} is not in {directory}')
+
+    files = series[series_uid]
+    first = files[0][1]
+    # Geometry of the first slice (or frame)
+    first_frame = 0 if 'PerFrameFunctionalGroupsSequence' in first else None
+    orientation = _functional_group(first, first_frame, 'PlaneOrientationSequence').get(
+        'ImageOrientationPatient', DEFAULT_ORIENTATION
+    )
+    pixel_measures = _functional_group(first, first_frame, 'PixelMeasuresSequence')
+    normal = np.cross(np.array(orientation[:3], dtype=float), np.array(orientation[3:], dtype=float))
+    converter_output = is_converter_output(first)
+
+    slices = []
+    for path, ds in files:
+        if (ds.Rows, ds.Columns) != (first.Rows, first.Columns):
+            raise I2DException(f'{path.name}: slice size differs from {files[0][0].name}')
+        slices.extend(_slice_infos(path, ds, normal))
+
+    # write_dicom writes the last Interfile slice at the lowest position
+    slices.sort(key=lambda s: s.position, reverse=converter_output)
+
+    positions = np.array([s.position for s in slices])
+    if len(slices) > 1:
+        slice_spacing = float(np.median(np.abs(np.diff(positions))))
+    else:
+        slice_spacing = float(pixel_measures.get('SliceThickness', 1))
+
+    # Pixel Spacing is (between rows, between columns), write_dicom writes the
+    # Interfile scaling factors [1] and [2] in this order
+    pixel_spacing = tuple(float(v) for v in pixel_measures.get('PixelSpacing', (1, 1)))
+    if not converter_output:
+        pixel_spacing = pixel_spacing[::-1]
+
+    return SeriesInfo(
+        series_uid=series_uid,
+        modality=first.Modality,
+        slices=slices,
+        rows=first.Rows,
+        columns=first.Columns,
+        stored_dtype=_stored_dtype(first),
+        pixel_spacing=pixel_spacing,
+        slice_spacing=slice_spacing,
+        start_time=float(first.get('FrameReferenceTime', 0))/1000,
+        duration=float(first.get('ActualFrameDuration', 0))/1000,
+        converter_output=converter_output,
+    )
+
+def write_interfile_header(info: SeriesInfo, header_path: Path, img_name: str) -> None:
+    """
+        Writes CASToR-like Interfile header of the image written by dicom_to_interfile
+    """
+    dtype = info.output_dtype
+    number_format = {'f': 'short float', 'u': 'unsigned integer', 'i': 'signed integer'}[dtype.kind]
+    if dtype.kind == 'f' and dtype.itemsize == 8:
+        number_format = 'long float'
+
+    Path(header_path).write_text(INTERFILE_HEADER_TEMPLATE.format(
+        modality=info.modality,
+        originating_system='PET_JPET',
+        img_name=img_name,
+        size_1=info.shape[2],
+        size_2=info.shape[1],
+        size_3=info.shape[0],
+        number_format=number_format,
+        bytes_per_pixel=dtype.itemsize,
+        scaling_factor_1=info.pixel_spacing[0],
+        scaling_factor_2=info.pixel_spacing[1],
+        scaling_factor_3=abs(info.slice_spacing),
+        duration=info.duration,
+        start_time=info.start_time,
+    ))
+
+def dicom_to_interfile(
+    directory: Path,
+    header_path: Path,
+    series_uid: Optional[str]=None,
+) -> Path:
+    """
+        Converts a DICOM series back to Interfile, the inverse of write_dicom.
+
+        Slice headers are read first, then the image file is preallocated and
+        filled slice by slice through a memory map, so only one slice is held
+        in memory (a multi-frame file is decoded at once). Rescaled slices (e.g.
+        quantized float images) are written as 32-bit floats, other slices keep
+        their stored type. See scan_series for the orientation of the volume.
+
+        Arguments:
+        directory - directory with slices (or multi-frame files) of the series
+        header_path - Interfile header to write, the image is written next to it (.img)
+        series_uid - series to convert, required if the directory holds more than one
+
+        Returns:
+        - path to the header file
+    """
+    info = scan_series(directory, series_uid)
+    header_path = Path(header_path)
+    header_path.parent.mkdir(parents=True, exist_ok=True)
+    img_path = header_path.with_suffix('.img')
+
+    dtype = info.output_dtype
+    nbytes = int(np.prod(info.shape))*dtype.itemsize
+    LOGGER.info('Writing %d slices of series %s to %s', len(info.slices), info.series_uid, img_path)
+
+    volume = np.memmap(img_path, dtype=dtype, mode='w+', shape=info.shape)
+    frames_path, frames = None, None
+    try:
+        with profile_stage('read_binary', nbytes):
+            for k, s in enumerate(info.slices):
+                if s.frame is None:
+                    img_slice = dcmread(s.path).pixel_array
+                else:
+                    if s.path != frames_path:
+                        frames_path = s.path
+                        frames = dcmread(s.path).pixel_array.reshape(-1, info.rows, info.columns)
+                    img_slice = frames[s.frame]
+                if info.converter_output:
+                    # Same bytes as the slice given to write_dicom, flipped back (Y axis)
+                    img_slice = img_slice.reshape(info.columns, info.rows)[::-1, :]
+                if info.rescaled:
+                    volume[k] = img_slice*np.float32(s.rescale_slope) + np.float32(s.rescale_intercept)
+                else:
+                    volume[k] = img_slice
+        with profile_stage('write', nbytes):
+            volume.flush()
+    finally:
+        del volume
+
+    write_interfile_header(info, header_path, img_path.name)
+    return header_path
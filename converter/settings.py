@@ -8,4 +8,7 @@ CASToR_VERSION = '3.1.1'
 TEST_DIR = "/tmp/i2d_test"
 
 # Root UID obtained from (http://www.medicalconnections.co.uk/FreeUID.html)
-UID = '1.2.826.0.1.3680043.10.837.'
\ No newline at end of file
+UID = '1.2.826.0.1.3680043.10.837.'
+
+# Implementation Version Name in the file meta information of written files
+IMPLEMENTATION_VERSION_NAME = 'J-PET_V0'
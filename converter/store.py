@@ -0,0 +1,293 @@
+# DICOM network store module
+
+from contextlib import contextmanager
+from io import BytesIO
+import logging
+import queue
+import threading
+import time
+from typing import BinaryIO, Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+
+from converter.exceptions import DicomStoreException
+from converter.pipeline import QUEUE_SIZE, run_pipeline
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_AE_TITLE = 'JPETCONVERTER'
+DEFAULT_CALLED_AE_TITLE = 'ANY-SCP'
+
+# C-STORE statuses which mean the object was stored (Success and Warnings, PS3.4 B.2.3)
+STORED_STATUSES = (0x0000, 0xB000, 0xB006, 0xB007)
+
+PIXEL_KEYWORDS = ('PixelData', 'FloatPixelData', 'DoubleFloatPixelData')
+
+
+def _pynetdicom():
+    """
+        Imports pynetdicom, which is needed only for sending over the network
+    """
+    try:
+        import pynetdicom
+    except ImportError as e:
+        raise DicomStoreException(
+            'Sending over DICOM network requires pynetdicom (pip install pynetdicom)'
+        ) from e
+    return pynetdicom
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """
+        Splits `host:port` into host and port
+    """
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f'Invalid address: {address}, use host:port')
+    return host, int(port)
+
+
+class SeriesStats(NamedTuple):
+    """Objects, bytes and time spent sending a series"""
+    series_uid: str
+    files: int
+    bytes: int
+    seconds: float
+    retries: int
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.bytes / 2**20 / self.seconds if self.seconds else 0.0
+
+
+class AssociationPool:
+    """
+        Persistent associations with a Storage SCP, shared by sending threads.
+
+        Associations are opened when needed (at most `size`) and reused for
+        following C-STOREs. Every association proposes all presentation contexts
+        seen so far; a new SOP class or transfer syntax makes idle associations
+        stale, they are released and opened again with the new context.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ae_title: str=DEFAULT_AE_TITLE,
+        called_ae_title: str=DEFAULT_CALLED_AE_TITLE,
+        size: int=2,
+        timeout: float=30,
+    ):
+        pynetdicom = _pynetdicom()
+        self.host = host
+        self.port = port
+        self.called_ae_title = called_ae_title
+        self.size = max(1, size)
+
+        self._ae = pynetdicom.AE(ae_title=ae_title)
+        self._ae.acse_timeout = timeout
+        self._ae.dimse_timeout = timeout
+        self._ae.network_timeout = timeout
+        self._build_context = pynetdicom.build_context
+
+        self._lock = threading.Lock()
+        self._contexts = []
+        self._generation = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(self.size)
+
+    def _require_context(self, context: Tuple[str, str]) -> None:
+        with self._lock:
+            if context not in self._contexts:
+                self._contexts.append(context)
+                self._generation += 1
+
+    def _associate(self):
+        with self._lock:
+            contexts = [self._build_context(*context) for context in self._contexts]
+            generation = self._generation
+
+        assoc = self._ae.associate(
+            self.host, self.port, contexts=contexts, ae_title=self.called_ae_title
+        )
+        if not assoc.is_established:
+            raise DicomStoreException(
+                f'Association with {self.called_ae_title}@{self.host}:{self.port} was not established'
+            )
+        return assoc, generation
+
+    @contextmanager
+    def association(self, sop_class: str, transfer_syntax: str) -> Iterator:
+        """
+            Lends an association accepting the context, returned to the pool afterwards.
+            An association which failed (exception inside the block) is aborted.
+        """
+        self._require_context((sop_class, transfer_syntax))
+        self._slots.acquire()
+        assoc = None
+        try:
+            while assoc is None:
+                try:
+                    assoc, generation = self._idle.get_nowait()
+                except queue.Empty:
+                    assoc, generation = self._associate()
+                    break
+                if generation != self._generation or not assoc.is_established:
+                    assoc.release()
+                    assoc = None
+
+            try:
+                yield assoc
+            except BaseException:
+                assoc.abort()
+                raise
+            self._idle.put((assoc, generation))
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """
+            Releases idle associations
+        """
+        while True:
+            try:
+                assoc, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if assoc.is_established:
+                assoc.release()
+
+
+class StoreSink:
+    """
+        Sends DICOM datasets or encoded objects to a Storage SCP (C-STORE).
+
+        Encoded objects are decoded in one thread, all are stored by `associations` threads,
+        each with its own association from the pool, so that several C-STOREs
+        are in flight. Failed C-STOREs are retried on a new association.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ae_title: str=DEFAULT_AE_TITLE,
+        called_ae_title: str=DEFAULT_CALLED_AE_TITLE,
+        associations: int=2,
+        retries: int=2,
+        retry_delay: float=1.0,
+        timeout: float=30,
+    ):
+        """
+            Arguments:
+            host, port - address of the Storage SCP
+            ae_title - our (calling) AE title
+            called_ae_title - AE title of the SCP
+            associations - number of associations, i.e. C-STOREs in flight
+            retries - number of retries of a failed C-STORE
+            retry_delay - seconds before the first retry, doubled for every next one
+            timeout - ACSE, DIMSE and network timeout in seconds
+        """
+        self.pool = AssociationPool(host, port, ae_title, called_ae_title, associations, timeout)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def store(self, ds: Dataset) -> int:
+        """
+            Stores one dataset, retrying failed C-STOREs
+
+            Returns:
+            - number of retries needed
+        """
+        context = (ds.SOPClassUID, ds.file_meta.TransferSyntaxUID)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.pool.association(*context) as assoc:
+                    status = assoc.send_c_store(ds)
+                    if 'Status' not in status:
+                        raise DicomStoreException('No C-STORE response (association aborted or timed out)')
+                    if status.Status not in STORED_STATUSES:
+                        raise DicomStoreException(f'C-STORE failed with status 0x{status.Status:04X}')
+                return attempt
+            except ValueError as e:
+                # No presentation context was accepted for the dataset (or it could not be
+                # encoded), a new association would propose the same contexts again
+                raise DicomStoreException(f'Storing {ds.SOPInstanceUID} failed: {e}') from e
+            except (DicomStoreException, OSError, RuntimeError) as e:
+                if attempt == self.retries:
+                    raise DicomStoreException(
+                        f'Storing {ds.SOPInstanceUID} failed after {attempt + 1} attempts: {e}'
+                    ) from e
+                LOGGER.warning('C-STORE attempt %d failed: %s, retrying', attempt + 1, e)
+                time.sleep(self.retry_delay * 2**attempt)
+
+    def send(
+        self,
+        encoded: Iterable[Tuple[str, Union[bytes, BinaryIO, Dataset]]],
+        queue_size: int=QUEUE_SIZE,
+        prepare: Optional[Callable[[Dataset], None]]=None,
+    ) -> List[SeriesStats]:
+        """
+            Sends objects, e.g. from writer.iter_dicom
+
+            Arguments:
+            encoded - (name, Part 10 bytes, buffer or dataset) pairs; datasets
+                (writer.iter_dicom with as_dataset) are encoded only by the
+                C-STORE, bytes of their pixel data are counted in the statistics
+            queue_size - number of objects waiting to be stored
+            prepare - called with every dataset before it is stored
+
+            Returns:
+            - statistics of every series, in order of their first object
+        """
+        lock = threading.Lock()
+        # Series UID: [files, bytes, retries, first decoded, last stored]
+        series = {}
+
+        def decode(item) -> Tuple[Dataset, int]:
+            _, data = item
+            if isinstance(data, Dataset):
+                ds = data
+                nbytes = sum(len(ds[keyword].value) for keyword in PIXEL_KEYWORDS if keyword in ds)
+            else:
+                fp = BytesIO(data) if isinstance(data, bytes) else data
+                ds = dcmread(fp)
+                nbytes = fp.seek(0, 2)
+            if prepare is not None:
+                prepare(ds)
+            with lock:
+                series.setdefault(ds.SeriesInstanceUID, [0, 0, 0, time.perf_counter(), None])
+            return ds, nbytes
+
+        def store(item) -> None:
+            ds, nbytes = item
+            retries = self.store(ds)
+            with lock:
+                counters = series[ds.SeriesInstanceUID]
+                counters[0] += 1
+                counters[1] += nbytes
+                counters[2] += retries
+                counters[4] = time.perf_counter()
+
+        run_pipeline(encoded, [(decode, 1), (store, self.pool.size)], queue_size)
+
+        stats = [
+            SeriesStats(series_uid, files, nbytes, (end or start) - start, retries)
+            for series_uid, (files, nbytes, retries, start, end) in series.items()
+        ]
+        for s in stats:
+            LOGGER.info(
+                'Sent series %s: %d files, %.1f MiB in %.2f s (%.1f MiB/s, %d retries)',
+                s.series_uid, s.files, s.bytes / 2**20, s.seconds, s.mb_per_s, s.retries
+            )
+        return stats
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def __enter__(self) -> 'StoreSink':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
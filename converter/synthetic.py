@@ -0,0 +1,156 @@
+# Synthetic Interfile module
+
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+INTERFILE_HEADER_TEMPLATE = """!INTERFILE :=
+!imaging modality := {modality}
+!version of keys := CASToRv3.1
+CASToR version := 3.1.1
+
+!GENERAL DATA :=
+!originating system := PET_JPET
+!data offset in bytes := {offset}
+!name of data file := {img_name}
+
+!GENERAL IMAGE DATA :=
+!type of data := Dynamic
+!total number of images := {images}
+imagedata byte order := {byte_order}
+!number of frame groups := 1
+
+!STATIC STUDY (General) :=
+number of dimensions := 3
+!matrix size [1] := {size_1}
+!matrix size [2] := {size_2}
+!matrix size [3] := {size_3}
+!number format := {number_format}
+!number of bytes per pixel := {bytes_per_pixel}
+scaling factor (mm/pixel) [1] := 2.5
+scaling factor (mm/pixel) [2] := 2.5
+scaling factor (mm/pixel) [3] := 2.5
+first pixel offset (mm) [1] := 0
+first pixel offset (mm) [2] := 0
+first pixel offset (mm) [3] := 0
+data rescale offset := 0
+data rescale slope := 1
+quantification units := 1
+{timing}!END OF INTERFILE :=
+"""
+
+NUMBER_FORMATS = {
+    'f': 'short float',
+    'u': 'unsigned integer',
+    'i': 'signed integer',
+}
+
+
+def write_interfile(
+    directory: Path,
+    name: str,
+    volume: np.ndarray,
+    modality: str='PT',
+    offset: int=0,
+    frame_duration: float=1,
+) -> Path:
+    """
+        Writes CASToR-like Interfile header and image files for a (z, y, x) volume,
+        or a dynamic (t, z, y, x) volume with frames stored one after another
+
+        Arguments:
+        directory - output directory
+        name - file name without extension (`name.hdr` and `name.img` are written)
+        volume - image, its dtype sets number format and byte order
+        modality - 'PT' or 'CT'
+        offset - number of zero bytes before the image data
+        frame_duration - duration of every time frame in seconds
+
+        Returns:
+        - path to the header file
+    """
+    frames = volume.shape[0] if volume.ndim == 4 else 1
+    if volume.ndim == 4:
+        timing = ''.join(
+            f"!image duration (sec) [{k}] := {frame_duration}\n"
+            f"!image start time (sec) [{k}] := {(k - 1)*frame_duration}\n"
+            for k in range(1, frames + 1)
+        )
+    else:
+        timing = f"!image duration (sec) := {frame_duration}\n!image start time (sec) := 0\n"
+
+    byte_order = 'BIGENDIAN' if volume.dtype.byteorder == '>' else 'LITTLEENDIAN'
+    header_path = Path(directory) / f"{name}.hdr"
+    header_path.write_text(INTERFILE_HEADER_TEMPLATE.format(
+        modality=modality,
+        offset=offset,
+        img_name=f"{name}.img",
+        byte_order=byte_order,
+        images=frames*volume.shape[-3],
+        size_1=volume.shape[-1],
+        size_2=volume.shape[-2],
+        size_3=volume.shape[-3],
+        number_format=NUMBER_FORMATS[volume.dtype.kind],
+        bytes_per_pixel=volume.dtype.itemsize,
+        timing=timing,
+    ))
+    with open(Path(directory) / f"{name}.img", 'wb') as f:
+        f.write(b'\x00' * offset)
+        f.write(volume.tobytes())
+    return header_path
+
+def synthetic_volume(
+    shape: Tuple[int, ...],
+    dtype: str='<f4',
+    seed: int=0,
+) -> np.ndarray:
+    """
+        Generates a phantom-like volume: a smooth blob with noise and an empty
+        border, so that both compression and quantization see realistic data
+
+        Arguments:
+        shape - (z, y, x) or (t, z, y, x) shape
+        dtype - numpy dtype string, e.g. '<f4', '>i2', '<u2'
+        seed - random generator seed
+
+        Returns:
+        - volume of the given shape and dtype
+    """
+    dtype = np.dtype(dtype)
+    rng = np.random.default_rng(seed)
+
+    axes = np.ogrid[tuple(slice(-1, 1, complex(0, n)) for n in shape[-3:])]
+    blob = np.exp(-4*sum(axis**2 for axis in axes)).astype(np.float32)
+    volume = np.broadcast_to(blob, shape) + 0.1*rng.random(shape, dtype=np.float32)
+
+    # Empty border around the field of view
+    border = shape[-2]//8
+    if border:
+        volume[..., :border, :] = 0
+        volume[..., -border:, :] = 0
+
+    if dtype.kind in 'iu':
+        volume *= min(np.iinfo(dtype).max, 10000)
+    else:
+        volume *= 100
+    return volume.astype(dtype)
+
+def write_synthetic_interfile(
+    directory: Path,
+    name: str,
+    shape: Tuple[int, ...],
+    dtype: str='<f4',
+    modality: str='PT',
+    offset: int=0,
+    seed: int=0,
+) -> Path:
+    """
+        Generates a synthetic volume and writes it as CASToR-like Interfile
+        (see synthetic_volume and write_interfile)
+
+        Returns:
+        - path to the header file
+    """
+    volume = synthetic_volume(shape, dtype=dtype, seed=seed)
+    return write_interfile(directory, name, volume, modality=modality, offset=offset)
@@ -0,0 +1,373 @@
+# Watch-folder module
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from fnmatch import fnmatch
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from converter.batch import BatchJob, BatchResult, _convert_job
+from converter.exceptions import I2DException
+from converter.reader import (
+    _metaheader_data_sets, _read_interfile_header, interfile_header_import, iter_interfile_frames,
+    read_json_meta
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# Headers and metaheaders of dynamic images watched in the spool
+HEADER_PATTERNS = ('*.hdr', '*.mhd')
+
+
+class MetadataRule(NamedTuple):
+    """Metadata JSON used for headers matching a file name pattern (and modality)"""
+    pattern: str
+    metadata: Path
+    modality: Optional[str] = None
+
+
+def read_rules(path: Path) -> List[MetadataRule]:
+    """
+        Reads metadata rules from a JSON list, e.g.
+        [{"pattern": "ct_*.hdr", "metadata": "ct.json"}, {"pattern": "*", "modality": "PT", "metadata": "pt.json"}]
+        Relative metadata paths are relative to the rules file directory.
+
+        Arguments:
+        path - path to the rules file
+
+        Returns:
+        - list of rules in file order
+    """
+    path = Path(path)
+    with open(path, 'r') as f:
+        records = json.load(f)
+
+    rules = []
+    for number, record in enumerate(records, start=1):
+        if 'metadata' not in record:
+            raise I2DException(f'{path}: rule {number} has no metadata')
+        rules.append(MetadataRule(
+            pattern=record.get('pattern', '*'),
+            metadata=path.parent / record['metadata'],
+            modality=record.get('modality'),
+        ))
+    return rules
+
+def select_metadata(
+    header_path: Path,
+    modality: str,
+    rules: Iterable[MetadataRule],
+    default: Optional[Path]=None,
+) -> Optional[Path]:
+    """
+        Returns metadata of the first rule matching header file name and modality,
+        or the default one if no rule matches
+    """
+    for rule in rules:
+        if fnmatch(header_path.name, rule.pattern) and rule.modality in (None, modality):
+            return Path(rule.metadata)
+    return default
+
+
+class WatchStats:
+    """
+        Counters of a watcher, throughput is measured since the watcher started
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.detected = 0
+        self.converted = 0
+        self.failed = 0
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.bytes_converted = 0
+        self.conversion_seconds = 0.0
+
+    def as_dict(self) -> Dict:
+        uptime = max(time.time() - self.started, 1e-9)
+        finished = self.converted + self.failed
+        return {
+            'uptime_seconds': uptime,
+            'detected': self.detected,
+            'converted': self.converted,
+            'failed': self.failed,
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'bytes_converted': self.bytes_converted,
+            'files_per_minute': 60*finished/uptime,
+            'mb_per_s': self.bytes_converted/2**20/uptime,
+            'mean_conversion_seconds': self.conversion_seconds/finished if finished else None,
+        }
+
+
+class SpoolWatcher:
+    """
+        Converts Interfile header/image pairs dropped into a spool directory.
+
+        A pair is converted once the image is complete (as large as the header says)
+        and sizes of both files did not change since the previous poll. A metaheader
+        of a dynamic image is converted as one series per frame once all its frame
+        headers and images are complete, the frame headers it lists are not
+        converted on their own. Conversions
+        run in a process pool which is started once, so interpreter and library
+        start-up is paid only once. Converted inputs are moved to the done directory,
+        inputs which failed to convert to the failed directory (with a .error file).
+    """
+
+    def __init__(
+        self,
+        spool: Path,
+        output_dir: Path,
+        rules: Iterable[MetadataRule]=(),
+        default_metadata: Optional[Path]=None,
+        done_dir: Optional[Path]=None,
+        failed_dir: Optional[Path]=None,
+        processes: int=1,
+        poll_interval: float=2.0,
+        status_file: Optional[Path]=None,
+        **convert_kwargs,
+    ):
+        """
+            Arguments:
+            spool - directory watched for .hdr (and .mhd metaheader) files
+            output_dir - directory where outputs are created
+            rules - metadata rules, the first matching one is used
+            default_metadata - metadata used when no rule matches
+            done_dir, failed_dir - where inputs are moved (default: spool/done, spool/failed)
+            processes - number of conversions running at the same time
+            poll_interval - seconds between polls
+            status_file - JSON file updated with counters after every poll
+            convert_kwargs - passed to write_dicom (extended_format, lazy, backend, ...)
+        """
+        self.spool = Path(spool)
+        self.output_dir = Path(output_dir)
+        self.rules = list(rules)
+        self.default_metadata = default_metadata
+        self.done_dir = Path(done_dir) if done_dir else self.spool / 'done'
+        self.failed_dir = Path(failed_dir) if failed_dir else self.spool / 'failed'
+        self.processes = max(1, processes)
+        self.poll_interval = poll_interval
+        self.status_file = status_file
+        self.convert_kwargs = dict(convert_kwargs)
+        self.convert_kwargs.setdefault('extended_format', False)
+
+        self.stats = WatchStats()
+        self._sizes = {}
+        self._pending = deque()
+        self._in_flight = {}
+        self._metadata_cache = {}
+        self._executor = ProcessPoolExecutor(max_workers=self.processes)
+
+    def _pair_state(self, header_path: Path) -> Tuple[Tuple[int, ...], List[Path], bool]:
+        """
+            Returns sizes of the header and its files, the files (image, or frame
+            headers and images of a metaheader) and whether every image is as
+            large as its header says
+        """
+        data_sets = _metaheader_data_sets(_read_interfile_header(header_path))
+        frame_headers = [header_path.parent / name for name in data_sets] or [header_path]
+
+        sizes = [header_path.stat().st_size]
+        inputs = []
+        complete = True
+        for frame_header in frame_headers:
+            if frame_header != header_path:
+                inputs.append(frame_header)
+                if not frame_header.is_file():
+                    sizes.append(-1)
+                    complete = False
+                    continue
+                sizes.append(frame_header.stat().st_size)
+
+            header = interfile_header_import(frame_header)
+            image_path = Path(header.header_file_path + header.img_file_name)
+            inputs.append(image_path)
+            if not image_path.is_file():
+                sizes.append(-1)
+                complete = False
+                continue
+
+            expected = header.data_offset_in_bytes + header.frames_number*header.bytes_per_pixel*(
+                header.matrix_size_1*header.matrix_size_2*header.matrix_size_3
+            )
+            sizes.append(image_path.stat().st_size)
+            complete = complete and sizes[-1] >= expected
+
+        return tuple(sizes), inputs, complete
+
+    def _frame_headers(self, header_paths: Iterable[Path]) -> Set[Path]:
+        """
+            Returns frame headers listed in metaheaders among the headers
+        """
+        frame_headers = set()
+        for header_path in header_paths:
+            try:
+                data_sets = _metaheader_data_sets(_read_interfile_header(header_path))
+            except (I2DException, KeyError, ValueError, OSError):
+                continue
+            frame_headers.update(header_path.parent / name for name in data_sets)
+        return frame_headers
+
+    def scan(self) -> List[Tuple[Path, List[Path], Optional[str]]]:
+        """
+            Finds pairs (and metaheaders with their frames) which did not change
+            since the previous scan
+
+            Returns:
+            - list of (header, other input files, error), error is set for stable
+              headers which can not be read
+        """
+        busy = set()
+        for job, inputs, *_ in self._pending:
+            busy.update([job.header, *inputs])
+        for job, inputs in self._in_flight.values():
+            busy.update([job.header, *inputs])
+        ready = []
+        sizes = {}
+
+        header_paths = sorted(path for pattern in HEADER_PATTERNS for path in self.spool.glob(pattern))
+        # Frames of a dynamic image are converted with its metaheader
+        skipped = busy | self._frame_headers(header_paths)
+
+        for header_path in header_paths:
+            if header_path in skipped:
+                continue
+            try:
+                state, inputs, complete = self._pair_state(header_path)
+                error = None
+            except (I2DException, KeyError, ValueError, OSError) as e:
+                # Header may still be written, it is only a failure once it stops changing
+                state, inputs, complete = (header_path.stat().st_size,), [], True
+                error = f'{e.__class__.__name__}: {e}'
+
+            sizes[header_path] = state
+            if complete and self._sizes.get(header_path) == state:
+                ready.append((header_path, inputs, error))
+
+        self._sizes = sizes
+        return ready
+
+    def _metadata(self, path: Path, modality: str):
+        stat = os.stat(path)
+        key = (str(Path(path).resolve()), modality, stat.st_mtime_ns, stat.st_size)
+        if key not in self._metadata_cache:
+            self._metadata_cache[key] = read_json_meta(path, modality)
+        return self._metadata_cache[key]
+
+    def _output_path(self, header_path: Path, dynamic: bool=False) -> Path:
+        # Dynamic images are saved to a directory with a series per frame
+        extended_format = self.convert_kwargs['extended_format'] and not dynamic
+        return self.output_dir / (header_path.stem + ('.dcm' if extended_format else ''))
+
+    def _queue(self, header_path: Path, inputs: List[Path], error: Optional[str]) -> None:
+        self.stats.detected += 1
+        self._sizes.pop(header_path, None)
+
+        if error is None:
+            try:
+                frames = list(iter_interfile_frames(header_path))
+                metadata_path = select_metadata(
+                    header_path, frames[0].modality, self.rules, self.default_metadata
+                )
+                if metadata_path is None:
+                    raise I2DException(f'no metadata rule matches {header_path.name}')
+                job = BatchJob(header_path, metadata_path, self._output_path(header_path, len(frames) > 1))
+                self._pending.append((job, inputs, frames, self._metadata(metadata_path, frames[0].modality)))
+                return
+            except Exception as e:
+                error = f'{e.__class__.__name__}: {e}'
+
+        job = BatchJob(header_path, None, self._output_path(header_path))
+        self._finish(BatchResult(job, error, 0.0), inputs)
+
+    def _submit(self) -> None:
+        while self._pending and len(self._in_flight) < self.processes:
+            job, inputs, frames, metadata = self._pending.popleft()
+            future = self._executor.submit(_convert_job, job, frames, metadata, self.convert_kwargs)
+            self._in_flight[future] = (job, inputs)
+
+    def _collect(self, wait: bool=False) -> None:
+        for future in list(self._in_flight):
+            if not (wait or future.done()):
+                continue
+            job, inputs = self._in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                # e.g. worker process killed
+                result = BatchResult(job, f'{e.__class__.__name__}: {e}', 0.0)
+            self._finish(result, inputs)
+
+    def _finish(self, result: BatchResult, inputs: List[Path]) -> None:
+        header_path = result.job.header
+        inputs = [path for path in (header_path, *inputs) if path.is_file()]
+        input_bytes = sum(path.stat().st_size for path in inputs)
+
+        directory = self.done_dir if result.ok else self.failed_dir
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in inputs:
+            shutil.move(str(path), str(directory / path.name))
+
+        self.stats.conversion_seconds += result.seconds
+        if result.ok:
+            self.stats.converted += 1
+            self.stats.bytes_converted += input_bytes
+            LOGGER.info('Converted %s -> %s (%.2f s)', header_path.name, result.job.output, result.seconds)
+        else:
+            self.stats.failed += 1
+            (directory / f'{header_path.stem}.error').write_text(result.error + '\n')
+            LOGGER.error('Failed %s: %s', header_path.name, result.error)
+
+    def _update_stats(self) -> None:
+        self.stats.queue_depth = len(self._pending)
+        self.stats.in_flight = len(self._in_flight)
+        if self.status_file is not None:
+            temporary = Path(f'{self.status_file}.tmp')
+            temporary.write_text(json.dumps(self.stats.as_dict(), indent=2))
+            os.replace(temporary, self.status_file)
+
+    def poll(self) -> None:
+        """
+            Collects finished conversions, queues new stable pairs and starts conversions
+        """
+        self._collect()
+        for header_path, inputs, error in self.scan():
+            self._queue(header_path, inputs, error)
+        self._submit()
+        self._update_stats()
+
+    def drain(self) -> None:
+        """
+            Waits until all queued conversions are finished
+        """
+        while self._pending or self._in_flight:
+            self._submit()
+            self._collect(wait=True)
+        self._update_stats()
+
+    def run(self, stop: Optional[threading.Event]=None, max_polls: Optional[int]=None) -> None:
+        """
+            Polls the spool until stop is set (or max_polls polls are done),
+            then finishes queued conversions and shuts the pool down
+        """
+        stop = stop or threading.Event()
+        polls = 0
+        LOGGER.info('Watching %s', self.spool)
+        try:
+            while not stop.is_set() and (max_polls is None or polls < max_polls):
+                self.poll()
+                polls += 1
+                stop.wait(self.poll_interval)
+            self.drain()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
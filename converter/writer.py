@@ -1,25 +1,97 @@
 # Wrtier module
 #Author: Mateusz Kruk, Rafal Mozdzonek
 
+from concurrent.futures import ProcessPoolExecutor
+import copy
 from datetime import datetime
+from io import BytesIO
 import logging
+from multiprocessing import RawArray
 import os
 from pathlib import Path
 import random
-from typing import Union
+import struct
+import tarfile
+import time
+import warnings
+from typing import (
+    BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+)
+from typing import Sequence as SequenceType
+import zipfile
 
+import numpy as np
 from numpy.core.records import array
-from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.dataelem import DataElement
+from pydicom.dataset import Dataset, FileMetaDataset, validate_file_meta
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element, write_dataset, write_file_meta_info
+from pydicom.datadict import tag_for_keyword
+from pydicom.encaps import encapsulate
 from pydicom.sequence import Sequence
-from pydicom.uid import generate_uid
+from pydicom.tag import BaseTag, Tag
+from pydicom.uid import (
+    CTImageStorage, DeflatedExplicitVRLittleEndian, EnhancedCTImageStorage, EnhancedPETImageStorage,
+    ExplicitVRLittleEndian, PositronEmissionTomographyImageStorage, RLELossless, generate_uid
+)
 
-from converter.exceptions import InterfileDataMissingException
-from converter.reader import read_binary
-from converter.settings import UID
+from converter.compression import DeflateWriter, rle_encode_frame, transfer_syntax
+from converter.derived import DerivedOutputs
+from converter.memory import MemoryBudget
+from converter.pipeline import QUEUE_SIZE, run_pipeline
+from converter.profiling import profile_stage
+from converter.quantization import _blocks
+from converter.reader import InterfileVolume, _binary_dtype, read_binary
+from converter.settings import IMPLEMENTATION_VERSION_NAME, UID
+from converter.store import SeriesStats, StoreSink
 from models.metadata import InterfileHeader, CTMetaFile, PETMetaFile
 from models.metadata import PatientData, PetSeries
 
 
+BACKENDS = ('pydicom', 'stream')
+
+# Arguments of write_dicom used by iter_dicom as well
+ENCODE_ARGUMENTS = (
+    'lazy', 'backend', 'compression', 'per_slice_rescale', 'memory_budget', 'float_pixel_data'
+)
+
+# Copies of a slice held while it is encoded (pixel bytes, buffers, RLE output),
+# reserved besides the slabs of a conversion with a memory budget
+ENCODE_COPIES = 4
+
+# Output suffixes written as archives by write_archive
+ARCHIVE_SUFFIXES = {
+    '.zip': 'zip',
+    '.tar.gz': 'tar.gz',
+    '.tgz': 'tar.gz',
+    '.tar': 'tar',
+}
+
+PIXEL_DATA_TAG = Tag(0x7FE0, 0x0010)
+
+# Pixel data element of float images by Bits Allocated: keyword and VR
+FLOAT_PIXEL_DATA = {
+    32: ('FloatPixelData', b'OF'),
+    64: ('DoubleFloatPixelData', b'OD'),
+}
+
+MULTIFRAME_SOP_CLASSES = {
+    'PT': EnhancedPETImageStorage,
+    'CT': EnhancedCTImageStorage,
+}
+
+# SOP classes of slices sent to a Storage SCP
+STORAGE_SOP_CLASSES = {
+    'PT': PositronEmissionTomographyImageStorage,
+    'CT': CTImageStorage,
+}
+
+# Attributes which are moved to functional groups in multi-frame datasets
+MULTIFRAME_FUNCTIONAL_KEYWORDS = (
+    'PixelSpacing', 'SliceThickness', 'ImageOrientationPatient', 'ImagePositionPatient',
+    'RescaleIntercept', 'RescaleSlope', 'NumberOfSlices', 'ImageIndex',
+)
+
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(
     format="%(levelname)-10s | %(filename)-20s | %(funcName)-15s | %(lineno)-5d | %(message)-50s\n"
@@ -32,6 +104,40 @@ def rand_uid(prefix: str=UID) -> str:
         entropy_srcs=[str(random.getrandbits(100))]
     ))
 
+def seeded_uid(seed: str, *parts) -> str:
+    """
+        Returns UID derived from the seed and parts, the same on every run
+    """
+    return str(generate_uid(prefix=UID, entropy_srcs=[seed, *map(str, parts)]))
+
+def seeded_series_attributes(
+    seed: str,
+    study_date: str,
+    study_time: str,
+    frame_number: int=1,
+) -> Dict[str, str]:
+    """
+        Returns series attributes (as generated by write_dicom) derived from a seed,
+        so that a conversion repeated with the same seed writes the same files
+
+        Arguments:
+        seed - UID seed, e.g. recorded in a conversion manifest
+        study_date, study_time - study date and time of the first run
+        frame_number - time frame of a dynamic image, series of frames share the study
+
+        Returns:
+        - attributes for the series_attributes argument of write_dicom and iter_dicom
+    """
+    attributes = {
+        keyword: seeded_uid(seed, keyword) for keyword in ('StudyInstanceUID', 'FrameOfReferenceUID')
+    }
+    attributes.update({
+        keyword: seeded_uid(seed, keyword, frame_number)
+        for keyword in ('SOPInstanceUID', 'SOPClassUID', 'SeriesInstanceUID')
+    })
+    attributes.update(StudyDate=study_date, StudyTime=study_time)
+    return attributes
+
 
 def add_from_interfile_header(obj: InterfileHeader, dataset: Dataset) -> Dataset:
     """
@@ -102,54 +208,51 @@ def add_from_json(obj: Union[CTMetaFile, PETMetaFile], dataset: Dataset) -> Data
 
     return dataset
 
-def add_dicom_metadata(dataset: Dataset) -> Dataset:
+def add_dicom_metadata(
+    dataset: Dataset,
+    transfer_syntax: str=ExplicitVRLittleEndian,
+) -> Dataset:
     file_meta = FileMetaDataset()
     """A Transfer Syntax is a set of encoding rules able to unambiguously represent one or more
     Abstract Syntaxes. In particular, it allows communicating Application Entities to negotiate
     common encoding techniques they both support (e.g., byte ordering, compression, etc.).
     A Transfer Syntax is an attribute of a Presentation Context, one or more of which are
     negotiated at the establishment of an Association between DICOM Application Entities."""
-    file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1' # Explicit VR Little Endian
+    file_meta.TransferSyntaxUID = transfer_syntax # Explicit VR Little Endian by default
 
-    file_meta.ImplementationVersionName = 'J-PET_V0'
+    file_meta.ImplementationVersionName = IMPLEMENTATION_VERSION_NAME
 
     dataset.file_meta = file_meta
 
     return dataset
 
+def _deprecated(name: str, replacement: str) -> None:
+    warnings.warn(f'{name} is deprecated, use {replacement}', DeprecationWarning, stacklevel=3)
+
 def interfile_image_to_dicom_dataset(
     obj: InterfileHeader,
     binary_img: array,
     dataset: Dataset,
 ) -> Dataset:
     """
-        Read image file from header data and put it into a Dicom Dataset
+        Deprecated, use create_series_template and set_pixel_data.
+        Puts the image (a slice or the volume) into a Dicom Dataset
 
         Arguments:
         obj - object containing interfile header data
+        binary_img - image returned by read_binary
         dataset - Dicom Dataset to save the image data
 
         Returns:
         dataset - the same dataset that came as an argument but with image metadata
     """
+    _deprecated('interfile_image_to_dicom_dataset', 'create_series_template and set_pixel_data')
 
-    try:
-        if len(binary_img.shape) == 3:
-            slices_number = binary_img.shape[0]
-            dataset.Columns = binary_img.shape[1]
-            dataset.Rows = binary_img.shape[2]
-        else:
-            dataset.Columns = binary_img.shape[0]
-            dataset.Rows = binary_img.shape[1]
-
-        dataset.PixelData = binary_img.tobytes()
-
-        return dataset
+    dataset.Columns = binary_img.shape[-2]
+    dataset.Rows = binary_img.shape[-1]
+    dataset.PixelData = binary_img.tobytes()
 
-    except KeyError as e:
-        x = e.args
-        LOGGER.error("Missing", x[0], " line from header!")
-        raise InterfileDataMissingException
+    return dataset
 
 def create_slice_dataset(
     interfile_data: InterfileHeader,
@@ -158,54 +261,779 @@ def create_slice_dataset(
     slice_number=0,
     number_of_slices=1,
     extended_format: bool=False,
-):
-    ds = Dataset()
-    ds = add_from_interfile_header(obj=interfile_data, dataset=ds)
-    ds = add_dicom_metadata(ds)
-
-    ds.StudyDate = datetime.today().strftime("%Y%m%d")
-
-    # Add image to the dataset
-    ds = interfile_image_to_dicom_dataset(
-        obj=interfile_data,
-        binary_img=binary_img,
-        dataset=ds
+) -> Dataset:
+    """
+        Deprecated, use create_series_template and create_slice_from_template.
+        Creates dataset of one slice (or of the whole volume with extended format),
+        building the series template for every call
+    """
+    _deprecated('create_slice_dataset', 'create_series_template and create_slice_from_template')
+
+    img_shape = binary_img.shape if len(binary_img.shape) == 3 else (number_of_slices,) + binary_img.shape
+    template = create_series_template(
+        interfile_data=interfile_data,
+        metadata=metadata,
+        img_shape=img_shape,
+        rescale_slope=1,
+        rescale_intercept=0,
+        byte_order_local=_binary_dtype(interfile_data)[1],
+        series={'StudyDate': datetime.today().strftime("%Y%m%d")},
     )
+    if binary_img.dtype.kind in 'iu':
+        # Quantized images are stored as they are, without their rescale values
+        template.BitsAllocated = template.BitsStored = 8*binary_img.dtype.itemsize
+        template.HighBit = template.BitsAllocated - 1
+        template.PixelRepresentation = int(binary_img.dtype.kind == 'i')
+    if extended_format:
+        ds = copy.copy(template)
+        ds.file_meta = copy.deepcopy(template.file_meta)
+        return set_pixel_data(ds, binary_img)
+
+    return create_slice_from_template(template, binary_img, metadata, slice_number)
 
-    if metadata:
-        ds = add_from_json(obj=metadata, dataset=ds)
+def set_slice_position(
+        dataset: Dataset,
+        metadata: Union[CTMetaFile, PETMetaFile],
+        slice_number: int,
+        number_of_slices: int
+) -> Dataset:
+    """
+        Deprecated, use create_slice_elements (or get_slice_position)
+    """
+    _deprecated('set_slice_position', 'create_slice_elements')
 
-    if not extended_format:
-        ds = set_slice_position(ds, metadata, slice_number, number_of_slices)
+    dataset.ImagePositionPatient = get_slice_position(dataset, metadata, slice_number)
 
-    return ds
+    return dataset
 
-def set_slice_position(
+def get_slice_position(
         dataset: Dataset,
         metadata: Union[CTMetaFile, PETMetaFile],
         slice_number: int,
-        number_of_slices: int
-):
+) -> List[float]:
     pixel_spacing_x = float(dataset.PixelSpacing[0])
     pixel_spacing_y = float(dataset.PixelSpacing[1])
     pixel_spacing_z = float(dataset.SliceThickness)
     patient_center = metadata.patientCenter
 
-    img_position_patient = [
+    return [
         -pixel_spacing_x*patient_center[0],
         -pixel_spacing_y*patient_center[1],
         pixel_spacing_z*(slice_number - patient_center[2])
     ]
 
-    setattr(dataset, "ImagePositionPatient", img_position_patient)
+def create_series_template(
+    interfile_data: InterfileHeader,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    img_shape: Tuple[int, ...],
+    rescale_slope: float,
+    rescale_intercept: float,
+    byte_order_local: str,
+    series: Dict[str, str],
+    compression: Optional[str]=None,
+    float_pixel_data: bool=False,
+) -> Dataset:
+    """
+        Builds dicom dataset with all attributes shared by the slices of a series
+
+        Arguments:
+        interfile_data - header arguments object
+        metadata - additional meta data to add
+        img_shape - shape of the image volume (slices first)
+        rescale_slope, rescale_intercept - rescale values returned by read_binary; arrays
+            with a value per slice are set as multi-valued elements, which
+            create_slice_elements splits between slices
+        byte_order_local - byte order returned by read_binary
+        series - attributes shared by all slices of the series (UIDs, study date and time)
+        compression - None, 'rle' or 'deflate', sets the transfer syntax
+        float_pixel_data - float voxels are written as Float Pixel Data (or Double
+            Float Pixel Data), which has no Bits Stored, High Bit and Pixel Representation
+
+        Returns:
+        dataset - template dataset without pixel data and slice position
+    """
+    ds = Dataset()
+    ds = add_from_interfile_header(obj=interfile_data, dataset=ds)
+    ds = add_dicom_metadata(ds, transfer_syntax(compression))
+
+    # Columns and rows are the second and third axis of the (flipped) volume
+    ds.Columns = img_shape[1]
+    ds.Rows = img_shape[2]
+
+    if metadata:
+        ds = add_from_json(obj=metadata, dataset=ds)
+
+    ds.NumberOfSlices = img_shape[0]
+
+    ds.RescaleSlope = np.asarray(rescale_slope).tolist()
+    ds.RescaleIntercept = np.asarray(rescale_intercept).tolist()
+
+    if float_pixel_data:
+        ds.BitsAllocated = 8*interfile_data.bytes_per_pixel
+    elif np.any(np.asarray(rescale_slope) != 1):
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0 # unsigned int
+    else:
+        ds.BitsAllocated = 8*interfile_data.bytes_per_pixel
+        ds.BitsStored = 8*interfile_data.bytes_per_pixel
+        ds.HighBit = 8*interfile_data.bytes_per_pixel - 1
+        if "unsigned" in interfile_data.number_format:
+            ds.PixelRepresentation = 0 # unsigned int
+        else:
+            ds.PixelRepresentation = 1 # signed int
+
+    # Only monochromatic images (one channel per pixel)
+    ds.SamplesPerPixel = 1
+
+    # Assing folder level UUIDs and other data
+    for keyword, value in series.items():
+        setattr(ds, keyword, value)
+
+    # TODO: Implement our own Implementation Class UID
+
+    # Set most common options (most common encoding)
+    # Compressed transfer syntaxes are always little endian
+    ds.is_little_endian = '<' in byte_order_local or compression is not None
+    ds.is_implicit_VR = False
+
+    return ds
+
+def float_pixel_keyword(dataset: Dataset) -> Optional[str]:
+    """
+        Returns keyword of the pixel data element of a float image template
+        (see create_series_template), None for integer images
+    """
+    if 'PixelRepresentation' in dataset:
+        return None
+    return FLOAT_PIXEL_DATA[dataset.BitsAllocated][0]
+
+def set_pixel_data(dataset: Dataset, img: Union[array, InterfileVolume]) -> Dataset:
+    """
+        Encodes image into PixelData according to the dataset transfer syntax
+
+        Arguments:
+        dataset - dataset with file meta and Columns
+        img - 2D image of a slice, or 3D volume (one frame per slice)
+
+        Returns:
+        dataset - the same dataset with PixelData
+    """
+    tsyntax = dataset.file_meta.TransferSyntaxUID
+    float_keyword = float_pixel_keyword(dataset)
+
+    if float_keyword is not None:
+        # Never encapsulated, a deflated transfer syntax deflates the whole dataset
+        img = img[...]
+        if tsyntax == DeflatedExplicitVRLittleEndian:
+            img = img.astype(img.dtype.newbyteorder('<'), copy=False)
+        setattr(dataset, float_keyword, img.tobytes())
+    elif tsyntax == RLELossless:
+        frames = [img] if len(img.shape) == 2 else (img[i] for i in range(img.shape[0]))
+        dataset.PixelData = encapsulate(
+            [rle_encode_frame(frame, dataset.Columns) for frame in frames]
+        )
+        dataset['PixelData'].VR = 'OB'
+        dataset['PixelData'].is_undefined_length = True
+    elif tsyntax == DeflatedExplicitVRLittleEndian:
+        img = img[...]
+        dataset.PixelData = img.astype(img.dtype.newbyteorder('<'), copy=False).tobytes()
+    else:
+        dataset.PixelData = img[...].tobytes()
 
     return dataset
 
+def create_multiframe_dataset(
+    template: Dataset,
+    metadata: Union[CTMetaFile, PETMetaFile],
+) -> Dataset:
+    """
+        Creates Enhanced PET/CT Image dataset (without pixel data) from the series template.
+        Geometry and rescale attributes are moved to the shared functional groups,
+        slice positions become per-frame functional groups.
+
+        Arguments:
+        template - dataset created by create_series_template
+        metadata - additional meta data (patient center)
+
+        Returns:
+        dataset - multi-frame dataset, one frame per slice
+    """
+    ds = Dataset()
+    ds.update(template)
+    ds.file_meta = copy.deepcopy(template.file_meta)
+    ds.is_little_endian = template.is_little_endian
+    ds.is_implicit_VR = template.is_implicit_VR
+
+    number_of_frames = template.NumberOfSlices
+    for keyword in MULTIFRAME_FUNCTIONAL_KEYWORDS:
+        if keyword in ds:
+            delattr(ds, keyword)
+
+    ds.SOPClassUID = MULTIFRAME_SOP_CLASSES[template.Modality]
+    ds.NumberOfFrames = number_of_frames
+    # Enhanced images have four values: e.g. ORIGINAL\PRIMARY\VOLUME\NONE
+    ds.ImageType = list(template.ImageType)[:2] + ['VOLUME', 'NONE']
+    ds.ContentDate = template.StudyDate
+    ds.ContentTime = template.StudyTime
+    ds.AcquisitionDateTime = template.StudyDate + template.StudyTime
+    ds.PresentationLUTShape = 'IDENTITY'
+
+    # Frames are ordered by a single stack position
+    # Derived from the series, so that files of a seeded series are reproducible
+    dimension_organization_uid = seeded_uid(template.SeriesInstanceUID, 'DimensionOrganizationUID')
+    organization = Dataset()
+    organization.DimensionOrganizationUID = dimension_organization_uid
+    ds.DimensionOrganizationSequence = Sequence([organization])
+
+    dimension_indices = []
+    for pointer in ('StackID', 'InStackPositionNumber'):
+        index = Dataset()
+        index.DimensionOrganizationUID = dimension_organization_uid
+        index.DimensionIndexPointer = tag_for_keyword(pointer)
+        index.FunctionalGroupPointer = tag_for_keyword('FrameContentSequence')
+        dimension_indices.append(index)
+    ds.DimensionIndexSequence = Sequence(dimension_indices)
+
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = template.PixelSpacing
+    pixel_measures.SliceThickness = template.SliceThickness
+
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = template.ImageOrientationPatient
+
+    def pixel_transformation(rescale_intercept, rescale_slope) -> Dataset:
+        transformation = Dataset()
+        transformation.RescaleIntercept = rescale_intercept
+        transformation.RescaleSlope = rescale_slope
+        transformation.RescaleType = 'US' # unspecified
+        return transformation
+
+    # Slope and intercept of every slice are per-frame functional groups
+    per_frame_rescale = template['RescaleSlope'].VM > 1
+
+    shared = Dataset()
+    shared.PixelMeasuresSequence = Sequence([pixel_measures])
+    shared.PlaneOrientationSequence = Sequence([plane_orientation])
+    if not per_frame_rescale:
+        shared.PixelValueTransformationSequence = Sequence([
+            pixel_transformation(template.RescaleIntercept, template.RescaleSlope)
+        ])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    per_frame = []
+    for i in range(number_of_frames):
+        frame_content = Dataset()
+        frame_content.StackID = '1'
+        frame_content.InStackPositionNumber = i+1
+        frame_content.DimensionIndexValues = [1, i+1]
+
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = get_slice_position(template, metadata, i)
+
+        frame = Dataset()
+        frame.FrameContentSequence = Sequence([frame_content])
+        frame.PlanePositionSequence = Sequence([plane_position])
+        if per_frame_rescale:
+            frame.PixelValueTransformationSequence = Sequence([
+                pixel_transformation(template.RescaleIntercept[i], template.RescaleSlope[i])
+            ])
+        per_frame.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+
+    return ds
+
+def create_slice_elements(
+    template: Dataset,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    slice_number: int,
+) -> Dataset:
+    """
+        Creates dataset with the elements which differ from slice to slice (except pixel data)
+
+        Arguments:
+        template - dataset created by create_series_template
+        metadata - additional meta data (patient center)
+        slice_number - index of the slice in the volume
+
+        Returns:
+        dataset - slice specific elements
+    """
+    ds = Dataset()
+
+    ds.InstanceNumber = str(slice_number+1)
+    ds.ImagePositionPatient = get_slice_position(template, metadata, slice_number)
+
+    if template['RescaleSlope'].VM > 1:
+        # Slope and intercept of every slice
+        ds.RescaleIntercept = template.RescaleIntercept[slice_number]
+        ds.RescaleSlope = template.RescaleSlope[slice_number]
+
+    if template.Modality == "PT":
+        ds.ImageIndex = slice_number+1
+
+    return ds
+
+def create_slice_from_template(
+    template: Dataset,
+    img_slice: array,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    slice_number: int,
+) -> Dataset:
+    """
+        Creates dicom dataset of one slice from the series template
+
+        Arguments:
+        template - dataset created by create_series_template
+        img_slice - 2D image of the slice
+        metadata - additional meta data (patient center)
+        slice_number - index of the slice in the volume
+
+        Returns:
+        dataset - template attributes with slice specific ones
+    """
+    ds = Dataset()
+    # Elements are shared with the template, so only new elements are set below
+    ds.update(template)
+    ds.file_meta = copy.deepcopy(template.file_meta)
+    ds.is_little_endian = template.is_little_endian
+    ds.is_implicit_VR = template.is_implicit_VR
+
+    set_pixel_data(ds, img_slice)
+    ds.update(create_slice_elements(template, metadata, slice_number))
+
+    return ds
+
+
+class StreamEncoder:
+    """
+        Writes Part 10 files of a series without Dataset.save_as.
+
+        File meta information and template elements are encoded once per series
+        as Explicit VR Little Endian. For every slice only the slice elements are
+        encoded, while pixel data is written straight from the image buffer.
+        RLE Lossless and Deflated Explicit VR Little Endian templates are supported,
+        float images are written as Float Pixel Data straight from the voxel buffer.
+    """
+
+    PREAMBLE = b'\x00' * 128 + b'DICM'
+
+    def __init__(self, template: Dataset, slice_tags: List[BaseTag]):
+        """
+            Arguments:
+            template - dataset created by create_series_template
+            slice_tags - tags of the elements returned by create_slice_elements
+        """
+        self.slice_tags = sorted(slice_tags)
+
+        self.transfer_syntax = template.file_meta.TransferSyntaxUID
+        self.columns = template.Columns
+
+        file_meta = copy.deepcopy(template.file_meta)
+        if self.transfer_syntax not in (RLELossless, DeflatedExplicitVRLittleEndian):
+            self.transfer_syntax = ExplicitVRLittleEndian
+        file_meta.TransferSyntaxUID = self.transfer_syntax
+        file_meta.MediaStorageSOPClassUID = template.SOPClassUID
+        file_meta.MediaStorageSOPInstanceUID = template.SOPInstanceUID
+        validate_file_meta(file_meta, enforce_standard=True)
+
+        buffer = self._new_buffer()
+        buffer.write(self.PREAMBLE)
+        write_file_meta_info(buffer, file_meta, enforce_standard=True)
+        self.file_meta = buffer.getvalue()
+
+        float_keyword = float_pixel_keyword(template)
+        if float_keyword is not None:
+            self.pixel_tag = Tag(float_keyword)
+            self.pixel_vr = FLOAT_PIXEL_DATA[template.BitsAllocated][1]
+        else:
+            self.pixel_tag = PIXEL_DATA_TAG
+            self.pixel_vr = b'OW' if template.BitsAllocated > 8 else b'OB'
+
+        # Template elements between consecutive slice elements and pixel data
+        self.segments = []
+        start = 0
+        for tag in self.slice_tags + [self.pixel_tag]:
+            self.segments.append(self._encode(template[start:tag]))
+            start = tag + 1
+        self.segments.append(self._encode(template[start:]))
+
+    @staticmethod
+    def _new_buffer() -> DicomBytesIO:
+        buffer = DicomBytesIO()
+        buffer.is_little_endian = True
+        buffer.is_implicit_VR = False
+        return buffer
+
+    def _encode(self, dataset: Dataset) -> bytes:
+        buffer = self._new_buffer()
+        write_dataset(buffer, dataset)
+        return buffer.getvalue()
+
+    def _encode_element(self, element: DataElement) -> bytes:
+        buffer = self._new_buffer()
+        write_data_element(buffer, element)
+        return buffer.getvalue()
+
+    def write(
+        self,
+        fp: BinaryIO,
+        slice_elements: Dataset,
+        img: Union[array, InterfileVolume],
+    ) -> None:
+        """
+            Writes one slice (or all frames of a multi-frame dataset) as a Part 10 file
+
+            Arguments:
+            fp - binary file object to write to
+            slice_elements - dataset created by create_slice_elements
+            img - 2D image of the slice, or 3D volume written frame by frame
+        """
+        fp.write(self.file_meta)
+
+        out = fp
+        if self.transfer_syntax == DeflatedExplicitVRLittleEndian:
+            # Everything after the file meta information is deflated
+            out = DeflateWriter(fp)
+
+        for segment, tag in zip(self.segments, self.slice_tags):
+            out.write(segment)
+            out.write(self._encode_element(slice_elements[tag]))
+        out.write(self.segments[-2])
+
+        frames = [img] if len(img.shape) == 2 else (img[i] for i in range(img.shape[0]))
+
+        if self.transfer_syntax == RLELossless:
+            encapsulated = encapsulate([rle_encode_frame(frame, self.columns) for frame in frames])
+            # Undefined length, fragments are followed by a sequence delimiter
+            out.write(struct.pack('<HH2sHL', 0x7FE0, 0x0010, b'OB', 0, 0xFFFFFFFF))
+            out.write(encapsulated)
+            out.write(struct.pack('<HHL', 0xFFFE, 0xE0DD, 0))
+        else:
+            nbytes = int(np.prod(img.shape)) * img.dtype.itemsize
+            # Pixel data element header: tag, VR, 2 reserved bytes and 4 bytes length
+            out.write(struct.pack(
+                '<HH2sHL', self.pixel_tag.group, self.pixel_tag.element, self.pixel_vr, 0, nbytes + nbytes % 2
+            ))
+            for frame in frames:
+                self._write_frame(out, frame)
+            if nbytes % 2:
+                out.write(b'\x00')
+
+        out.write(self.segments[-1])
+
+        if out is not fp:
+            out.close()
+
+    @staticmethod
+    def _write_frame(fp: BinaryIO, frame: array) -> None:
+        if frame.dtype.byteorder == '>':
+            frame = frame.astype(frame.dtype.newbyteorder('<'))
+
+        if frame.flags.c_contiguous:
+            fp.write(memoryview(frame))
+        else:
+            # e.g. flipped slice of read_binary output, rows are still contiguous
+            for row in frame:
+                fp.write(memoryview(np.ascontiguousarray(row)))
+
+def slice_file_path(output_path: Path, slice_number: int) -> str:
+    """
+        Returns path of the slice file: {output_path}/{output directory name}_{slice_number}.dcm
+    """
+    base_name = output_path.parts[-1]
+    return f'{str(output_path)}/{base_name}_{slice_number}.dcm'
+
+def encode_slice(
+    img_slice: array,
+    slice_number: int,
+    template: Dataset,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    encoder: Optional[StreamEncoder]=None,
+) -> bytes:
+    """
+        Creates dicom dataset for one slice and encodes it as a Part 10 file in
+        memory, for the pipelined writer and iter_dicom (write_slice writes
+        straight into the file)
+
+        Arguments:
+        img_slice - 2D image of the slice
+        slice_number - index of the slice in the volume
+        template - dataset created by create_series_template
+        metadata - additional meta data (patient center)
+        encoder - StreamEncoder of the series, if None Dataset.save_as is used
+
+        Returns:
+        - content of the file
+    """
+    buffer = BytesIO()
+
+    if encoder is not None:
+        with profile_stage('encode', img_slice.nbytes):
+            encoder.write(buffer, create_slice_elements(template, metadata, slice_number), img_slice)
+        return buffer.getvalue()
+
+    with profile_stage('dataset_build', img_slice.nbytes):
+        ds = create_slice_from_template(template, img_slice, metadata, slice_number)
+
+    with profile_stage('encode', img_slice.nbytes):
+        ds.fix_meta_info()
+        ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+def write_file(file_path: str, data: bytes) -> None:
+    with profile_stage('write', len(data)), open(file_path, 'wb') as fp:
+        fp.write(data)
+
+def write_slice(
+    img_slice: array,
+    slice_number: int,
+    template: Dataset,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    output_path: Path,
+    encoder: Optional[StreamEncoder]=None,
+) -> None:
+    """
+        Creates dicom dataset for one slice and saves it in output_path
+
+        Arguments:
+        img_slice - 2D image of the slice
+        slice_number - index of the slice in the volume
+        template - dataset created by create_series_template
+        metadata - additional meta data (patient center)
+        output_path - directory to save output
+        encoder - StreamEncoder of the series, if None Dataset.save_as is used
+    """
+    file_path = slice_file_path(output_path, slice_number)
+
+    # Encoded straight into the file, without a copy of the whole file in memory
+    if encoder is not None:
+        with profile_stage('write', img_slice.nbytes), open(file_path, 'wb') as fp:
+            encoder.write(fp, create_slice_elements(template, metadata, slice_number), img_slice)
+        return
+
+    with profile_stage('dataset_build', img_slice.nbytes):
+        ds = create_slice_from_template(template, img_slice, metadata, slice_number)
+
+    with profile_stage('write', img_slice.nbytes):
+        ds.fix_meta_info()
+        ds.save_as(file_path, write_like_original=False)
+
+def _write_slices_pipelined(
+    binary_img: Union[array, InterfileVolume],
+    slice_kwargs: Dict,
+    queue_size: int,
+) -> None:
+    """
+        Writes slices with overlapped reading, encoding and writing (see run_pipeline).
+        A lazy volume is read and quantized in the reader thread.
+    """
+    output_path = slice_kwargs['output_path']
+    encode_kwargs = {key: slice_kwargs[key] for key in ('template', 'metadata', 'encoder')}
+
+    # A volume observed for derived outputs (derived._ObservedVolume) wraps the lazy volume
+    lazy = isinstance(getattr(binary_img, 'volume', binary_img), InterfileVolume)
+
+    def read_slices():
+        for i in range(binary_img.shape[0]):
+            img_slice = binary_img[i, :, :]
+            if lazy:
+                # Pages of the memory-mapped file are read here, not in the encoder
+                img_slice = np.ascontiguousarray(img_slice)
+            yield i, img_slice
+
+    def encode(item: Tuple[int, array]) -> Tuple[str, bytes]:
+        slice_number, img_slice = item
+        return (
+            slice_file_path(output_path, slice_number),
+            encode_slice(img_slice, slice_number, **encode_kwargs),
+        )
+
+    run_pipeline(
+        read_slices(),
+        [(encode, 1), (lambda item: write_file(*item), 1)],
+        queue_size=queue_size,
+    )
+
+# State of a slice writing worker process, set up once by _init_slice_worker
+_SLICE_WORKER = {}
+
+def _init_slice_worker(volume, shape, dtype, slice_kwargs) -> None:
+    if isinstance(volume, InterfileVolume):
+        # Memory-mapped volume, each worker maps the same image file
+        _SLICE_WORKER['volume'] = volume
+    else:
+        # Volume shared by the parent process
+        _SLICE_WORKER['volume'] = np.frombuffer(volume, dtype=dtype).reshape(shape)
+    _SLICE_WORKER['kwargs'] = slice_kwargs
+
+def _write_slice_in_worker(slice_number: int) -> None:
+    write_slice(
+        _SLICE_WORKER['volume'][slice_number, :, :].squeeze(),
+        slice_number,
+        **_SLICE_WORKER['kwargs']
+    )
+
+def _write_slices_parallel(
+    binary_img: Union[array, InterfileVolume],
+    workers: int,
+    slice_kwargs: Dict,
+) -> None:
+    """
+        Writes all slices of the volume using a pool of worker processes.
+        Pixel data is handed over through shared memory, not pickled per slice.
+    """
+    number_of_slices = binary_img.shape[0]
+
+    if isinstance(binary_img, InterfileVolume):
+        volume = binary_img
+    else:
+        volume = RawArray('B', binary_img.nbytes)
+        np.frombuffer(volume, dtype=binary_img.dtype).reshape(binary_img.shape)[:] = binary_img
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_slice_worker,
+        initargs=(volume, binary_img.shape, binary_img.dtype, slice_kwargs),
+    ) as executor:
+        chunksize = max(1, number_of_slices // (4*workers))
+        # Consume results, so exceptions from workers are raised here
+        for _ in executor.map(
+            _write_slice_in_worker, range(number_of_slices), chunksize=chunksize
+        ):
+            pass
+
+class EncodedDicom(NamedTuple):
+    """Encoded Part 10 object (or its dataset) and its file name as write_dicom would save it"""
+    name: str
+    data: Union[bytes, BinaryIO, Dataset]
+
+
+def _check_backend(backend: str) -> None:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}, use one of {BACKENDS}")
+
+def _prepare_series(
+    interfile_data: InterfileHeader,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    lazy: bool,
+    compression: Optional[str],
+    series_attributes: Optional[Dict],
+    per_slice_rescale: bool=False,
+    memory_budget: Optional[MemoryBudget]=None,
+    slices_in_flight: int=1,
+    float_pixel_data: bool=False,
+    extended_format: bool=False,
+    backend: str='pydicom',
+) -> Tuple[Union[array, InterfileVolume], Dataset, str]:
+    """
+        Reads the image and builds the series template with generated UIDs.
+        With a memory budget, memory of `slices_in_flight` slices being encoded
+        is reserved besides the slabs. Float Pixel Data is used only for float images.
+
+        Returns:
+        - image (or InterfileVolume)
+        - template dataset of the series
+        - backend to encode with: multi-frame objects are written with the
+          stream backend within a memory budget, so that the image is never
+          stacked at once
+    """
+    if memory_budget is not None and extended_format and backend != 'stream':
+        LOGGER.info('Writing frames with the stream backend to stay within the memory budget')
+        backend = 'stream'
+
+    float_pixel_data = float_pixel_data and 'float' in interfile_data.number_format
+    if float_pixel_data and compression == 'rle':
+        raise ValueError("Float Pixel Data can not be compressed with RLE Lossless")
+
+    itemsize = interfile_data.bytes_per_pixel if float_pixel_data else np.dtype(np.uint16).itemsize
+    slice_bytes = interfile_data.matrix_size_2*interfile_data.matrix_size_1*itemsize
+    binary_img, rescale_slope, rescale_intercept, byte_order_local = read_binary(
+        interfile_data, lazy=lazy, per_slice_rescale=per_slice_rescale, memory_budget=memory_budget,
+        reserved_bytes=ENCODE_COPIES*slices_in_flight*slice_bytes, float_pixel_data=float_pixel_data,
+    )
+
+    # Generate random UUIDs
+    series = {
+        'SOPInstanceUID': rand_uid(),
+        'SOPClassUID': rand_uid(),
+        'StudyInstanceUID': rand_uid(),
+        'SeriesInstanceUID': rand_uid(),
+        'FrameOfReferenceUID': rand_uid(),
+        'StudyDate': datetime.today().strftime("%Y%m%d"),
+        'StudyTime': datetime.today().strftime("%H%M%S.%f"),
+    }
+    series.update(series_attributes or {})
+
+    with profile_stage('dataset_build'):
+        template = create_series_template(
+            interfile_data=interfile_data,
+            metadata=metadata,
+            img_shape=binary_img.shape,
+            rescale_slope=rescale_slope,
+            rescale_intercept=rescale_intercept,
+            byte_order_local=byte_order_local,
+            series=series,
+            compression=compression,
+            float_pixel_data=float_pixel_data,
+        )
+
+    return binary_img, template, backend
+
+def _slice_encoder(
+    template: Dataset,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    backend: str,
+) -> Optional[StreamEncoder]:
+    if backend != 'stream':
+        return None
+    slice_tags = create_slice_elements(template, metadata, 0).keys()
+    return StreamEncoder(template, list(slice_tags))
+
+def _write_multiframe(
+    fp: BinaryIO,
+    template: Dataset,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    binary_img: Union[array, InterfileVolume],
+    backend: str,
+) -> None:
+    """
+        Encodes the whole image as one multi-frame Part 10 file into fp
+    """
+    nbytes = int(np.prod(binary_img.shape)) * binary_img.dtype.itemsize
+
+    with profile_stage('dataset_build'):
+        ds = create_multiframe_dataset(template, metadata)
+
+    if backend == 'stream':
+        # Frames are written one after another, a lazy volume is never loaded at once
+        with profile_stage('encode', nbytes):
+            StreamEncoder(ds, []).write(fp, Dataset(), binary_img)
+    else:
+        with profile_stage('dataset_build', nbytes):
+            set_pixel_data(ds, binary_img)
+
+        with profile_stage('encode', nbytes):
+            ds.fix_meta_info()
+            ds.save_as(fp, write_like_original=False)
+
 def write_dicom(
     interfile_data: InterfileHeader,
     metadata: Union[CTMetaFile, PETMetaFile],
     output_path: Path,
-    extended_format: bool
+    extended_format: bool,
+    lazy: bool=False,
+    workers: int=1,
+    backend: str='pydicom',
+    compression: Optional[str]=None,
+    series_attributes: Optional[Dict]=None,
+    pipeline: bool=False,
+    queue_size: int=QUEUE_SIZE,
+    per_slice_rescale: bool=False,
+    memory_budget: Optional[MemoryBudget]=None,
+    float_pixel_data: bool=False,
+    derived: Optional[DerivedOutputs]=None,
 ) -> None:
     """
         Writing a dicom file
@@ -213,101 +1041,462 @@ def write_dicom(
         Arguments:
         interfile_data - header arguments object
         metadata - additional meta data to add
-        output_path - path to save output
-        extended_format - should we use extended format (for 3D data)
+        output_path - path to save output (directory, or file with extended format)
+        extended_format - write one Enhanced PET/CT multi-frame file instead of slices
+        lazy - memory-map the image file and read it slice by slice
+        workers - number of processes writing slices (only without extended format)
+        backend - 'pydicom' (Dataset.save_as) or 'stream' (StreamEncoder)
+        compression - None (Explicit VR Little Endian), 'rle' (RLE Lossless) or
+            'deflate' (Deflated Explicit VR Little Endian); slices are compressed
+            by the worker processes
+        series_attributes - attributes overriding the generated series attributes
+            and the metadata (e.g. study UIDs shared by frames of a dynamic image)
+        pipeline - read, encode and write slices in separate threads (only without
+            extended format), so that disk I/O overlaps with encoding
+        queue_size - number of slices waiting between pipeline stages
+        per_slice_rescale - quantize every slice of a float image with its own
+            RescaleSlope and RescaleIntercept (see read_binary)
+        memory_budget - memory.MemoryBudget: the image is read, quantized and
+            written slab by slab within the budget, MemoryBudgetExceeded is
+            raised if the resident set size goes over it (implies lazy)
+        float_pixel_data - write float images as Float Pixel Data without
+            quantization (RescaleSlope 1, RescaleIntercept 0); with lazy and the
+            stream backend voxels are written straight from the mapped file
+        derived - derived.DerivedOutputs: MIPs and a preview of the volume are
+            computed from the slices being converted and written as PNG or
+            Secondary Capture files, the image is not read again
     """
-    binary_img, rescale_slope, rescale_intercept, byte_order_local = read_binary(interfile_data)
+    _check_backend(backend)
+    if pipeline and workers > 1:
+        raise ValueError("Pipeline can not be combined with worker processes")
+    if memory_budget is not None and workers > 1:
+        raise ValueError("Memory budget can not be combined with worker processes")
+
+    # Slices queued between pipeline stages, plus one in every stage
+    slices_in_flight = 2*queue_size + 3 if pipeline and not extended_format else 1
+    binary_img, template, backend = _prepare_series(
+        interfile_data, metadata, lazy, compression, series_attributes, per_slice_rescale,
+        memory_budget, slices_in_flight, float_pixel_data, extended_format, backend,
+    )
+
+    projections = None
+    if derived is not None:
+        projections = derived.series(template, binary_img.shape)
+        if isinstance(binary_img, np.ndarray) or workers > 1:
+            # Vectorized over blocks of the image in memory, or of the mapped
+            # file before worker processes read it from the page cache
+            with profile_stage('derived'):
+                for block in _blocks(binary_img):
+                    projections.update(block.start, np.asarray(binary_img[block]))
+        else:
+            # Slices of a lazy volume are projected when they are read for writing
+            binary_img = projections.observe(binary_img)
 
     if not extended_format:
         if not os.path.isdir(output_path):
             os.makedirs(output_path)
 
-        base_name = output_path.parts[-1]
+        number_of_slices = binary_img.shape[0]
+
+        slice_kwargs = dict(
+            template=template,
+            metadata=metadata,
+            output_path=output_path,
+            encoder=_slice_encoder(template, metadata, backend),
+        )
 
-        # Generate random UUIDs
-        SOPInstanceUID = rand_uid()
-        SOPClassUID = rand_uid()
-        StudyInstanceUID = rand_uid()
-        SeriesInstanceUID = rand_uid()
-        FrameOfReferenceUID = rand_uid()
+        if workers > 1 and number_of_slices > 1:
+            _write_slices_parallel(binary_img, min(workers, number_of_slices), slice_kwargs)
+        elif pipeline:
+            _write_slices_pipelined(binary_img, slice_kwargs, queue_size)
+        else:
+            for i in range(number_of_slices):
+                write_slice(binary_img[i, :, :].squeeze(), i, **slice_kwargs)
 
-        study_time = datetime.today().strftime("%H%M%S.%f")
+    else:
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
 
-        number_of_slices = binary_img.shape[0]
-        for i in range(number_of_slices):
-            img_slice = binary_img[i, :, :].squeeze()
-            ds = create_slice_dataset(
-                interfile_data=interfile_data,
-                binary_img=img_slice,
-                metadata=metadata,
-                extended_format=extended_format,
-                slice_number=i,
-                number_of_slices=number_of_slices
-            )
-
-            ds.InstanceNumber = str(i+1)
-            ds.NumberOfSlices = number_of_slices
-
-            if ds.Modality == "PT":
-                ds.ImageIndex = i+1
-
-            ds.RescaleSlope = rescale_slope
-            ds.RescaleIntercept = rescale_intercept
-
-            if rescale_slope != 1:
-                ds.BitsAllocated = 16
-                ds.BitsStored = 16
-                ds.HighBit = 15
-                ds.PixelRepresentation = 0 # unsigned int
-            else:
-                ds.BitsAllocated = 8*interfile_data.bytes_per_pixel
-                ds.BitsStored = 8*interfile_data.bytes_per_pixel
-                ds.HighBit = 8*interfile_data.bytes_per_pixel - 1
-                if "unsigned" in interfile_data.number_format:
-                    ds.PixelRepresentation = 0 # unsigned int
-                else:
-                    ds.PixelRepresentation = 1 # signed int
-
-            # Only monochromatic images (one channel per pixel)
-            ds.SamplesPerPixel = 1
-
-            ds.StudyDate = datetime.today().strftime("%Y%m%d")
-            ds.StudyTime = study_time
-
-            # Assing folder level UUIDs and other data
-            ds.SOPInstanceUID = SOPInstanceUID
-            ds.SOPClassUID = SOPClassUID
-            ds.StudyInstanceUID = StudyInstanceUID
-            ds.SeriesInstanceUID = SeriesInstanceUID
-            ds.FrameOfReferenceUID = FrameOfReferenceUID
-
-            # TODO: Implement our own Implementation Class UID
-
-            # Set most common options (most common encoding)
-            ds.is_little_endian = '<' in byte_order_local
-            ds.is_implicit_VR = False
+        with open(output_path, 'wb') as fp:
+            _write_multiframe(fp, template, metadata, binary_img, backend)
 
-            ds.fix_meta_info()
+    if projections is not None:
+        with profile_stage('derived'):
+            name = Path(output_path).stem if extended_format else Path(output_path).name
+            derived.write(projections, template, name)
 
-            # Save file
-            ds.save_as(f'{str(output_path)}/{base_name}_{i}.dcm', write_like_original=False)
+    if memory_budget is not None:
+        memory_budget.check()
 
-    # TODO: Fix it!
+    LOGGER.info('Writing completed!')
+
+def iter_dicom(
+    interfile_data: InterfileHeader,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    name: str,
+    extended_format: bool=False,
+    lazy: bool=False,
+    backend: str='pydicom',
+    compression: Optional[str]=None,
+    series_attributes: Optional[Dict]=None,
+    as_buffer: bool=False,
+    skip: Optional[Callable[[str], bool]]=None,
+    per_slice_rescale: bool=False,
+    memory_budget: Optional[MemoryBudget]=None,
+    float_pixel_data: bool=False,
+    as_dataset: bool=False,
+) -> Iterator[EncodedDicom]:
+    """
+        Encodes dicom files in memory, nothing is written to disk.
+        Slices are encoded one at a time, when the caller asks for the next one.
+
+        Arguments:
+        interfile_data - header arguments object
+        metadata - additional meta data to add
+        name - base of file names (name of the output directory in write_dicom)
+        extended_format, lazy, backend, compression, series_attributes,
+            per_slice_rescale, memory_budget, float_pixel_data - as in write_dicom (encoded files
+            are held by the caller, they are not counted in the budget)
+        as_buffer - yield file-like BytesIO buffers instead of bytes
+        skip - called with every file name, files for which it returns True
+            are not encoded (the image is not read at all if all files are skipped)
+        as_dataset - yield datasets with pixel data instead of encoding them
+            (e.g. for store.StoreSink, which encodes them for the network); the
+            backend is not used
+
+        Returns:
+        - generator of EncodedDicom: `{name}_{slice}.dcm` slices, or one
+          `{name}.dcm` multi-frame object with extended format
+    """
+    _check_backend(backend)
+
+    if extended_format:
+        names = [f'{name}.dcm']
     else:
-        ds = create_slice_dataset(
-            interfile_data=interfile_data,
-            binary_img=binary_img,
-            metadata=metadata,
+        names = [f'{name}_{i}.dcm' for i in range(interfile_data.matrix_size_3)]
+    if skip is not None:
+        skipped = {file_name for file_name in names if skip(file_name)}
+        if len(skipped) == len(names):
+            return
+    else:
+        skipped = set()
+
+    binary_img, template, backend = _prepare_series(
+        interfile_data, metadata, lazy, compression, series_attributes, per_slice_rescale,
+        memory_budget, float_pixel_data=float_pixel_data, extended_format=extended_format,
+        backend=backend,
+    )
+
+    def encoded(file_name: str, data: bytes) -> EncodedDicom:
+        return EncodedDicom(file_name, BytesIO(data) if as_buffer else data)
+
+    if as_dataset and extended_format:
+        nbytes = int(np.prod(binary_img.shape)) * binary_img.dtype.itemsize
+        with profile_stage('dataset_build', nbytes):
+            ds = set_pixel_data(create_multiframe_dataset(template, metadata), binary_img)
+        yield EncodedDicom(f'{name}.dcm', ds)
+        return
+
+    if as_dataset:
+        for i, file_name in enumerate(names):
+            if file_name in skipped:
+                continue
+            img_slice = binary_img[i, :, :].squeeze()
+            with profile_stage('dataset_build', img_slice.nbytes):
+                ds = create_slice_from_template(template, img_slice, metadata, i)
+            yield EncodedDicom(file_name, ds)
+        return
+
+    if extended_format:
+        buffer = BytesIO()
+        _write_multiframe(buffer, template, metadata, binary_img, backend)
+        buffer.seek(0)
+        yield EncodedDicom(f'{name}.dcm', buffer if as_buffer else buffer.getvalue())
+        return
+
+    encoder = _slice_encoder(template, metadata, backend)
+    for i, file_name in enumerate(names):
+        if file_name in skipped:
+            continue
+        yield encoded(
+            file_name,
+            encode_slice(binary_img[i, :, :].squeeze(), i, template, metadata, encoder),
+        )
+
+def store_dicom(
+    interfile_data: InterfileHeader,
+    metadata: Union[CTMetaFile, PETMetaFile],
+    sink: StoreSink,
+    extended_format: bool=False,
+    **encode_kwargs,
+) -> List[SeriesStats]:
+    """
+        Sends dicom files to a Storage SCP instead of writing them.
+        Slices are encoded while previous ones are being stored.
+
+        Arguments:
+        interfile_data - header arguments object
+        metadata - additional meta data to add
+        sink - store.StoreSink connected to the SCP
+        extended_format - send one multi-frame object instead of slices
+        encode_kwargs - passed to iter_dicom (lazy, compression, series_attributes)
+
+        Returns:
+        - sending statistics of the series
+    """
+    # Datasets are sent as they are built, they are encoded only once, for the network
+    return sink.send(iter_dicom(
+        interfile_data, metadata, name='slice', extended_format=extended_format,
+        as_dataset=True, **encode_kwargs
+    ), prepare=storage_identity)
+
+def storage_identity(ds: Dataset) -> None:
+    """
+        Gives a slice a PET (or CT) Image Storage SOP class and its own SOP
+        instance UID, derived from the shared one and the instance number, so
+        that a Storage SCP accepts it and keeps every slice of the series.
+        Multi-frame datasets already have an Enhanced Image Storage SOP class.
+    """
+    if 'NumberOfFrames' not in ds:
+        # New elements, those of a slice built from a template are shared with it
+        ds.add_new('SOPClassUID', 'UI', STORAGE_SOP_CLASSES[ds.Modality])
+        ds.add_new('SOPInstanceUID', 'UI', seeded_uid(ds.SOPInstanceUID, ds.InstanceNumber))
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+def frame_attributes(
+    frame: InterfileHeader,
+    frame_number: int,
+    frames_number: int,
+) -> Dict:
+    """
+        Returns series attributes of one time frame (or gate) of a dynamic image
+
+        Arguments:
+        frame - header of the frame
+        frame_number - number of the frame, starting from 1
+        frames_number - number of frames of the image
+
+        Returns:
+        - dictionary of attributes, timing is given in milliseconds
+    """
+    attributes = {'SeriesNumber': frame_number}
+
+    if frame.modality == 'PT':
+        attributes['SeriesType'] = ['GATED' if frame.gated else 'DYNAMIC', 'IMAGE']
+        if frame.gated:
+            attributes['NumberOfTimeSlots'] = frames_number
+        else:
+            attributes['NumberOfTimeSlices'] = frames_number
+
+    if frame.frame_start_times:
+        attributes['FrameReferenceTime'] = round(1000*frame.frame_start_times[0], 3)
+    if frame.frame_durations:
+        attributes['ActualFrameDuration'] = round(1000*frame.frame_durations[0])
+
+    return attributes
+
+def dynamic_series(frames: Iterable[InterfileHeader]) -> Iterator[Tuple[int, InterfileHeader, Dict]]:
+    """
+        Pairs frames of a dynamic (or gated) image with their series attributes.
+        All series share the study and frame of reference.
+
+        Arguments:
+        frames - frame headers, e.g. from reader.iter_interfile_frames
+
+        Returns:
+        - generator of (frame number starting from 1, frame header, series attributes)
+    """
+    frames = list(frames)
+
+    study = {
+        'StudyInstanceUID': rand_uid(),
+        'FrameOfReferenceUID': rand_uid(),
+        'StudyDate': datetime.today().strftime("%Y%m%d"),
+        'StudyTime': datetime.today().strftime("%H%M%S.%f"),
+    }
+
+    for frame_number, frame in enumerate(frames, start=1):
+        series_attributes = dict(study)
+        series_attributes.update(frame_attributes(frame, frame_number, len(frames)))
+        yield frame_number, frame, series_attributes
+
+def write_dynamic(
+    frames: Iterable[InterfileHeader],
+    metadata: Union[CTMetaFile, PETMetaFile],
+    output_path: Path,
+    extended_format: bool,
+    **write_kwargs,
+) -> None:
+    """
+        Writing a dynamic (or gated) image, one series per time frame.
+        Frames are read and written one after another, so only one frame
+        is held in memory at a time. All series share the study and frame of reference.
+
+        Arguments:
+        frames - frame headers, e.g. from reader.iter_interfile_frames
+        metadata - additional meta data to add
+        output_path - directory where frames are saved (`frame_<n>` directories,
+            or `frame_<n>.dcm` files with extended format)
+        extended_format - write every frame as one multi-frame file
+        write_kwargs - passed to write_dicom
+    """
+    frames = list(frames)
+
+    for frame_number, frame, series_attributes in dynamic_series(frames):
+        LOGGER.info('Writing frame %d of %d', frame_number, len(frames))
+
+        write_dicom(
+            frame,
+            metadata,
+            output_path=Path(output_path) / f'frame_{frame_number}{".dcm" if extended_format else ""}',
             extended_format=extended_format,
+            series_attributes=series_attributes,
+            **write_kwargs,
         )
 
-        # Set most common options (most common encoding)
-        ds.is_little_endian = True if '<' in byte_order_local else False
-        ds.is_implicit_VR = False
+def iter_frames_dicom(
+    frames: SequenceType[InterfileHeader],
+    metadata: Union[CTMetaFile, PETMetaFile],
+    name: str,
+    extended_format: bool=False,
+    **encode_kwargs,
+) -> Iterator[EncodedDicom]:
+    """
+        Encodes a static or dynamic image in memory, see iter_dicom
 
-        ds.fix_meta_info()
+        Arguments:
+        frames - frame headers, e.g. from reader.iter_interfile_frames
+        metadata - additional meta data to add
+        name - base of file names of a static image
+        extended_format - one multi-frame object per frame instead of slices
+        encode_kwargs - passed to iter_dicom
 
-        # Save file
-        ds.save_as(str(output_path), write_like_original=False)
+        Returns:
+        - generator of EncodedDicom, names are paths relative to the output of
+          write_dicom (static image) or write_dynamic (`frame_<n>/` prefix)
+    """
+    if len(frames) == 1:
+        yield from iter_dicom(
+            frames[0], metadata, name=name, extended_format=extended_format, **encode_kwargs
+        )
+        return
+
+    for frame_number, frame, series_attributes in dynamic_series(frames):
+        frame_name = f'frame_{frame_number}'
+        prefix = '' if extended_format else f'{frame_name}/'
+        for encoded in iter_dicom(
+            frame, metadata, name=frame_name, extended_format=extended_format,
+            series_attributes=series_attributes, **encode_kwargs
+        ):
+            yield EncodedDicom(prefix + encoded.name, encoded.data)
+
+def archive_format(output_path: Path) -> Optional[str]:
+    """
+        Returns archive format ('zip', 'tar' or 'tar.gz') chosen by the output suffix,
+        None if the output is not an archive
+    """
+    name = Path(output_path).name.lower()
+    for suffix, archive in ARCHIVE_SUFFIXES.items():
+        if name.endswith(suffix):
+            return archive
+    return None
 
-    LOGGER.info('Writing completed!')
+def archive_stem(output_path: Path) -> str:
+    """
+        Returns the output file name without the archive suffix
+    """
+    name = Path(output_path).name
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def write_archive(
+    encoded: Iterable[EncodedDicom],
+    output_path: Path,
+    deflate: bool=False,
+) -> int:
+    """
+        Writes encoded dicom files straight into a zip or tar archive,
+        each file is added as soon as it is encoded (no intermediate files).
+        A partially written archive is removed if encoding fails.
+
+        Arguments:
+        encoded - EncodedDicom objects, e.g. from iter_frames_dicom
+        output_path - archive file, its suffix (.zip, .tar, .tar.gz, .tgz) sets the format
+        deflate - deflate zip members; .tar.gz and .tgz archives are always compressed
+            (gzip), plain .tar archives only with deflate
+
+        Returns:
+        - number of files in the archive
+    """
+    archive = archive_format(output_path)
+    if archive is None:
+        raise ValueError(f'Unknown archive suffix: {output_path}, use one of {tuple(ARCHIVE_SUFFIXES)}')
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    date_time = datetime.now().timetuple()[:6]
+    files = 0
+
+    try:
+        if archive == 'zip':
+            compress_type = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+            with zipfile.ZipFile(output_path, 'w', compression=compress_type) as zf:
+                for name, data in encoded:
+                    data = data if isinstance(data, bytes) else data.read()
+                    info = zipfile.ZipInfo(name, date_time=date_time)
+                    info.compress_type = compress_type
+                    with profile_stage('write', len(data)):
+                        zf.writestr(info, data)
+                    files += 1
+        else:
+            mode = 'w:gz' if deflate or archive == 'tar.gz' else 'w'
+            with tarfile.open(output_path, mode) as tf:
+                for name, data in encoded:
+                    fp = BytesIO(data) if isinstance(data, bytes) else data
+                    info = tarfile.TarInfo(name)
+                    info.size = fp.seek(0, 2)
+                    info.mtime = time.time()
+                    fp.seek(0)
+                    with profile_stage('write', info.size):
+                        tf.addfile(info, fp)
+                    files += 1
+    except BaseException:
+        output_path.unlink(missing_ok=True)
+        raise
+
+    LOGGER.info('Written %d files to %s', files, output_path)
+    return files
+
+def write_frames(
+    frames: SequenceType[InterfileHeader],
+    metadata: Union[CTMetaFile, PETMetaFile],
+    output_path: Path,
+    extended_format: bool,
+    archive_deflate: bool=False,
+    **write_kwargs,
+) -> None:
+    """
+        Writes a static or dynamic image; outputs with an archive suffix
+        (.zip, .tar, .tar.gz, .tgz) are written as archives
+
+        Arguments:
+        frames - frame headers, e.g. from reader.iter_interfile_frames
+        metadata - additional meta data to add
+        output_path - output directory, file or archive
+        extended_format - write multi-frame files instead of slices
+        archive_deflate - compress archive members (see write_archive)
+        write_kwargs - passed to write_dicom (only ENCODE_ARGUMENTS for archives)
+    """
+    if archive_format(output_path) is not None:
+        encode_kwargs = {key: write_kwargs[key] for key in ENCODE_ARGUMENTS if key in write_kwargs}
+        encoded = iter_frames_dicom(
+            frames, metadata, name=archive_stem(output_path), extended_format=extended_format,
+            **encode_kwargs
+        )
+        write_archive(encoded, output_path, deflate=archive_deflate)
+    elif len(frames) > 1:
+        write_dynamic(frames, metadata, output_path, extended_format, **write_kwargs)
+    else:
+        write_dicom(frames[0], metadata, output_path, extended_format, **write_kwargs)
@@ -2,10 +2,26 @@
 #Author: Mateusz Kruk, Rafal Mozdzonek
 
 import argparse
+import json
 import logging
 from pathlib import Path
+import signal
+import sys
+import threading
+from typing import Callable, Dict, Iterator, Optional
 
+import converter.batch as batch
+from converter.inspection import HISTOGRAM_BINS, SAMPLE_VOXELS, format_report, inspect_interfile
+from converter.claims import DEFAULT_CLAIM_TTL, WorkClaims
+from converter.manifest import convert_resumable
+from converter.compression import COMPRESSIONS
+from converter.derived import DERIVED_FORMATS, DerivedOutputs
+from converter.memory import MemoryBudget, parse_size
+from converter.profiling import profiling
 import converter.reader as rd
+from converter.reverse import dicom_to_interfile
+from converter.store import DEFAULT_AE_TITLE, DEFAULT_CALLED_AE_TITLE, StoreSink, parse_address
+import converter.watch as watch
 import converter.writer as wr
 
 LOGGER = logging.getLogger(__name__)
@@ -18,11 +34,32 @@ def convert_intefile_to_dicom(
     meta_path: str,
     output=None,
     directory=None,
-    extended_format=False
-) -> None:
+    extended_format=False,
+    lazy=False,
+    workers=1,
+    backend='pydicom',
+    compression=None,
+    pipeline=False,
+    archive_deflate=False,
+    resume=False,
+    per_slice_rescale=False,
+    max_memory=None,
+    float_pixel_data=False,
+    derived=None,
+) -> Optional[Dict]:
+    """
+        Converts Interfile to DICOM files (or an archive)
+
+        With max_memory (bytes) the image is converted slab by slab within the
+        budget and the memory report (budget, peak resident set size, slab size)
+        is returned. With derived (derived.DerivedOutputs) MIPs and a preview are
+        written in the same pass (not for archives and resumed conversions).
+    """
     p = Path(input_path)
-    header_obj = rd.interfile_header_import(p)
-    metadata = rd.read_json_meta(Path(meta_path), header_obj.modality)
+    # Headers of all time frames, a static image has a single frame
+    frames = list(rd.iter_interfile_frames(p))
+    dynamic = len(frames) > 1
+    metadata = rd.read_json_meta(Path(meta_path), frames[0].modality)
 
     if directory is not None:
         output_path = directory + '/'
@@ -32,18 +69,286 @@ def convert_intefile_to_dicom(
     if output is not None:
         output_path += output
     else:
-        output_path += input_path.split('/')[-1].replace(
-            '.hdr', '.dcm' if extended_format else ''
-        )
+        # Dynamic images are saved to a directory with a series per frame
+        output_path += p.stem + ('.dcm' if extended_format and not dynamic else '')
 
-    wr.write_dicom(
-        header_obj,
+    write_kwargs = dict(
+        extended_format=extended_format,
+        lazy=lazy,
+        workers=workers,
+        backend=backend,
+        compression=compression,
+        pipeline=pipeline,
+        archive_deflate=archive_deflate,
+        per_slice_rescale=per_slice_rescale,
+        float_pixel_data=float_pixel_data,
+    )
+    if derived is not None:
+        write_kwargs['derived'] = derived
+    budget = None
+    if max_memory is not None:
+        budget = write_kwargs['memory_budget'] = MemoryBudget(max_memory)
+
+    if resume:
+        # Completed files recorded in the manifest next to the output are skipped
+        convert_resumable(p, frames, Path(meta_path), metadata, Path(output_path), **write_kwargs)
+    else:
+        # Outputs with an archive suffix (.zip, .tar, .tar.gz) are written as archives
+        wr.write_frames(frames, metadata, output_path=Path(output_path), **write_kwargs)
+
+    return budget.report() if budget is not None else None
+
+def iter_interfile_to_dicom(
+    input_path: str,
+    meta_path: str,
+    extended_format=False,
+    as_buffer=False,
+    lazy=False,
+    backend='pydicom',
+    compression=None,
+    per_slice_rescale=False,
+    max_memory=None,
+    float_pixel_data=False,
+    as_dataset=False,
+) -> Iterator[wr.EncodedDicom]:
+    """
+        Converts Interfile to DICOM in memory, e.g. to send or archive it without temporary files
+
+        Arguments:
+        input_path - Interfile header
+        meta_path - metadata JSON
+        extended_format - one multi-frame object instead of slices
+        as_buffer - yield file-like buffers instead of bytes
+        as_dataset - yield datasets instead of encoded files (see writer.iter_dicom)
+        lazy, backend, compression, per_slice_rescale, max_memory, float_pixel_data - as in
+            convert_intefile_to_dicom (encoded files held by the caller are not
+            counted in the budget)
+
+        Returns:
+        - generator of (name, data); names are paths relative to the output
+          of convert_intefile_to_dicom (`frame_<n>/` prefix for dynamic images)
+    """
+    p = Path(input_path)
+    frames = list(rd.iter_interfile_frames(p))
+    metadata = rd.read_json_meta(Path(meta_path), frames[0].modality)
+
+    yield from wr.iter_frames_dicom(
+        frames,
         metadata,
-        output_path=Path(output_path),
-        extended_format=extended_format
+        name=p.stem,
+        extended_format=extended_format,
+        lazy=lazy,
+        backend=backend,
+        compression=compression,
+        as_buffer=as_buffer,
+        per_slice_rescale=per_slice_rescale,
+        memory_budget=MemoryBudget(max_memory) if max_memory is not None else None,
+        float_pixel_data=float_pixel_data,
+        as_dataset=as_dataset,
     )
 
-def main():
+def _add_conversion_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--extended',
+        help='write one Enhanced PET/CT multi-frame file instead of a file per slice',
+        action='store_true'
+    )
+    parser.add_argument('--no-extended', dest='extended', action='store_false')
+    parser.set_defaults(extended=False)
+
+    parser.add_argument(
+        '--lazy',
+        help='memory-map the image file and read it slice by slice',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--pipeline',
+        help='read, encode and write slices in separate threads with bounded queues',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--backend',
+        help='slice writer: pydicom Dataset.save_as or pre-encoded stream encoder',
+        choices=wr.BACKENDS,
+        default='pydicom'
+    )
+    parser.add_argument(
+        '--compression',
+        help='compressed transfer syntax: RLE Lossless or Deflated Explicit VR Little Endian',
+        choices=COMPRESSIONS,
+        default=None
+    )
+    parser.add_argument(
+        '--per-slice-rescale',
+        help='quantize every slice of a float image with its own rescale slope and intercept',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--float-pixel-data',
+        help='write float images as 32-bit (or 64-bit) Float Pixel Data without quantization',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--resume',
+        help='record completed files in a manifest next to the output and skip them on rerun '
+             '(UIDs are the same in every run)',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--archive-deflate',
+        help='deflate files written into a .zip (or .tar) output, stored by default',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--max-memory',
+        help='memory budget of a conversion, e.g. 512M or 2G: the image is read, quantized and '
+             'written slab by slab and the conversion stops if its resident set size goes over',
+        type=parse_size,
+        default=None
+    )
+    parser.add_argument(
+        '--derived',
+        help='directory for axial, coronal and sagittal MIPs and a downsampled preview, '
+             'computed while the image is converted',
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        '--derived-format',
+        help='format of the derived images: PNG or Secondary Capture DICOM',
+        choices=DERIVED_FORMATS,
+        default='png'
+    )
+    parser.add_argument(
+        '--preview-factor',
+        help='downsampling factor of the preview along every axis',
+        type=int,
+        default=4
+    )
+
+def _derived_outputs(args: argparse.Namespace) -> Optional[DerivedOutputs]:
+    if args.derived is None:
+        return None
+    return DerivedOutputs(Path(args.derived), args.derived_format, args.preview_factor)
+
+def _add_profiling_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--profile',
+        help='print wall time, bytes and allocation peak of every conversion stage '
+             '(stages run by worker processes are not included)',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--profile-report',
+        help='save the profile as JSON to this file (implies --profile)',
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        '--profile-trace',
+        help='save stages as Chrome trace JSON to this file (implies --profile)',
+        type=str,
+        default=None
+    )
+
+def run_profiled(args: argparse.Namespace, command: Callable[[], int]) -> int:
+    """
+        Runs the command, with profiling if any of the profiling options is set
+    """
+    if not (args.profile or args.profile_report or args.profile_trace):
+        return command()
+
+    with profiling() as profiler:
+        status = command()
+
+    print(profiler.format_report())
+    if args.profile_report:
+        profiler.write_report(Path(args.profile_report))
+    if args.profile_trace:
+        profiler.write_chrome_trace(Path(args.profile_trace))
+
+    return status
+
+def batch_command(args: argparse.Namespace) -> int:
+    if args.manifest is not None:
+        jobs = batch.jobs_from_manifest(Path(args.manifest))
+    else:
+        jobs = batch.jobs_from_glob(
+            args.glob, Path(args.meta_file), Path(args.directory), extended_format=args.extended
+        )
+
+    results = batch.run_batch(
+        jobs,
+        processes=args.processes,
+        extended_format=args.extended,
+        lazy=args.lazy,
+        backend=args.backend,
+        compression=args.compression,
+        pipeline=args.pipeline,
+        archive_deflate=args.archive_deflate,
+        resume=args.resume,
+        per_slice_rescale=args.per_slice_rescale,
+        max_memory=args.max_memory,
+        float_pixel_data=args.float_pixel_data,
+        derived=_derived_outputs(args),
+        shard=args.shard,
+        claims=WorkClaims(Path(args.claim_dir), ttl=args.claim_ttl) if args.claim_dir else None,
+    )
+    print(batch.format_summary(results))
+
+    return 0 if all(result.ok for result in results) else 1
+
+def watch_command(args: argparse.Namespace) -> int:
+    rules = watch.read_rules(Path(args.rules)) if args.rules else []
+
+    watcher = watch.SpoolWatcher(
+        Path(args.spool),
+        Path(args.directory),
+        rules=rules,
+        default_metadata=Path(args.meta_file) if args.meta_file else None,
+        done_dir=args.done,
+        failed_dir=args.failed,
+        processes=args.processes,
+        poll_interval=args.interval,
+        status_file=Path(args.status_file) if args.status_file else None,
+        extended_format=args.extended,
+        lazy=args.lazy,
+        backend=args.backend,
+        compression=args.compression,
+        pipeline=args.pipeline,
+        archive_deflate=args.archive_deflate,
+        resume=args.resume,
+        per_slice_rescale=args.per_slice_rescale,
+        max_memory=args.max_memory,
+        float_pixel_data=args.float_pixel_data,
+        derived=_derived_outputs(args),
+    )
+
+    # Stop polling on SIGTERM as on Ctrl+C, queued conversions are finished
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        watcher.run(stop)
+    except KeyboardInterrupt:
+        LOGGER.info('Interrupted, stopping')
+
+    print(json.dumps(watcher.stats.as_dict(), indent=2))
+    return 0
+
+def to_interfile_command(args: argparse.Namespace) -> int:
+    header_path = dicom_to_interfile(Path(args.series), Path(args.output), series_uid=args.series_uid)
+    print(header_path)
+    return 0
+
+def inspect_command(args: argparse.Namespace) -> int:
+    report = inspect_interfile(Path(args.header), bins=args.bins, sample=args.sample)
+    if args.json:
+        print(json.dumps(report.as_dict(), indent=2))
+    else:
+        print(format_report(report))
+    return 0 if report.size_status == 'ok' else 1
+
+def main(argv=None) -> int:
 
     parser = argparse.ArgumentParser(
         description='This is a interfile to dicom converter created by the J-PET collaboration.',
@@ -51,9 +356,8 @@ def main():
     )
     parser.add_argument(
         '-i', '--input_file',
-        help='input interfile header',
+        help='input interfile header (or metaheader of a dynamic image)',
         type=str,
-        required=True
     )
     parser.add_argument(
         '-m',
@@ -61,7 +365,6 @@ def main():
         help='path to external meta data in JSON',
         type=str,
         nargs='?',
-        required=True
     )
     parser.add_argument(
         '-o', '--output_file',
@@ -73,21 +376,247 @@ def main():
     parser.add_argument('-d','--directory', help='output directory', type=str, default='.')
     parser.add_argument('-v', '--version', action='version', version=version_str)
 
-    parser.add_argument('--extended', action='store_true')
-    parser.add_argument('--no-extended', dest='extended', action='store_false')
-    parser.set_defaults(extended=False)
+    _add_conversion_arguments(parser)
+    _add_profiling_arguments(parser)
+    parser.add_argument(
+        '-w', '--workers',
+        help='number of processes writing slices in parallel',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--store',
+        help='send slices to a Storage SCP at HOST:PORT (C-STORE, requires pynetdicom) '
+             'instead of writing files',
+        type=str,
+        default=None
+    )
+    parser.add_argument('--calling-aet', help='our AE title', type=str, default=DEFAULT_AE_TITLE)
+    parser.add_argument('--called-aet', help='AE title of the SCP', type=str, default=DEFAULT_CALLED_AE_TITLE)
+    parser.add_argument(
+        '--associations',
+        help='number of persistent associations, i.e. C-STOREs in flight',
+        type=int,
+        default=2
+    )
+    parser.add_argument('--retries', help='retries of a failed C-STORE', type=int, default=2)
+
+    subparsers = parser.add_subparsers(dest='command', title='commands')
+
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help='convert many interfiles, see: batch --help',
+        description='Converts many interfiles and prints a per-file summary.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    source = batch_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        '--glob',
+        help='glob pattern of interfile headers (or a directory with them)',
+        type=str
+    )
+    source.add_argument(
+        '--manifest',
+        help='CSV or JSONL file with header, metadata and output of every conversion',
+        type=str
+    )
+    batch_parser.add_argument(
+        '-m', '--meta_file',
+        help='meta data in JSON used for all headers (with --glob)',
+        type=str
+    )
+    batch_parser.add_argument(
+        '-d', '--directory',
+        help='output directory (with --glob)',
+        type=str,
+        default='.'
+    )
+    batch_parser.add_argument(
+        '-p', '--processes',
+        help='number of volumes converted in parallel',
+        type=int,
+        default=1
+    )
+    batch_parser.add_argument(
+        '--shard',
+        help='convert only part i of N of the jobs (e.g. 2/4), for N nodes sharing the inputs',
+        type=batch.parse_shard,
+        default=None
+    )
+    batch_parser.add_argument(
+        '--claim-dir',
+        help='directory shared by the nodes: every job is claimed with a lock file before it is '
+             'converted, jobs claimed or finished by other nodes are skipped',
+        type=str,
+        default=None
+    )
+    batch_parser.add_argument(
+        '--claim-ttl',
+        help='seconds after which the claim of a crashed node (no heartbeat) expires',
+        type=float,
+        default=DEFAULT_CLAIM_TTL
+    )
+    _add_conversion_arguments(batch_parser)
+    _add_profiling_arguments(batch_parser)
 
-    args = parser.parse_args()
-    convert_intefile_to_dicom(
-        args.input_file,
-        args.meta_file,
-        args.output_file,
-        args.directory,
-        extended_format=args.extended
+    watch_parser = subparsers.add_parser(
+        'watch',
+        help='convert interfiles as they appear in a spool directory, see: watch --help',
+        description='Converts header/image pairs dropped into a spool directory until stopped.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    watch_parser.add_argument('spool', help='directory watched for interfile headers', type=str)
+    watch_parser.add_argument(
+        '-m', '--meta_file',
+        help='meta data in JSON used when no rule matches',
+        type=str
+    )
+    watch_parser.add_argument(
+        '--rules',
+        help='JSON list of {"pattern", "modality", "metadata"} rules choosing meta data',
+        type=str
+    )
+    watch_parser.add_argument('-d', '--directory', help='output directory', type=str, default='.')
+    watch_parser.add_argument('--done', help='directory for converted inputs (default: spool/done)', type=str)
+    watch_parser.add_argument('--failed', help='directory for failed inputs (default: spool/failed)', type=str)
+    watch_parser.add_argument(
+        '-p', '--processes',
+        help='number of volumes converted in parallel',
+        type=int,
+        default=1
+    )
+    watch_parser.add_argument('--interval', help='seconds between polls', type=float, default=2.0)
+    watch_parser.add_argument(
+        '--status-file',
+        help='JSON file updated with throughput and queue depth after every poll',
+        type=str
+    )
+    _add_conversion_arguments(watch_parser)
+
+    reverse_parser = subparsers.add_parser(
+        'to-interfile',
+        help='convert a DICOM series back to interfile, see: to-interfile --help',
+        description='Converts a directory with DICOM slices (or Enhanced multi-frame files, e.g. written '
+                    'with --extended) of a series to interfile header and image. Series written by this '
+                    'converter are read back into the original image, other series keep the DICOM '
+                    'orientation. A multi-frame file is decoded at once.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    reverse_parser.add_argument('series', help='directory with DICOM slices or multi-frame files', type=str)
+    reverse_parser.add_argument(
+        '-o', '--output',
+        help='interfile header to write, the image is written next to it (.img)',
+        type=str,
+        required=True
+    )
+    reverse_parser.add_argument(
+        '--series-uid',
+        help='series to convert if the directory holds more than one',
+        type=str
     )
+    _add_profiling_arguments(reverse_parser)
+
+    inspect_parser = subparsers.add_parser(
+        'inspect',
+        help='print header, statistics, histogram and slice profile of an interfile, see: inspect --help',
+        description='Checks the image file size against the header and prints statistics of the voxels '
+                    'without converting the image. Exits with 1 if the image file size does not match.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    inspect_parser.add_argument('header', help='interfile header', type=str)
+    inspect_parser.add_argument('--bins', help='number of histogram bins', type=int, default=HISTOGRAM_BINS)
+    inspect_parser.add_argument(
+        '--sample',
+        help='estimate from about that many voxels (every n-th row of every slice) instead of reading '
+             'the whole image',
+        type=int,
+        nargs='?',
+        const=SAMPLE_VOXELS,
+        default=None
+    )
+    inspect_parser.add_argument('--json', help='print the report as JSON', action='store_true')
+    _add_profiling_arguments(inspect_parser)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'to-interfile':
+        return run_profiled(args, lambda: to_interfile_command(args))
+
+    if args.command == 'inspect':
+        return run_profiled(args, lambda: inspect_command(args))
+
+    if args.command == 'watch':
+        if args.meta_file is None and args.rules is None:
+            watch_parser.error('-m/--meta_file or --rules is required')
+        return watch_command(args)
+
+    if args.command == 'batch':
+        if args.glob is not None and args.meta_file is None:
+            batch_parser.error('-m/--meta_file is required with --glob')
+        return run_profiled(args, lambda: batch_command(args))
+
+    if args.input_file is None or args.meta_file is None:
+        parser.error('the following arguments are required: -i/--input_file, -m/--meta_file')
+    if args.derived is not None and (args.store or args.resume):
+        parser.error('--derived can not be combined with --store or --resume')
+    if args.output_file is not None and wr.archive_format(args.output_file) is not None:
+        # Archive members are encoded one by one in memory
+        if args.derived is not None or args.workers > 1 or args.pipeline:
+            parser.error('--derived, --workers and --pipeline can not be combined with an archive output')
+
+    def store() -> int:
+        host, port = parse_address(args.store)
+        with StoreSink(
+            host, port, args.calling_aet, args.called_aet,
+            associations=args.associations, retries=args.retries
+        ) as sink:
+            stats = sink.send(iter_interfile_to_dicom(
+                args.input_file,
+                args.meta_file,
+                extended_format=args.extended,
+                lazy=args.lazy,
+                backend=args.backend,
+                compression=args.compression,
+                per_slice_rescale=args.per_slice_rescale,
+                max_memory=args.max_memory,
+                float_pixel_data=args.float_pixel_data,
+                as_dataset=True,
+            ), prepare=wr.storage_identity)
+        for series in stats:
+            print(
+                f'{series.series_uid}: {series.files} files, {series.bytes / 2**20:.1f} MiB, '
+                f'{series.seconds:.2f} s, {series.mb_per_s:.1f} MiB/s, {series.retries} retries'
+            )
+        return 0
+
+    def convert() -> int:
+        report = convert_intefile_to_dicom(
+            args.input_file,
+            args.meta_file,
+            args.output_file,
+            args.directory,
+            extended_format=args.extended,
+            lazy=args.lazy,
+            workers=args.workers,
+            backend=args.backend,
+            compression=args.compression,
+            pipeline=args.pipeline,
+            archive_deflate=args.archive_deflate,
+            resume=args.resume,
+            per_slice_rescale=args.per_slice_rescale,
+            max_memory=args.max_memory,
+            float_pixel_data=args.float_pixel_data,
+            derived=_derived_outputs(args),
+        )
+        if report is not None:
+            print(f'Peak RSS {report["peak_rss_mb"]:.0f} MiB, budget {report["budget_mb"]:.0f} MiB')
+        return 0
+
+    status = run_profiled(args, store if args.store else convert)
 
     LOGGER.info("Convertion Completed")
+    return status
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
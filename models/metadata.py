@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import List, Tuple, Optional, Union, Literal
 
 from pydantic import BaseModel
@@ -18,18 +19,28 @@ class InterfileHeader(BaseModel):
     matrix_size_3: int
     number_format: str
     bytes_per_pixel: int
-    scaling_factor_1: str
-    scaling_factor_2: str
-    scaling_factor_3: str
-    data_rescale_offset: int
-    data_rescale_slope: int
+    scaling_factor_1: float
+    scaling_factor_2: float
+    scaling_factor_3: float
+    data_rescale_offset: float
+    data_rescale_slope: float
     quantification_units: int
+    frames_number: int=1
+    frame_start_times: List[float]=[]
+    frame_durations: List[float]=[]
+    gated: bool=False
 
 class BaseMetaData(BaseModel):
     @classmethod
     def get_field_names(cls,alias=False):
+        return list(cls._field_names(alias))
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def _field_names(cls, alias):
+        # Generating the schema is expensive and it never changes for a class
         props = cls.schema(alias).get("properties")
-        return list(props.keys()) if props else []
+        return tuple(props.keys()) if props else ()
 
     def __getitem__(self, item):
         return getattr(self, item)
@@ -21,6 +21,8 @@ setup(
                       "pylint",
                       "python-coveralls",
                       'dicomgenerator'],
+    # Sending to a Storage SCP (--store)
+    extras_require={'store': ['pynetdicom>=2.0']},
     keywords=['JPET','interfile','dicom','format','converter'],
     classifiers =[
     'Programming Language :: Python :: 3',
@@ -1,11 +1,14 @@
 from lxml import etree
 from io import StringIO
 from pathlib import Path
+import numpy as np
 import pytest
 import re
 import requests
 import time
 
+from converter.synthetic import write_interfile
+
 
 @pytest.fixture(scope="session")
 def temp_directory(tmp_path_factory):
@@ -61,4 +64,15 @@ def data_directory(temp_directory):
     download_file(input_folder=input_folder)
     return test_dir
 
+@pytest.fixture
+def synthetic_volume():
+    rng = np.random.default_rng(0)
+    volume = rng.random((12, 10, 8), dtype=np.float32) * 100
+    volume[:, :2, :] = 0
+    return volume
+
+@pytest.fixture
+def synthetic_header(tmp_path, synthetic_volume):
+    return write_interfile(tmp_path, 'synthetic', synthetic_volume, offset=64)
+
 test_params = ['PT']
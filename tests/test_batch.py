@@ -0,0 +1,110 @@
+#Batch module tests
+
+import json
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+import converter.batch as batch
+from converter.claims import WorkClaims
+from converter.exceptions import I2DException
+
+from .conftest import write_interfile
+
+METADATA_PATH = Path("tests/inputs/metadata_pt.json").resolve()
+
+
+class TestBatch:
+
+    def test_jobs_from_manifest(self, tmp_path):
+        jsonl = tmp_path / "jobs.jsonl"
+        jsonl.write_text(
+            json.dumps({"header": "a.hdr", "metadata": "meta.json", "output": "out/a"}) + "\n\n"
+        )
+        csv = tmp_path / "jobs.csv"
+        csv.write_text("header,metadata,output\na.hdr,meta.json,out/a\n")
+
+        expected = [batch.BatchJob(tmp_path / "a.hdr", tmp_path / "meta.json", tmp_path / "out/a")]
+        assert batch.jobs_from_manifest(jsonl) == expected
+        assert batch.jobs_from_manifest(csv) == expected
+
+        csv.write_text("header,metadata\na.hdr,meta.json\n")
+        with pytest.raises(I2DException):
+            batch.jobs_from_manifest(csv)
+
+    @pytest.mark.parametrize("processes", [1, 2])
+    def test_run_batch(self, tmp_path, synthetic_volume, monkeypatch, processes):
+        for name in ["a", "b", "c"]:
+            write_interfile(tmp_path, name, synthetic_volume)
+        # Broken image file reference, conversion fails
+        header_b = tmp_path / "b.hdr"
+        header_b.write_text(header_b.read_text().replace("b.img", "missing.img"))
+
+        parsed = []
+        read_json_meta = batch.read_json_meta
+        monkeypatch.setattr(
+            batch, "read_json_meta", lambda *args: parsed.append(args) or read_json_meta(*args)
+        )
+
+        jobs = batch.jobs_from_glob(str(tmp_path), METADATA_PATH, tmp_path / "out")
+        results = batch.run_batch(jobs, processes=processes, backend="stream")
+
+        assert len(parsed) == 1
+        assert sorted(result.ok for result in results) == [False, True, True]
+        assert (tmp_path / "out" / "a" / "a_0.dcm").is_file()
+        assert (tmp_path / "out" / "c" / "c_0.dcm").is_file()
+
+        summary = batch.format_summary(results)
+        assert "FAILED" in summary and "missing.img" in summary
+        assert summary.endswith("2 converted, 1 failed")
+
+    def test_shard_jobs(self, tmp_path):
+        jobs = [batch.BatchJob(tmp_path / f"{name}.hdr", METADATA_PATH, tmp_path / name) for name in "edcba"]
+        shards = [batch.shard_jobs(jobs, index, 2) for index in (1, 2)]
+
+        assert [job.header.stem for job in shards[0]] == ["a", "c", "e"]
+        assert [job.header.stem for job in shards[1]] == ["b", "d"]
+        assert batch.parse_shard("2/4") == (2, 4)
+        for text in ("0/4", "5/4", "two"):
+            with pytest.raises(ValueError):
+                batch.parse_shard(text)
+
+    @pytest.mark.parametrize("processes", [1, 2])
+    def test_run_batch_claims(self, tmp_path, synthetic_volume, processes):
+        for name in ["a", "b", "c", "d"]:
+            write_interfile(tmp_path, name, synthetic_volume)
+        jobs = batch.jobs_from_glob(str(tmp_path), METADATA_PATH, tmp_path / "out")
+        claims_dir = tmp_path / "claims"
+
+        # Another node is converting b, a crashed node left a stale claim of c
+        other = WorkClaims(claims_dir, node="other")
+        assert other.claim(tmp_path / "b.hdr") and other.claim(tmp_path / "c.hdr")
+        stale_lock = claims_dir / f"{WorkClaims.key(tmp_path / 'c.hdr')}.lock"
+        os.utime(stale_lock, (time.time() - 60, time.time() - 60))
+
+        results = batch.run_batch(
+            jobs, processes=processes, backend="stream", claims=WorkClaims(claims_dir, ttl=30)
+        )
+        assert sorted(result.job.header.stem for result in results) == ["a", "c", "d"]
+        assert all(result.ok for result in results)
+        assert not (tmp_path / "out" / "b").exists()
+        lock_b = f"{WorkClaims.key(tmp_path / 'b.hdr')}.lock"
+        assert [path.name for path in claims_dir.glob("*.lock")] == [lock_b]
+
+        # Finished jobs are skipped in later runs, b is left to its node
+        assert batch.run_batch(jobs, claims=WorkClaims(claims_dir, ttl=30)) == []
+        other.release(tmp_path / "b.hdr")
+        assert not list(claims_dir.glob("*.lock"))
+        assert len(list(claims_dir.glob("*.done"))) == 4
+
+    def test_claim_heartbeat(self, tmp_path):
+        header = tmp_path / "a.hdr"
+        with WorkClaims(tmp_path / "claims", ttl=0.4, node="first") as first:
+            assert first.claim(header)
+            time.sleep(0.6)
+            # Refreshed by the heartbeat, the claim did not expire
+            assert not WorkClaims(tmp_path / "claims", ttl=0.4, node="second").claim(header)
+        # Claims held when the node stops are given up
+        assert WorkClaims(tmp_path / "claims", node="second").claim(header)
@@ -0,0 +1,46 @@
+#Benchmark and synthetic Interfile tests
+
+import numpy as np
+from pytest import mark
+
+from benchmarks.run import check_thresholds, run_case
+from converter.reader import interfile_header_import, read_binary
+from converter.synthetic import synthetic_volume, write_synthetic_interfile
+
+
+class TestBenchmarks:
+
+    @mark.parametrize("dtype", ["<f4", ">f4", ">i2", "<u1"])
+    def test_synthetic_interfile(self, tmp_path, dtype):
+        header_path = write_synthetic_interfile(tmp_path, "synthetic", (6, 16, 12), dtype=dtype, offset=32)
+        volume = synthetic_volume((6, 16, 12), dtype=dtype)
+
+        header = interfile_header_import(header_path)
+        assert (header.matrix_size_1, header.matrix_size_2, header.matrix_size_3) == (12, 16, 6)
+        assert header.bytes_per_pixel == np.dtype(dtype).itemsize
+
+        img, _, _, byte_order = read_binary(header)
+        assert byte_order == dtype[0]
+        if np.dtype(dtype).kind != "f":
+            assert np.array_equal(img, volume[::-1, ::-1, :])
+
+    def test_run_case(self, tmp_path):
+        header_path = write_synthetic_interfile(tmp_path, "tiny", (4, 16, 16))
+
+        case = run_case("tiny", header_path, repeat=1)
+
+        assert case["shape"] == [4, 16, 16]
+        assert list(case["stages"]) == [
+            "header_parse", "read_binary", "quantization", "dataset_build", "write_dicom"
+        ]
+        assert case["stages"]["header_parse"]["mb_per_s"] is None
+        assert all(stage["seconds"] > 0 for stage in case["stages"].values())
+
+        results = {"cases": [case]}
+        assert check_thresholds(results, {"tiny": {"min_mb_per_s": {"read_binary": 0}}}) == []
+        failures = check_thresholds(results, {
+            "tiny": {"max_seconds": {"write_dicom": 0}, "max_peak_rss_mb": 0},
+            "other": {"max_peak_rss_mb": 0},
+        })
+        assert len(failures) == 2
+        assert failures[0].startswith("tiny: write_dicom")
@@ -0,0 +1,36 @@
+#Compression module tests
+
+import numpy as np
+import pytest
+from pydicom.pixel_data_handlers.rle_handler import _rle_decode_frame
+
+from converter.compression import rle_encode_frame, transfer_syntax
+
+
+class TestCompression:
+
+    @pytest.mark.parametrize("dtype", ["u1", "<u2", ">i2", "<i4"])
+    def test_rle_encode_frame(self, dtype):
+        rng = np.random.default_rng(0)
+        frame = np.zeros((20, 300), dtype=dtype)
+        # Literal runs, short runs, runs longer than 128 bytes and rows of noise
+        frame[2, 10:20] = np.arange(10)
+        frame[3, 5:7] = 7
+        frame[4, :] = 9
+        frame[5:8] = rng.integers(0, 100, (3, 300))
+        frame[9, 299] = 1
+
+        encoded = rle_encode_frame(frame, columns=300)
+
+        assert len(encoded) % 2 == 0
+        assert len(encoded) < frame.nbytes
+        decoded = _rle_decode_frame(encoded, 20, 300, 1, frame.dtype.itemsize*8)
+        restored = np.frombuffer(decoded, dtype=frame.dtype.newbyteorder('<')).reshape(frame.shape)
+        assert np.array_equal(restored, frame)
+
+    def test_transfer_syntax(self):
+        assert transfer_syntax(None) == "1.2.840.10008.1.2.1"
+        assert transfer_syntax("rle") == "1.2.840.10008.1.2.5"
+        assert transfer_syntax("deflate") == "1.2.840.10008.1.2.1.99"
+        with pytest.raises(ValueError):
+            transfer_syntax("jpeg")
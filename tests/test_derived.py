@@ -0,0 +1,83 @@
+#Derived outputs module tests
+
+from pathlib import Path
+
+import numpy as np
+import pydicom
+import pytest
+from pytest import mark
+
+from converter.derived import PNG_SIGNATURE, DerivedOutputs, SeriesProjections, montage
+from converter.reader import interfile_header_import, read_binary, read_json_meta
+from converter.writer import write_dicom
+
+
+def expected_images(header, per_slice_rescale=False):
+    image, slope, intercept, _ = read_binary(header, per_slice_rescale=per_slice_rescale)
+    values = image*np.reshape(slope, (-1, 1, 1)) + np.reshape(intercept, (-1, 1, 1))
+    return values, {'axial': values.max(axis=0), 'coronal': values.max(axis=1), 'sagittal': values.max(axis=2)}
+
+
+class TestDerived:
+
+    def test_preview_block_means(self):
+        volume = np.arange(5*6*7, dtype=np.float64).reshape(5, 6, 7)
+        projections = SeriesProjections(volume.shape, 1.0, 0.0, preview_factor=2)
+        # Blocks out of order and repeated slices are counted once
+        projections.update(3, volume[3:])
+        projections.update(0, volume[:3])
+        projections.update(2, volume[2:3])
+
+        assert projections.preview.shape == (3, 3, 4)
+        assert projections.preview[0, 0, 0] == volume[:2, :2, :2].mean()
+        assert projections.preview[2, 2, 3] == volume[4:, 4:, 6:].mean()
+        assert np.array_equal(projections.images()['axial'], volume.max(axis=0))
+
+    def test_incomplete_projections(self):
+        projections = SeriesProjections((4, 3, 3), 1.0, 0.0, preview_factor=2)
+        projections.update(0, np.ones((2, 3, 3)))
+        with pytest.raises(ValueError):
+            projections.images()
+
+    def test_montage(self):
+        volume = np.arange(5*2*3).reshape(5, 2, 3)
+        tiles = montage(volume)
+        assert tiles.shape == (4, 9)
+        assert np.array_equal(tiles[2:, 3:6], volume[4])
+        assert not tiles[2:, 6:].any()
+
+    @mark.parametrize("lazy,extended_format,per_slice_rescale", [
+        (False, False, False), (True, False, False), (True, True, False), (True, False, True)
+    ])
+    def test_write_dicom_derived(self, tmp_path, synthetic_header, lazy, extended_format, per_slice_rescale):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        output_path = tmp_path / ("out.dcm" if extended_format else "out")
+        derived = DerivedOutputs(tmp_path / "derived", "dicom", preview_factor=3)
+
+        write_dicom(
+            interfile_header, metadata, output_path, extended_format, lazy=lazy,
+            per_slice_rescale=per_slice_rescale, derived=derived
+        )
+
+        values, mips = expected_images(interfile_header, per_slice_rescale)
+        for name, mip in mips.items():
+            ds = pydicom.dcmread(tmp_path / "derived" / f"out_mip_{name}.dcm")
+            assert ds.ImageType[-1] == "MIP"
+            assert np.allclose(ds.pixel_array*ds.RescaleSlope + ds.RescaleIntercept, mip, atol=ds.RescaleSlope)
+
+        preview = pydicom.dcmread(tmp_path / "derived" / "out_preview.dcm")
+        assert int(preview.NumberOfFrames) == 4
+        assert preview.pixel_array.shape == (4, 4, 3)
+        mean = preview.pixel_array[0, 0, 0]*preview.RescaleSlope + preview.RescaleIntercept
+        assert mean == pytest.approx(values[:3, :3, :3].mean(), abs=preview.RescaleSlope)
+
+    def test_write_dicom_derived_png(self, tmp_path, synthetic_header):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        write_dicom(interfile_header, metadata, tmp_path / "out", False, derived=DerivedOutputs(tmp_path / "png"))
+
+        names = sorted(path.name for path in (tmp_path / "png").iterdir())
+        assert names == ["out_mip_axial.png", "out_mip_coronal.png", "out_mip_sagittal.png", "out_preview.png"]
+        assert all((tmp_path / "png" / name).read_bytes().startswith(PNG_SIGNATURE) for name in names)
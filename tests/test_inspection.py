@@ -0,0 +1,74 @@
+#Inspection module tests
+
+import json
+
+import numpy as np
+import pytest
+
+from converter.inspection import PERCENTILE_BINS, PERCENTILES, format_report, inspect_interfile
+from main import main
+
+from .conftest import write_interfile
+
+
+class TestInspection:
+
+    def test_inspect_interfile(self, synthetic_header, synthetic_volume):
+        report = inspect_interfile(synthetic_header, bins=10)
+
+        assert report.size_status == "ok"
+        assert not report.sampled
+        assert report.voxels == synthetic_volume.size
+        assert report.minimum == synthetic_volume.min() and report.maximum == synthetic_volume.max()
+        assert report.mean == pytest.approx(synthetic_volume.mean(dtype=np.float64))
+        assert report.std == pytest.approx(synthetic_volume.std(dtype=np.float64))
+
+        # Percentiles lie in the fine histogram bin of the voxel
+        width = (report.maximum - report.minimum)/PERCENTILE_BINS
+        for q in PERCENTILES:
+            expected = np.percentile(synthetic_volume, q, method="inverted_cdf")
+            assert report.percentiles[f"p{q}"] == pytest.approx(expected, abs=width*1.001)
+
+        counts, _ = np.histogram(synthetic_volume, bins=report.histogram_edges)
+        assert sum(report.histogram_counts) == synthetic_volume.size
+        assert np.abs(counts - report.histogram_counts).sum() <= 2
+
+        assert report.slices == list(range(len(synthetic_volume)))
+        assert np.allclose(report.slice_means, synthetic_volume.mean(axis=(1, 2), dtype=np.float64))
+        assert np.array_equal(report.slice_maxima, synthetic_volume.max(axis=(1, 2)))
+
+    def test_inspect_sample(self, tmp_path):
+        rng = np.random.default_rng(0)
+        volume = rng.random((20, 64, 64), dtype=np.float32)
+        report = inspect_interfile(write_interfile(tmp_path, "image", volume), sample=20*64*4)
+
+        assert report.sampled
+        assert report.voxels == 20*4*64
+        assert report.slices == list(range(20))
+        assert report.mean == pytest.approx(0.5, abs=0.05)
+        assert report.percentiles["p50"] == pytest.approx(0.5, abs=0.05)
+
+    def test_inspect_truncated(self, tmp_path):
+        volume = np.arange(6*4*5, dtype=np.float32).reshape(6, 4, 5)
+        volume[1, 2, 3] = np.nan
+        header = write_interfile(tmp_path, "image", volume)
+        image = tmp_path / "image.img"
+        image.write_bytes(image.read_bytes()[:-30])
+
+        report = inspect_interfile(header)
+
+        assert report.size_status == "truncated"
+        assert report.slices == list(range(5))
+        assert report.non_finite == 1
+        assert report.maximum == volume[4].max()
+        assert "truncated" in format_report(report)
+
+    def test_inspect_command(self, synthetic_header, capsys):
+        assert main(["inspect", str(synthetic_header), "--json"]) == 0
+        report = json.loads(capsys.readouterr().out)
+        assert report["size_status"] == "ok"
+        assert report["header"]["matrix_size_3"] == 12
+
+        assert main(["inspect", str(synthetic_header), "--sample", "100"]) == 0
+        output = capsys.readouterr().out
+        assert "estimated from a sample" in output and "Slice profile" in output
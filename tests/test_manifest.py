@@ -0,0 +1,67 @@
+#Manifest module tests
+
+import json
+from pathlib import Path
+
+import numpy as np
+from pytest import mark
+
+from converter.manifest import convert_resumable, file_digest, manifest_path
+from converter.reader import iter_interfile_frames, read_json_meta
+
+from .conftest import write_interfile
+
+META_PATH = Path("tests/inputs/metadata_pt.json")
+
+
+class TestManifest:
+
+    def test_convert_resumable(self, tmp_path, synthetic_volume):
+        header_path = write_interfile(tmp_path, "image", synthetic_volume)
+        frames = list(iter_interfile_frames(header_path))
+        metadata = read_json_meta(META_PATH, "PT")
+        output_path = tmp_path / "out" / "study"
+        slices = synthetic_volume.shape[0]
+
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path) == (slices, 0)
+        first = {path.name: path.read_bytes() for path in output_path.iterdir()}
+        assert len(first) == slices
+        assert len(json.loads(manifest_path(output_path).read_text())["completed"]) == slices
+
+        # Nothing to do on rerun
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path) == (0, slices)
+
+        # Missing and modified slices are written again, with the same UIDs
+        (output_path / "study_1.dcm").unlink()
+        (output_path / "study_2.dcm").write_bytes(b"truncated")
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path) == (2, slices - 2)
+        assert {path.name: path.read_bytes() for path in output_path.iterdir()} == first
+
+        # Changed input makes the whole output stale
+        write_interfile(tmp_path, "image", synthetic_volume[::-1].copy())
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path) == (slices, 0)
+        assert (output_path / "study_0.dcm").read_bytes() != first["study_0.dcm"]
+
+    @mark.parametrize("extended_format", [False, True])
+    def test_convert_resumable_dynamic(self, tmp_path, synthetic_volume, extended_format):
+        dynamic = np.stack([synthetic_volume + 100*k for k in range(2)])
+        header_path = write_interfile(tmp_path, "dynamic", dynamic)
+        frames = list(iter_interfile_frames(header_path))
+        metadata = read_json_meta(META_PATH, "PT")
+        output_path = tmp_path / "dynamic"
+        files = 2 if extended_format else 2*synthetic_volume.shape[0]
+
+        kwargs = dict(extended_format=extended_format)
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path, **kwargs) == (files, 0)
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path, **kwargs) == (0, files)
+
+    def test_convert_resumable_archive(self, tmp_path, synthetic_volume):
+        header_path = write_interfile(tmp_path, "image", synthetic_volume)
+        frames = list(iter_interfile_frames(header_path))
+        metadata = read_json_meta(META_PATH, "PT")
+        output_path = tmp_path / "study.zip"
+
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path) == (1, 0)
+        completed = json.loads(manifest_path(output_path).read_text())["completed"]
+        assert completed == {"study.zip": file_digest(output_path)}
+        assert convert_resumable(header_path, frames, META_PATH, metadata, output_path) == (0, 1)
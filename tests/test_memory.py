@@ -0,0 +1,145 @@
+#Memory budget module tests
+
+import os
+import zipfile
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pydicom
+import pytest
+from pytest import mark
+
+from converter import writer
+from converter.manifest import convert_resumable
+from converter.memory import SLAB_SHARE, MemoryBudget, MemoryBudgetExceeded, parse_size
+from converter.quantization import BLOCK_BYTES
+from converter.reader import SlabVolume, interfile_header_import, read_binary, read_json_meta
+from converter.writer import write_dicom, write_frames
+
+from .conftest import write_interfile
+
+
+def started_budget(extra_bytes: int) -> MemoryBudget:
+    # Limit relative to the measured baseline, so that the slab size is known
+    budget = MemoryBudget(0)
+    budget.start()
+    budget.limit = budget.baseline + int(extra_bytes/SLAB_SHARE)
+    return budget
+
+def forbid_stacking(monkeypatch):
+    # Frames are streamed within a budget, the volume is never stacked at once
+    def set_pixel_data(*args, **kwargs):
+        raise AssertionError("Pixel data of the whole volume set")
+    monkeypatch.setattr(writer, "set_pixel_data", set_pixel_data)
+
+
+class TestMemory:
+
+    @mark.parametrize("text,size", [("1024", 1024), ("512K", 2**19), ("1.5G", 3*2**29), ("2GiB", 2**31)])
+    def test_parse_size(self, text, size):
+        assert parse_size(text) == size
+
+    def test_parse_size_invalid(self):
+        with pytest.raises(ValueError):
+            parse_size("lots")
+
+    @mark.parametrize("per_slice_rescale", [False, True])
+    def test_slab_volume(self, tmp_path, per_slice_rescale):
+        rng = np.random.default_rng(0)
+        volume = rng.random((12, 128, 128), dtype=np.float32)*100
+        header = interfile_header_import(path=write_interfile(tmp_path, "image", volume, offset=16))
+        slice_cost = 128*128*(4 + 4)
+
+        # Room for the quantize block (the whole image, twice) and three slices
+        budget = started_budget(2*volume.nbytes + 3*slice_cost)
+        slabs, slope, intercept, _ = read_binary(
+            header, threads=1, memory_budget=budget, per_slice_rescale=per_slice_rescale
+        )
+        expected, expected_slope, expected_intercept, _ = read_binary(
+            header, per_slice_rescale=per_slice_rescale
+        )
+
+        assert isinstance(slabs, SlabVolume)
+        assert slabs.slab_slices == 3
+        assert np.array_equal(slope, expected_slope) and np.array_equal(intercept, expected_intercept)
+        assert np.array_equal(np.stack([slabs[i] for i in range(len(slabs))]), expected)
+        assert np.array_equal(slabs[5, 2:4, :], expected[5, 2:4, :])
+
+    def test_slab_threads(self, tmp_path, monkeypatch):
+        # Quantize threads are limited by the blocks of the image, not by the CPU count
+        monkeypatch.setattr(os, "cpu_count", lambda: 32)
+        volume = np.random.default_rng(0).random((6, 5, 4), dtype=np.float32)
+        header = interfile_header_import(path=write_interfile(tmp_path, "image", volume))
+
+        slabs = read_binary(header, memory_budget=started_budget(2**20))[0]
+        assert slabs.threads == 1
+        assert slabs.slab_slices == 6
+        assert np.array_equal(slabs[...], read_binary(header)[0])
+
+        # Threads without room for their blocks are not used
+        volume = np.zeros((64, 256, 256), dtype=np.float32)
+        header = interfile_header_import(path=write_interfile(tmp_path, "large", volume))
+        slabs = read_binary(header, memory_budget=started_budget(5*BLOCK_BYTES))[0]
+        assert slabs.threads == 2
+
+    def test_budget_too_small(self, tmp_path, synthetic_header, synthetic_volume):
+        header = interfile_header_import(path=synthetic_header)
+        # The quantize block of the image alone needs twice its size
+        with pytest.raises(MemoryBudgetExceeded):
+            read_binary(header, memory_budget=started_budget(synthetic_volume.nbytes))
+
+        budget = MemoryBudget(2**20)
+        with pytest.raises(MemoryBudgetExceeded):
+            budget.check()
+
+    @mark.parametrize("extended_format", [False, True])
+    def test_write_dicom_memory_budget(self, tmp_path, synthetic_header, extended_format):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        budget = started_budget(2**30)
+
+        output_path = tmp_path / ("out.dcm" if extended_format else "out")
+        write_dicom(interfile_header, metadata, output_path, extended_format, memory_budget=budget)
+
+        expected = read_binary(interfile_header)[0]
+        if extended_format:
+            assert np.array_equal(pydicom.dcmread(output_path).pixel_array.ravel(), expected.ravel())
+        else:
+            for i in range(len(expected)):
+                ds = pydicom.dcmread(output_path / f"out_{i}.dcm")
+                assert np.array_equal(ds.pixel_array.ravel(), expected[i].ravel())
+
+        report = budget.report()
+        assert report["baseline_mb"] <= report["peak_rss_mb"] <= report["budget_mb"]
+
+    def test_archive_memory_budget(self, tmp_path, synthetic_header, monkeypatch):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        forbid_stacking(monkeypatch)
+
+        output_path = tmp_path / "out.zip"
+        write_frames(
+            [interfile_header], metadata, output_path, extended_format=True,
+            memory_budget=started_budget(2**30),
+        )
+
+        with zipfile.ZipFile(output_path) as archive:
+            ds = pydicom.dcmread(BytesIO(archive.read("out.dcm")))
+        assert np.array_equal(ds.pixel_array.ravel(), read_binary(interfile_header)[0].ravel())
+
+    def test_resume_memory_budget(self, tmp_path, synthetic_header, monkeypatch):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        meta_path = Path("tests/inputs/metadata_pt.json")
+        metadata = read_json_meta(meta_path, "PT")
+        forbid_stacking(monkeypatch)
+
+        output_path = tmp_path / "out.dcm"
+        written, skipped = convert_resumable(
+            synthetic_header, [interfile_header], meta_path, metadata, output_path,
+            extended_format=True, memory_budget=started_budget(2**30),
+        )
+
+        assert (written, skipped) == (1, 0)
+        ds = pydicom.dcmread(output_path)
+        assert np.array_equal(ds.pixel_array.ravel(), read_binary(interfile_header)[0].ravel())
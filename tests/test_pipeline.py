@@ -0,0 +1,51 @@
+#Pipeline module tests
+
+import threading
+import time
+
+import pytest
+
+from converter.pipeline import run_pipeline
+
+
+class TestPipeline:
+
+    @pytest.mark.parametrize("threads", [1, 3])
+    def test_run_pipeline(self, threads):
+        written = []
+        run_pipeline(range(50), [(lambda i: i*i, threads), (written.append, 1)], queue_size=2)
+
+        assert sorted(written) == [i*i for i in range(50)]
+
+    def test_backpressure(self):
+        read = []
+        in_flight = []
+        lock = threading.Lock()
+
+        def source():
+            for i in range(30):
+                read.append(i)
+                yield i
+
+        def slow_write(i):
+            with lock:
+                in_flight.append(len(read) - i)
+            time.sleep(0.002)
+
+        run_pipeline(source(), [(lambda i: i, 1), (slow_write, 1)], queue_size=2)
+
+        # Reader is at most two full queues and the items held by the stages ahead
+        assert max(in_flight) <= 2*2 + 3
+
+    def test_error_stops_pipeline(self):
+        processed = []
+
+        def fail(i):
+            if i == 5:
+                raise RuntimeError("encoding failed")
+            return i
+
+        with pytest.raises(RuntimeError, match="encoding failed"):
+            run_pipeline(iter(range(10**6)), [(fail, 2), (processed.append, 1)], queue_size=4)
+
+        assert len(processed) < 100
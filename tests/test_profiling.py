@@ -0,0 +1,80 @@
+#Profiling module tests
+
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from converter.profiling import profile_stage, profiling
+from converter.reader import interfile_header_import, read_json_meta
+from converter.writer import write_dicom
+
+
+class TestProfiling:
+
+    def test_profile_write_dicom(self, synthetic_header, synthetic_volume, tmp_path):
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        with profiling() as profiler:
+            header = interfile_header_import(path=synthetic_header)
+            write_dicom(header, metadata, tmp_path / "out", extended_format=False)
+
+        stages = {stage["name"]: stage for stage in profiler.report()["stages"]}
+
+        assert list(stages) == ["header_parse", "read_binary", "quantization", "dataset_build", "write"]
+        assert stages["read_binary"]["bytes"] == synthetic_volume.nbytes
+        assert stages["quantization"]["peak_mb"] > 0
+        assert stages["write"]["calls"] == len(synthetic_volume)
+        # Slices are written as uint16
+        assert stages["write"]["bytes"] == synthetic_volume.size * 2
+
+        trace_path = tmp_path / "trace.json"
+        profiler.write_chrome_trace(trace_path)
+        events = json.load(open(trace_path))["traceEvents"]
+        assert len(events) == sum(stage["calls"] for stage in stages.values())
+        assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+
+    def test_nested_stages(self):
+        with profiling() as profiler:
+            with profile_stage("outer"):
+                with profile_stage("inner", nbytes=8*2**20):
+                    block = np.ones(2**20)
+                del block
+
+        stages = {stage["name"]: stage for stage in profiler.report()["stages"]}
+        assert stages["inner"]["peak_mb"] >= 8
+        assert stages["outer"]["peak_mb"] >= stages["inner"]["peak_mb"]
+        assert stages["inner"]["mb_per_s"] > 0
+
+        # Disabled profiling does nothing
+        events = len(profiler.events)
+        with profile_stage("ignored"):
+            pass
+        assert len(profiler.events) == events
+
+    def test_overlapping_threads(self):
+        started, finished = threading.Event(), threading.Event()
+
+        def worker():
+            with profile_stage("worker"):
+                started.set()
+                finished.wait(5)
+
+        with profiling() as profiler:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            started.wait(5)
+            with profile_stage("main"):
+                block = np.ones(2**20)
+            finished.set()
+            thread.join()
+            with profile_stage("alone"):
+                block = np.ones(2**20)
+            del block
+
+        # The process-wide peak is not attributed to stages of overlapping threads
+        stages = {stage["name"]: stage for stage in profiler.report()["stages"]}
+        assert stages["main"]["peak_mb"] is None and stages["worker"]["peak_mb"] is None
+        assert stages["alone"]["peak_mb"] >= 8
+        assert "main" in profiler.format_report()
@@ -0,0 +1,58 @@
+#Quantization module tests
+
+import numpy as np
+import pytest
+
+import converter.quantization as qt
+
+
+class TestQuantization:
+
+    @pytest.mark.parametrize("threads", [1, 3])
+    def test_quantize_matches_reference(self, monkeypatch, synthetic_volume, threads):
+        # Several slices per block and a partial last block
+        monkeypatch.setattr(qt, "BLOCK_BYTES", synthetic_volume[:5].nbytes)
+        volume = synthetic_volume[::-1, ::-1, :]
+
+        minimum, maximum = qt.min_max(volume, threads=threads)
+        assert minimum == volume.min()
+        assert maximum == volume.max()
+
+        slope, intercept = qt.rescale_parameters(minimum, maximum)
+        expected = ((volume - intercept)/slope).astype(np.uint16)
+        result = qt.quantize(volume, slope, intercept, threads=threads)
+
+        assert result.dtype == np.uint16
+        assert np.array_equal(result, expected)
+
+    def test_quantize_into_preallocated(self, synthetic_volume):
+        out = np.empty(synthetic_volume.shape, dtype=np.uint16)
+        slope, intercept = qt.rescale_parameters(*qt.min_max(synthetic_volume))
+
+        assert qt.quantize(synthetic_volume, slope, intercept, out=out) is out
+        assert out.max() == np.iinfo(np.int16).max
+        assert out.min() == 0
+
+    @pytest.mark.parametrize("threads", [1, 3])
+    def test_quantize_per_slice(self, monkeypatch, synthetic_volume, threads):
+        monkeypatch.setattr(qt, "BLOCK_BYTES", synthetic_volume[:5].nbytes)
+        # Slices of very different activity, and a constant one
+        volume = synthetic_volume * np.logspace(0, 3, synthetic_volume.shape[0], dtype=np.float32)[:, None, None]
+        volume[4] = 7
+        volume = volume[::-1, ::-1, :]
+
+        minima, maxima = qt.slice_min_max(volume, threads=threads)
+        assert np.array_equal(minima, volume.min(axis=(1, 2)))
+        assert np.array_equal(maxima, volume.max(axis=(1, 2)))
+
+        slopes, intercepts = qt.rescale_parameters(minima, maxima)
+        result = qt.quantize(volume, slopes, intercepts, threads=threads)
+
+        for i in range(volume.shape[0]):
+            expected = ((volume[i] - intercepts[i])/slopes[i]).astype(np.uint16)
+            assert np.array_equal(result[i], expected)
+            # Every slice uses the whole range (up to rounding), except the constant one
+            if i == volume.shape[0] - 5:
+                assert result[i].max() == 0
+            else:
+                assert result[i].max() >= np.iinfo(np.int16).max - 1
@@ -15,7 +15,7 @@ from pytest import mark
 import converter.reader as rd
 from converter.exceptions import InterfileInvalidHeaderException
 
-from .conftest import test_params
+from .conftest import test_params, write_interfile
 
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(
@@ -104,6 +104,130 @@ class TestReader:
             with pytest.raises(InterfileInvalidHeaderException):
                 rd._read_interfile_header(path=invalid)
 
+    def test_read_interfile_header_typed(self, synthetic_header):
+        """
+            Test if values are typed and indexed keys are gathered into lists
+        """
+        res = rd._read_interfile_header(path=synthetic_header)
+
+        assert res["matrix size [1]"] == 8
+        assert res["matrix size"] == [8, 10, 12]
+        assert res["scaling factor (mm/pixel) [1]"] == 2.5
+        assert isinstance(res["scaling factor (mm/pixel) [1]"], float)
+        assert res["CASToR version"] == "3.1.1"
+        assert res["number format"] == "short float"
+
+        header = rd.interfile_header_import(path=synthetic_header)
+        assert header.scaling_factor_1 == 2.5
+
+        # Versions which look like numbers stay as written
+        synthetic_header.write_text(
+            synthetic_header.read_text().replace("CASToR version := 3.1.1", "CASToR version := 3.10")
+        )
+        res = rd._read_interfile_header(path=synthetic_header)
+        assert res["CASToR version"] == "3.10"
+        assert rd.interfile_header_import(path=synthetic_header).castor_version == "3.10"
+
+        # Cached header is not changed through the returned copy
+        res["matrix size"].append(0)
+        assert rd._read_interfile_header(path=synthetic_header)["matrix size"] == [8, 10, 12]
+
+    def test_interfile_header_cache(self, synthetic_header):
+        """
+            Test if headers are parsed once and parsed again after they change
+        """
+        rd.clear_header_cache()
+        first = rd.interfile_header_import(path=synthetic_header)
+        second = rd.interfile_header_import(path=synthetic_header)
+
+        assert first == second and first is not second
+        assert rd._import_interfile_header.cache_info().hits == 1
+
+        synthetic_header.write_text(
+            synthetic_header.read_text().replace("data offset in bytes := 64", "data offset in bytes := 128")
+        )
+        assert rd.interfile_header_import(path=synthetic_header).data_offset_in_bytes == 128
+
+    def test_read_binary_data_offset(self, synthetic_header, synthetic_volume):
+        """
+            Test if image data is read from `data offset in bytes`
+        """
+        header = rd.interfile_header_import(path=synthetic_header)
+        assert header.data_offset_in_bytes == 64
+
+        img, slope, intercept, byte_order = rd.read_binary(header)
+
+        assert img.shape == synthetic_volume.shape
+        assert byte_order == "<"
+        assert intercept == synthetic_volume.min()
+        restored = img * slope + intercept
+        assert np.allclose(restored, synthetic_volume[::-1, ::-1, :], atol=slope)
+
+    def test_read_binary_lazy(self, synthetic_header):
+        """
+            Test if memory-mapped volume gives the same slices as eager reading
+        """
+        header = rd.interfile_header_import(path=synthetic_header)
+
+        img, slope, intercept, _ = rd.read_binary(header)
+        volume, lazy_slope, lazy_intercept, _ = rd.read_binary(header, lazy=True)
+
+        assert isinstance(volume, rd.InterfileVolume)
+        assert volume.shape == img.shape
+        assert volume.dtype == img.dtype
+        assert lazy_slope == slope
+        assert lazy_intercept == intercept
+
+        for i in range(len(volume)):
+            assert np.array_equal(volume[i, :, :], img[i, :, :])
+        assert np.array_equal(np.asarray(volume), img)
+
+    def test_iter_interfile_frames(self, tmp_path, synthetic_volume):
+        """
+            Test if frames of a dynamic image are read one by one with their timing
+        """
+        dynamic = np.stack([synthetic_volume + 100*k for k in range(3)])
+        header_path = write_interfile(tmp_path, 'dynamic', dynamic, offset=16, frame_duration=30)
+
+        header = rd.interfile_header_import(path=header_path)
+        assert header.frames_number == 3
+        assert header.frame_start_times == [0, 30, 60]
+
+        frames = list(rd.iter_interfile_frames(header_path))
+        assert len(frames) == 3
+
+        for k, frame in enumerate(frames):
+            assert frame.frames_number == 1
+            assert frame.frame_start_times == [30*k]
+            assert frame.frame_durations == [30]
+
+            img, slope, intercept, _ = rd.read_binary(frame)
+            assert intercept == dynamic[k].min()
+            assert np.allclose(img * slope + intercept, dynamic[k, ::-1, ::-1, :], atol=slope)
+
+    def test_iter_interfile_frames_metaheader(self, tmp_path, synthetic_volume):
+        """
+            Test if frames are read from headers listed in a metaheader
+        """
+        for k in range(1, 3):
+            write_interfile(tmp_path, f'frame_{k}', synthetic_volume*k)
+        metaheader = tmp_path / 'dynamic.mhd'
+        metaheader.write_text(
+            "!INTERFILE := \n"
+            "!total number of data sets := 2\n"
+            "%data set [1] := {frame_1.hdr}\n"
+            "%data set [2] := {frame_2.hdr}\n"
+            "!END OF INTERFILE := \n"
+        )
+
+        frames = list(rd.iter_interfile_frames(metaheader))
+
+        assert [frame.img_file_name for frame in frames] == ['frame_1.img', 'frame_2.img']
+        assert all(frame.frames_number == 1 for frame in frames)
+
+        static = list(rd.iter_interfile_frames(tmp_path / 'frame_1.hdr'))
+        assert static == [rd.interfile_header_import(tmp_path / 'frame_1.hdr')]
+
     @mark.dependency(
             depends=["tests/test_writer.py::TestWriter::test_write_dicom_ct_ok[PT]"],
             scope='session'
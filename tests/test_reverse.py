@@ -0,0 +1,117 @@
+#Reverse conversion module tests
+
+from pathlib import Path
+import shutil
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, PositronEmissionTomographyImageStorage, generate_uid
+import pytest
+from pytest import mark
+
+from converter.exceptions import I2DException
+from converter.reader import interfile_header_import, read_binary, read_json_meta
+from converter.reverse import dicom_to_interfile, scan_series
+from converter.writer import write_dicom
+
+from .conftest import write_interfile
+
+
+class TestReverse:
+
+    @mark.parametrize("dtype,compression", [("<i2", None), (">u2", "rle"), ("<f4", None)])
+    def test_dicom_to_interfile(self, tmp_path, synthetic_volume, dtype, compression):
+        volume = synthetic_volume.astype(dtype) if dtype[1] != "f" else synthetic_volume
+        header_path = write_interfile(tmp_path, "image", volume, offset=16)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        interfile_header = interfile_header_import(path=header_path)
+        write_dicom(
+            interfile_header, metadata, tmp_path / "series", extended_format=False,
+            compression=compression
+        )
+
+        back_path = dicom_to_interfile(tmp_path / "series", tmp_path / "back" / "image.hdr")
+        back_header = interfile_header_import(path=back_path)
+
+        for key in ("modality", "matrix_size_1", "matrix_size_2", "matrix_size_3",
+                    "scaling_factor_1", "scaling_factor_2", "scaling_factor_3"):
+            assert getattr(back_header, key) == getattr(interfile_header, key)
+
+        if dtype[1] == "f":
+            # Quantized values are rescaled back to floats
+            back = np.fromfile(back_path.with_suffix(".img"), dtype="<f4").reshape(volume.shape)
+            assert back_header.number_format == "short float"
+            assert np.allclose(back, volume, atol=read_binary(interfile_header)[1])
+        else:
+            assert np.array_equal(read_binary(back_header)[0], read_binary(interfile_header)[0])
+
+    def test_scan_series(self, tmp_path, synthetic_header):
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        interfile_header = interfile_header_import(path=synthetic_header)
+        write_dicom(interfile_header, metadata, tmp_path / "a", extended_format=False)
+        write_dicom(interfile_header, metadata, tmp_path / "b", extended_format=False)
+
+        info = scan_series(tmp_path / "a")
+        positions = [s.position for s in info.slices]
+        assert positions == sorted(positions, reverse=True)
+        assert info.shape == (
+            interfile_header.matrix_size_3, interfile_header.matrix_size_2, interfile_header.matrix_size_1
+        )
+
+        # Two series in one directory, the series has to be chosen
+        for path in (tmp_path / "b").iterdir():
+            shutil.move(str(path), str(tmp_path / "a" / f"other_{path.name}"))
+        with pytest.raises(I2DException):
+            scan_series(tmp_path / "a")
+        assert len(scan_series(tmp_path / "a", info.series_uid).slices) == len(info.slices)
+
+    @mark.parametrize("backend", ["pydicom", "stream"])
+    def test_dicom_to_interfile_extended(self, tmp_path, synthetic_volume, backend):
+        header_path = write_interfile(tmp_path, "image", synthetic_volume)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        interfile_header = interfile_header_import(path=header_path)
+        (tmp_path / "series").mkdir()
+        write_dicom(
+            interfile_header, metadata, tmp_path / "series" / "image.dcm", extended_format=True,
+            backend=backend, per_slice_rescale=True
+        )
+
+        back_path = dicom_to_interfile(tmp_path / "series", tmp_path / "back" / "image.hdr")
+        back_header = interfile_header_import(path=back_path)
+
+        assert back_header.matrix_size_3 == interfile_header.matrix_size_3
+        back = np.fromfile(back_path.with_suffix(".img"), dtype="<f4").reshape(synthetic_volume.shape)
+        slopes = read_binary(interfile_header, per_slice_rescale=True)[1]
+        assert np.allclose(back, synthetic_volume, atol=np.max(slopes))
+
+    def test_dicom_to_interfile_other_series(self, tmp_path):
+        # Slices of another writer: Rows along Y, not flipped, given in any order
+        volume = np.arange(3*4*5, dtype=np.uint16).reshape(3, 4, 5)
+        series_uid = generate_uid()
+        (tmp_path / "series").mkdir()
+        for k in (2, 0, 1):
+            ds = Dataset()
+            ds.file_meta = FileMetaDataset()
+            ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            ds.SOPClassUID = PositronEmissionTomographyImageStorage
+            ds.SOPInstanceUID = generate_uid()
+            ds.SeriesInstanceUID = series_uid
+            ds.Modality = "PT"
+            ds.ImagePositionPatient = [0, 0, 2.0*k]
+            ds.PixelSpacing = [1.5, 0.5]
+            ds.Rows, ds.Columns = volume.shape[1:]
+            ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = "MONOCHROME2"
+            ds.PixelData = volume[k].tobytes()
+            ds.save_as(tmp_path / "series" / f"{k}.dcm", write_like_original=False)
+
+        back_path = dicom_to_interfile(tmp_path / "series", tmp_path / "back" / "image.hdr")
+        back_header = interfile_header_import(path=back_path)
+
+        assert (back_header.matrix_size_1, back_header.matrix_size_2, back_header.matrix_size_3) == (5, 4, 3)
+        assert (back_header.scaling_factor_1, back_header.scaling_factor_2) == (0.5, 1.5)
+        back = np.fromfile(back_path.with_suffix(".img"), dtype="<u2").reshape(volume.shape)
+        assert np.array_equal(back, volume)
+        assert pydicom.dcmread(tmp_path / "series" / "0.dcm").pixel_array.shape == (4, 5)
@@ -0,0 +1,140 @@
+#Store module tests
+
+from pathlib import Path
+import threading
+
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+import pytest
+
+from converter.exceptions import DicomStoreException
+from converter.reader import interfile_header_import, read_json_meta
+from converter.store import StoreSink, parse_address
+from converter.writer import STORAGE_SOP_CLASSES, iter_dicom, storage_identity, store_dicom, write_dicom
+
+from .test_writer import assert_same_slice
+
+pynetdicom = pytest.importorskip("pynetdicom")
+
+
+@pytest.fixture
+def scp():
+    """
+        Stand-in Storage SCP accepting PET and CT Image Storage with uncompressed
+        transfer syntaxes, on a free local port.
+        Statuses in `scp.statuses` are returned first, then Success.
+    """
+    from pynetdicom import evt
+    from pynetdicom.sop_class import CTImageStorage, PositronEmissionTomographyImageStorage, Verification
+
+    lock = threading.Lock()
+    state = type("SCP", (), {})()
+    state.datasets = []
+    state.statuses = []
+    state.associations = 0
+
+    def handle_store(event):
+        with lock:
+            if state.statuses:
+                return state.statuses.pop(0)
+            ds = event.dataset
+            ds.file_meta = event.file_meta
+            state.datasets.append(ds)
+        return 0x0000
+
+    def handle_associated(event):
+        with lock:
+            state.associations += 1
+
+    ae = pynetdicom.AE(ae_title="TEST-SCP")
+    ae.add_supported_context(Verification)
+    for sop_class in (PositronEmissionTomographyImageStorage, CTImageStorage):
+        ae.add_supported_context(sop_class, [ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+    server = ae.start_server(
+        ("127.0.0.1", 0), block=False,
+        evt_handlers=[(evt.EVT_C_STORE, handle_store), (evt.EVT_ACCEPTED, handle_associated)]
+    )
+    state.port = server.server_address[1]
+    yield state
+
+    server.shutdown()
+
+
+class TestStore:
+
+    def test_parse_address(self):
+        assert parse_address("pacs.local:104") == ("pacs.local", 104)
+        with pytest.raises(ValueError):
+            parse_address("pacs.local")
+
+    def test_store_dicom(self, scp, synthetic_header, tmp_path):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        write_dicom(interfile_header, metadata, tmp_path / "slice", extended_format=False)
+
+        with StoreSink("127.0.0.1", scp.port, associations=2) as sink:
+            stats = store_dicom(interfile_header, metadata, sink)
+            # Associations are reused for all slices
+            assert scp.associations <= 2
+            store_dicom(interfile_header, metadata, sink)
+
+        slices = interfile_header.matrix_size_3
+        assert len(stats) == 1
+        assert stats[0].files == slices
+        assert stats[0].retries == 0
+        # Datasets are sent without encoding, their (uint16) pixel data is counted
+        assert stats[0].bytes == interfile_header.matrix_size_1*interfile_header.matrix_size_2*slices*2
+        assert len(scp.datasets) == 2*slices
+
+        # Every slice is a PET Image Storage instance of its own
+        assert {ds.SOPClassUID for ds in scp.datasets} == {STORAGE_SOP_CLASSES["PT"]}
+        assert len({ds.SOPInstanceUID for ds in scp.datasets}) == 2*slices
+
+        received = {ds.InstanceNumber: ds for ds in scp.datasets[:slices]}
+        for i in range(slices):
+            written = pydicom.dcmread(tmp_path / "slice" / f"slice_{i}.dcm")
+            ds = received[written.InstanceNumber]
+            # File meta information is written by the SCP
+            ds.file_meta = written.file_meta
+            assert_same_slice(written, ds)
+
+    def test_send_encoded(self, scp, synthetic_header):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        encoded = list(iter_dicom(interfile_header, metadata, name="slice"))
+
+        with StoreSink("127.0.0.1", scp.port, associations=2) as sink:
+            stats = sink.send(encoded, prepare=storage_identity)
+
+        assert stats[0].files == len(encoded)
+        assert stats[0].bytes == sum(len(data) for _, data in encoded)
+        assert len({ds.SOPInstanceUID for ds in scp.datasets}) == len(encoded)
+
+    def test_store_retry(self, scp, synthetic_header):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        # Out of resources twice, then stored
+        scp.statuses = [0xA700, 0xA700]
+        with StoreSink("127.0.0.1", scp.port, associations=1, retries=2, retry_delay=0) as sink:
+            stats = store_dicom(interfile_header, metadata, sink)
+
+        assert stats[0].retries == 2
+        assert len(scp.datasets) == interfile_header.matrix_size_3
+
+        scp.statuses = [0xA700]*3
+        with StoreSink("127.0.0.1", scp.port, associations=1, retries=2, retry_delay=0) as sink:
+            with pytest.raises(DicomStoreException):
+                store_dicom(interfile_header, metadata, sink)
+
+    def test_store_context_rejected(self, scp, synthetic_header):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        # Uncompressed slices are stored, then RLE Lossless is not accepted by the SCP
+        with StoreSink("127.0.0.1", scp.port, associations=1, retries=2, retry_delay=0) as sink:
+            store_dicom(interfile_header, metadata, sink)
+            with pytest.raises(DicomStoreException, match="No presentation context"):
+                store_dicom(interfile_header, metadata, sink, compression="rle")
+
+        assert len(scp.datasets) == interfile_header.matrix_size_3
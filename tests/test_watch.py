@@ -0,0 +1,108 @@
+#Watch module tests
+
+import json
+from pathlib import Path
+
+from converter.synthetic import synthetic_volume, write_interfile
+from converter.watch import MetadataRule, SpoolWatcher, read_rules, select_metadata
+
+PT_METADATA = Path("tests/inputs/metadata_pt.json").resolve()
+
+
+class TestWatch:
+
+    def test_select_metadata(self, tmp_path):
+        rules_path = tmp_path / "rules.json"
+        rules_path.write_text(json.dumps([
+            {"pattern": "ct_*.hdr", "metadata": "ct.json"},
+            {"modality": "PT", "metadata": "pt.json"},
+        ]))
+        rules = read_rules(rules_path)
+
+        assert rules[1] == MetadataRule("*", tmp_path / "pt.json", "PT")
+        assert select_metadata(Path("ct_1.hdr"), "CT", rules) == tmp_path / "ct.json"
+        assert select_metadata(Path("brain.hdr"), "PT", rules) == tmp_path / "pt.json"
+        assert select_metadata(Path("brain.hdr"), "CT", rules, default=Path("x.json")) == Path("x.json")
+
+    def test_spool_watcher(self, tmp_path):
+        spool = tmp_path / "spool"
+        spool.mkdir()
+        volume = synthetic_volume((4, 8, 6))
+
+        write_interfile(spool, "first", volume)
+        write_interfile(spool, "int_second", volume.astype("<i2"))
+        # Image of the third pair is still being copied
+        write_interfile(spool, "third", volume)
+        with open(spool / "third.img", "r+b") as f:
+            f.truncate(100)
+        (spool / "broken.hdr").write_text("!INTERFILE := \nno end")
+
+        rule_metadata = tmp_path / "int.json"
+        rule_metadata.write_text(PT_METADATA.read_text())
+
+        status_file = tmp_path / "status.json"
+        watcher = SpoolWatcher(
+            spool, tmp_path / "out",
+            rules=[MetadataRule("int_*", rule_metadata)],
+            default_metadata=PT_METADATA,
+            poll_interval=0,
+            status_file=status_file,
+        )
+        try:
+            # Pairs are converted only once they did not change between two polls
+            watcher.poll()
+            assert watcher.stats.detected == 0
+
+            watcher.poll()
+            assert watcher.stats.detected == 3
+            assert watcher.stats.failed == 1
+            assert watcher.stats.queue_depth + watcher.stats.in_flight == 2
+            watcher.drain()
+
+            assert watcher.stats.converted == 2
+            assert sorted(path.name for path in (spool / "done").iterdir()) == [
+                "first.hdr", "first.img", "int_second.hdr", "int_second.img"
+            ]
+            assert (spool / "failed" / "broken.error").is_file()
+            assert len(list((tmp_path / "out" / "first").iterdir())) == 4
+
+            write_interfile(spool, "third", volume)
+            watcher.run(max_polls=2)
+        finally:
+            watcher.close()
+
+        assert (spool / "done" / "third.img").is_file()
+        status = json.loads(status_file.read_text())
+        assert status["converted"] == 3
+        assert status["failed"] == 1
+        assert status["queue_depth"] == 0
+        assert status["bytes_converted"] > 0
+
+    def test_spool_watcher_metaheader(self, tmp_path):
+        spool = tmp_path / "spool"
+        spool.mkdir()
+        volume = synthetic_volume((4, 8, 6))
+
+        for k in range(1, 3):
+            write_interfile(spool, f"frame_{k}", volume*k)
+        (spool / "dynamic.hdr").write_text(
+            "!INTERFILE := \n"
+            "!total number of data sets := 2\n"
+            "%data set [1] := {frame_1.hdr}\n"
+            "%data set [2] := {frame_2.hdr}\n"
+            "!END OF INTERFILE := \n"
+        )
+
+        watcher = SpoolWatcher(spool, tmp_path / "out", default_metadata=PT_METADATA, poll_interval=0)
+        try:
+            watcher.run(max_polls=2)
+        finally:
+            watcher.close()
+
+        # One dynamic series, frame headers are not converted on their own
+        assert watcher.stats.converted == 1 and watcher.stats.failed == 0
+        assert sorted(path.name for path in (spool / "done").iterdir()) == [
+            "dynamic.hdr", "frame_1.hdr", "frame_1.img", "frame_2.hdr", "frame_2.img"
+        ]
+        assert sorted(path.name for path in (tmp_path / "out").iterdir()) == ["dynamic"]
+        assert sorted(path.name for path in (tmp_path / "out" / "dynamic").iterdir()) == ["frame_1", "frame_2"]
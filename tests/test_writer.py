@@ -3,16 +3,37 @@
 
 import logging
 import shutil
+import tarfile
+import zipfile
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
+import pydicom
+import pytest
 from pytest import mark
 
-from converter.reader import interfile_header_import, read_json_meta
-from converter.writer import write_dicom
+from converter.compression import transfer_syntax
+from converter.reader import (
+    interfile_header_import, iter_interfile_frames, read_binary, read_json_meta
+)
+from converter.writer import (
+    StreamEncoder, create_series_template, create_slice_dataset, create_slice_elements,
+    create_slice_from_template, iter_dicom, rand_uid, set_slice_position, write_dicom, write_dynamic,
+    write_frames, write_slice
+)
+from main import main
 
-from .conftest import test_params
+from .conftest import test_params, write_interfile
 
 LOGGER = logging.getLogger(__name__)
+
+# Attributes generated anew on every conversion
+GENERATED_KEYWORDS = [
+    "SOPInstanceUID", "SOPClassUID", "StudyInstanceUID", "SeriesInstanceUID",
+    "FrameOfReferenceUID", "StudyTime", "ContentTime", "AcquisitionDateTime",
+    "MediaStorageSOPInstanceUID", "MediaStorageSOPClassUID",
+]
 logging.basicConfig(
     format="%(levelname)-10s | %(filename)-20s | %(funcName)-15s | %(lineno)-5d | %(message)-50s\n"
 )
@@ -40,3 +61,369 @@ class TestWriter:
         metadata = read_json_meta(metafile_path, img_type)
 
         write_dicom(interfile_header, metadata, output_path, extended_format=False)
+
+    def test_write_dicom_lazy(self, synthetic_header, tmp_path):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        eager_path = tmp_path / "eager"
+        lazy_path = tmp_path / "lazy"
+        write_dicom(interfile_header, metadata, eager_path, extended_format=False)
+        write_dicom(interfile_header, metadata, lazy_path, extended_format=False, lazy=True)
+
+        for i in range(interfile_header.matrix_size_3):
+            eager = pydicom.dcmread(eager_path / f"eager_{i}.dcm")
+            lazy = pydicom.dcmread(lazy_path / f"lazy_{i}.dcm")
+            assert eager.PixelData == lazy.PixelData
+            assert eager.RescaleSlope == lazy.RescaleSlope
+            assert eager.RescaleIntercept == lazy.RescaleIntercept
+
+    @mark.parametrize("lazy", [False, True])
+    def test_write_dicom_workers(self, synthetic_header, tmp_path, lazy):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        serial_path = tmp_path / "serial"
+        parallel_path = tmp_path / "parallel"
+        write_dicom(interfile_header, metadata, serial_path, extended_format=False, lazy=lazy)
+        write_dicom(
+            interfile_header, metadata, parallel_path, extended_format=False, lazy=lazy, workers=3
+        )
+
+        for i in range(interfile_header.matrix_size_3):
+            serial = pydicom.dcmread(serial_path / f"serial_{i}.dcm")
+            parallel = pydicom.dcmread(parallel_path / f"parallel_{i}.dcm")
+            assert_same_slice(serial, parallel)
+
+    @mark.parametrize("lazy", [False, True])
+    def test_write_dicom_pipeline(self, synthetic_header, tmp_path, lazy):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        serial_path = tmp_path / "serial"
+        pipeline_path = tmp_path / "pipeline"
+        write_dicom(interfile_header, metadata, serial_path, extended_format=False)
+        write_dicom(
+            interfile_header, metadata, pipeline_path, extended_format=False,
+            lazy=lazy, pipeline=True, queue_size=2
+        )
+
+        for i in range(interfile_header.matrix_size_3):
+            assert_same_slice(
+                pydicom.dcmread(serial_path / f"serial_{i}.dcm"),
+                pydicom.dcmread(pipeline_path / f"pipeline_{i}.dcm"),
+            )
+
+    @mark.parametrize("extended_format,as_buffer", [(False, False), (False, True), (True, False)])
+    def test_iter_dicom(self, synthetic_header, tmp_path, extended_format, as_buffer):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        output_path = tmp_path / ("file.dcm" if extended_format else "file")
+        write_dicom(interfile_header, metadata, output_path, extended_format=extended_format)
+
+        encoded = list(iter_dicom(
+            interfile_header, metadata, name="file",
+            extended_format=extended_format, as_buffer=as_buffer
+        ))
+
+        if extended_format:
+            assert [e.name for e in encoded] == ["file.dcm"]
+        else:
+            assert [e.name for e in encoded] == [
+                f"file_{i}.dcm" for i in range(interfile_header.matrix_size_3)
+            ]
+
+        for name, data in encoded:
+            written = tmp_path / name if extended_format else output_path / name
+            ds = pydicom.dcmread(data if as_buffer else BytesIO(data))
+            reference = pydicom.dcmread(written)
+            if extended_format:
+                for d in (reference, ds):
+                    del d.DimensionOrganizationSequence, d.DimensionIndexSequence
+            assert_same_slice(reference, ds)
+
+    @mark.parametrize("option", [["--pipeline"], ["--workers", "2"], ["--derived", "mips"]])
+    def test_archive_options_rejected(self, synthetic_header, tmp_path, option):
+        argv = [
+            "-i", str(synthetic_header), "-m", "tests/inputs/metadata_pt.json",
+            "-d", str(tmp_path), "-o", "study.zip",
+        ]
+        # Archive members are encoded by iter_dicom, which has no such options
+        with pytest.raises(SystemExit):
+            main(argv + option)
+        assert not (tmp_path / "study.zip").exists()
+
+    @mark.parametrize("archive,deflate", [
+        ("zip", False), ("zip", True), ("tar", False), ("tar.gz", False)
+    ])
+    def test_write_archive(self, synthetic_header, tmp_path, archive, deflate):
+        frames = list(iter_interfile_frames(synthetic_header))
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        write_frames(frames, metadata, tmp_path / "study", extended_format=False)
+        archive_path = tmp_path / "out" / f"study.{archive}"
+        write_frames(
+            frames, metadata, archive_path, extended_format=False, archive_deflate=deflate
+        )
+
+        # Nothing but the archive is written
+        assert list((tmp_path / "out").iterdir()) == [archive_path]
+
+        if archive == "zip":
+            with zipfile.ZipFile(archive_path) as zf:
+                compress_types = {info.compress_type for info in zf.infolist()}
+                assert compress_types == {zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED}
+                members = {name: zf.read(name) for name in zf.namelist()}
+        else:
+            with tarfile.open(archive_path) as tf:
+                members = {m.name: tf.extractfile(m).read() for m in tf.getmembers()}
+
+        slices = frames[0].matrix_size_3
+        assert sorted(members) == sorted(f"study_{i}.dcm" for i in range(slices))
+        for i in range(slices):
+            assert_same_slice(
+                pydicom.dcmread(tmp_path / "study" / f"study_{i}.dcm"),
+                pydicom.dcmread(BytesIO(members[f"study_{i}.dcm"])),
+            )
+
+    @mark.parametrize("lazy,backend", [(False, "pydicom"), (True, "stream")])
+    def test_write_dicom_per_slice_rescale(self, tmp_path, synthetic_volume, lazy, backend):
+        # Activity grows by three orders of magnitude along the volume
+        volume = synthetic_volume * np.logspace(0, 3, len(synthetic_volume), dtype=np.float32)[:, None, None]
+        header_path = write_interfile(tmp_path, "image", volume)
+        interfile_header = interfile_header_import(path=header_path)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        output_path = tmp_path / "out"
+        write_dicom(
+            interfile_header, metadata, output_path, extended_format=False,
+            lazy=lazy, backend=backend, per_slice_rescale=True
+        )
+
+        # Slices are flipped as in read_binary
+        expected = volume[::-1, ::-1, :]
+        for i in range(len(volume)):
+            ds = pydicom.dcmread(output_path / f"out_{i}.dcm")
+            slope, intercept = float(ds.RescaleSlope), float(ds.RescaleIntercept)
+            assert np.isclose(intercept, expected[i].min())
+            assert np.isclose(slope, (expected[i].max() - expected[i].min())/np.iinfo(np.int16).max)
+
+            values = np.frombuffer(ds.PixelData, dtype=np.uint16)*slope + intercept
+            assert np.allclose(values, expected[i].ravel(), atol=slope)
+
+        extended_path = tmp_path / "extended.dcm"
+        write_dicom(
+            interfile_header, metadata, extended_path, extended_format=True,
+            lazy=lazy, backend=backend, per_slice_rescale=True
+        )
+        ds = pydicom.dcmread(extended_path)
+        assert "PixelValueTransformationSequence" not in ds.SharedFunctionalGroupsSequence[0]
+        for i, frame in enumerate(ds.PerFrameFunctionalGroupsSequence):
+            transformation = frame.PixelValueTransformationSequence[0]
+            assert np.isclose(float(transformation.RescaleIntercept), expected[i].min())
+
+    @mark.parametrize("dtype,lazy,backend,compression", [
+        ("<f4", False, "pydicom", None),
+        ("<f4", True, "stream", None),
+        (">f4", True, "stream", "deflate"),
+        ("<f8", False, "pydicom", "deflate"),
+    ])
+    def test_write_dicom_float_pixel_data(self, tmp_path, synthetic_volume, dtype, lazy, backend, compression):
+        volume = synthetic_volume.astype(dtype)
+        interfile_header = interfile_header_import(path=write_interfile(tmp_path, "image", volume))
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        kwargs = dict(lazy=lazy, backend=backend, compression=compression, float_pixel_data=True)
+
+        output_path = tmp_path / "out"
+        write_dicom(interfile_header, metadata, output_path, extended_format=False, **kwargs)
+
+        # Voxels are written as they are, flipped as in read_binary
+        expected = volume[::-1, ::-1, :]
+        keyword = "FloatPixelData" if dtype[-1] == "4" else "DoubleFloatPixelData"
+        for i in range(len(volume)):
+            ds = pydicom.dcmread(output_path / f"out_{i}.dcm")
+            assert keyword in ds and "PixelData" not in ds
+            assert ds.BitsAllocated == 8*volume.itemsize and "PixelRepresentation" not in ds
+            assert (float(ds.RescaleSlope), float(ds.RescaleIntercept)) == (1, 0)
+            assert np.array_equal(ds.pixel_array.ravel(), expected[i].ravel())
+
+        extended_path = tmp_path / "extended.dcm"
+        write_dicom(interfile_header, metadata, extended_path, extended_format=True, **kwargs)
+        assert np.array_equal(pydicom.dcmread(extended_path).pixel_array.ravel(), expected.ravel())
+
+    def test_slice_from_template(self, synthetic_header):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        volume = np.zeros((3, 4, 5), dtype=np.uint16)
+
+        template = create_series_template(
+            interfile_header, metadata, volume.shape, 1, 0, "<", {"StudyDate": "20220316"}
+        )
+        slices = [
+            create_slice_from_template(template, volume[i], metadata, i) for i in range(3)
+        ]
+
+        assert "PixelData" not in template
+        assert "InstanceNumber" not in template
+        assert [ds.InstanceNumber for ds in slices] == [1, 2, 3]
+        assert [ds.ImageIndex for ds in slices] == [1, 2, 3]
+        assert slices[0].ImagePositionPatient[2] != slices[1].ImagePositionPatient[2]
+        assert slices[0].file_meta is not slices[1].file_meta
+        assert all(ds.StudyDate == "20220316" for ds in slices)
+
+    def test_deprecated_slice_builders(self, synthetic_header):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        volume = read_binary(interfile_header)[0]
+
+        with pytest.deprecated_call():
+            ds = create_slice_dataset(interfile_header, volume[1], metadata, 1, len(volume))
+        assert np.array_equal(ds.pixel_array.ravel(), volume[1].ravel())
+        assert ds.InstanceNumber == 2
+
+        position = ds.ImagePositionPatient
+        with pytest.deprecated_call():
+            set_slice_position(ds, metadata, 2, len(volume))
+        assert ds.ImagePositionPatient[2] == position[2] + float(ds.SliceThickness)
+
+
+    @mark.parametrize("compression", [None, "rle", "deflate"])
+    @mark.parametrize("dtype", ["<f4", "<u1", ">i2"])
+    def test_stream_encoder(self, tmp_path, synthetic_volume, dtype, compression):
+        volume = (synthetic_volume * 10).astype(dtype)
+        header_path = write_interfile(tmp_path, "volume", volume)
+        interfile_header = interfile_header_import(path=header_path)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        binary_img, slope, intercept, byte_order = read_binary(interfile_header)
+        template = create_series_template(
+            interfile_header, metadata, binary_img.shape, slope, intercept, byte_order,
+            {"SOPInstanceUID": rand_uid(), "SOPClassUID": rand_uid()}, compression=compression
+        )
+        slice_tags = create_slice_elements(template, metadata, 0).keys()
+        encoder = StreamEncoder(template, list(slice_tags))
+
+        for backend, enc in [("pydicom", None), ("stream", encoder)]:
+            (tmp_path / backend / "out").mkdir(parents=True)
+            for i in range(binary_img.shape[0]):
+                write_slice(binary_img[i], i, template, metadata, tmp_path / backend / "out", enc)
+
+        for i in range(binary_img.shape[0]):
+            reference = tmp_path / "pydicom" / "out" / f"out_{i}.dcm"
+            streamed = tmp_path / "stream" / "out" / f"out_{i}.dcm"
+            if byte_order == "<":
+                assert reference.read_bytes() == streamed.read_bytes()
+            else:
+                # Big endian input is written as Explicit VR Little Endian
+                ds = pydicom.dcmread(streamed)
+                assert ds.file_meta.TransferSyntaxUID == transfer_syntax(compression)
+                assert ds.pixel_array.tobytes() == binary_img[i].astype("<i2").tobytes()
+
+    @mark.parametrize("backend", ["pydicom", "stream"])
+    def test_write_dicom_extended(self, synthetic_header, tmp_path, backend):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        binary_img, slope, intercept, _ = read_binary(interfile_header)
+
+        output_path = tmp_path / "extended.dcm"
+        write_dicom(
+            interfile_header, metadata, output_path, extended_format=True, lazy=True,
+            backend=backend
+        )
+
+        ds = pydicom.dcmread(output_path)
+        number_of_frames = interfile_header.matrix_size_3
+        assert ds.SOPClassUID == pydicom.uid.EnhancedPETImageStorage
+        assert ds.file_meta.MediaStorageSOPClassUID == pydicom.uid.EnhancedPETImageStorage
+        assert ds.NumberOfFrames == number_of_frames
+        assert "PixelSpacing" not in ds and "RescaleSlope" not in ds
+        assert ds.PixelData == binary_img.tobytes()
+
+        shared = ds.SharedFunctionalGroupsSequence[0]
+        assert shared.PixelMeasuresSequence[0].PixelSpacing == [2.5, 2.5]
+        assert shared.PixelValueTransformationSequence[0].RescaleSlope == slope
+        assert shared.PixelValueTransformationSequence[0].RescaleIntercept == intercept
+
+        per_frame = ds.PerFrameFunctionalGroupsSequence
+        assert len(per_frame) == number_of_frames
+        positions = [frame.PlanePositionSequence[0].ImagePositionPatient[2] for frame in per_frame]
+        assert positions == sorted(positions)
+        assert [
+            frame.FrameContentSequence[0].InStackPositionNumber for frame in per_frame
+        ] == list(range(1, number_of_frames + 1))
+
+    @mark.parametrize("compression", ["rle", "deflate"])
+    @mark.parametrize("extended_format", [False, True])
+    def test_write_dicom_compression(self, synthetic_header, tmp_path, compression, extended_format):
+        interfile_header = interfile_header_import(path=synthetic_header)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+        binary_img, _, _, _ = read_binary(interfile_header)
+
+        paths = {}
+        for backend in ["pydicom", "stream"]:
+            output_path = tmp_path / backend / ("out.dcm" if extended_format else "out")
+            write_dicom(
+                interfile_header, metadata, output_path, extended_format=extended_format,
+                backend=backend, compression=compression
+            )
+            paths[backend] = output_path if extended_format else output_path / "out_3.dcm"
+
+        for backend, path in paths.items():
+            ds = pydicom.dcmread(path)
+            assert ds.file_meta.TransferSyntaxUID == transfer_syntax(compression)
+            expected = binary_img if extended_format else binary_img[3]
+            assert ds.pixel_array.tobytes() == expected.tobytes()
+
+        reference, streamed = (pydicom.dcmread(path) for path in paths.values())
+        if extended_format:
+            # Dimension organization UID is generated for every file
+            for ds in (reference, streamed):
+                del ds.DimensionOrganizationSequence, ds.DimensionIndexSequence
+        assert_same_slice(reference, streamed)
+
+    @mark.parametrize("extended_format", [False, True])
+    def test_write_dynamic(self, tmp_path, synthetic_volume, extended_format):
+        dynamic = np.stack([synthetic_volume + 100*k for k in range(3)])
+        header_path = write_interfile(tmp_path, "dynamic", dynamic, frame_duration=30)
+        metadata = read_json_meta(Path("tests/inputs/metadata_pt.json"), "PT")
+
+        output_path = tmp_path / "out"
+        write_dynamic(
+            iter_interfile_frames(header_path), metadata, output_path,
+            extended_format=extended_format
+        )
+
+        datasets = [
+            pydicom.dcmread(
+                output_path / (f"frame_{k}.dcm" if extended_format else f"frame_{k}/frame_{k}_5.dcm")
+            )
+            for k in range(1, 4)
+        ]
+
+        assert len({ds.SeriesInstanceUID for ds in datasets}) == 3
+        assert len({ds.StudyInstanceUID for ds in datasets}) == 1
+        assert len({ds.FrameOfReferenceUID for ds in datasets}) == 1
+
+        for k, ds in enumerate(datasets):
+            assert ds.SeriesNumber == k + 1
+            assert list(ds.SeriesType) == ["DYNAMIC", "IMAGE"]
+            assert ds.NumberOfTimeSlices == 3
+            assert ds.FrameReferenceTime == 30000*k
+            assert ds.ActualFrameDuration == 30000
+
+            # Every frame is rescaled separately
+            if not extended_format:
+                assert np.isclose(float(ds.RescaleIntercept), dynamic[k].min())
+
+def assert_same_slice(ds_a, ds_b):
+    """
+        Compares two slices, skipping attributes which are generated on every conversion
+    """
+    for keyword in GENERATED_KEYWORDS:
+        for ds in (ds_a, ds_b, ds_a.file_meta, ds_b.file_meta):
+            if keyword in ds:
+                delattr(ds, keyword)
+    assert ds_a.file_meta == ds_b.file_meta
+    assert ds_a == ds_b
+